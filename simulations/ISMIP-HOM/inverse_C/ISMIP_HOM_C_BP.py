@@ -113,25 +113,52 @@ model.generate_uniform_mesh(nx, ny, nz, xmin=0, xmax=L, ymin=0, ymax=L,
 model.set_parameters(src.physical_constants.IceParameters())
 model.initialize_variables()
 
-F = src.solvers.SteadySolver(model,config)
-F.solve()
-
-model.eps_reg = 1e-5
-config['adjoint']['control_variable'] = [model.beta2]
-config['adjoint']['bounds'] = [(0.0,5000.0)]
-dolfin.File('results/beta2_obs.xml') << model.beta2
-
-A = src.solvers.AdjointSolver(model,config)
-u_o = model.u.vector().get_local()
-v_o = model.v.vector().get_local()
 U_e = 10.0
+ref_path = config['output_path']
 from scipy import random
 
-for i in range(50):
-    config['output_path'] = 'results/run_'+str(i)+'/'
+def setup(path):
+    # the reference solution, computed once by the parent process and read
+    # from disk by the members :
+    F = src.solvers.SteadySolver(model,config)
+    F.solve()
+    dolfin.File(path + 'beta2_obs.xml') << model.beta2
+    dolfin.File(path + 'U_ref.xml') << model.U
+    dolfin.File(path + 'u_ref.xml') << model.u
+    dolfin.File(path + 'v_ref.xml') << model.v
+
+def member(i, path):
+    dolfin.File(ref_path + 'U_ref.xml') >> model.U
+    dolfin.File(ref_path + 'u_ref.xml') >> model.u
+    dolfin.File(ref_path + 'v_ref.xml') >> model.v
+    u_o = model.u.vector().get_local()
+    v_o = model.v.vector().get_local()
+
+    model.eps_reg = 1e-5
+    config['adjoint']['control_variable'] = [model.beta2]
+    config['adjoint']['bounds'] = [(0.0,5000.0)]
+    config['output_path'] = path
+    A = src.solvers.AdjointSolver(model,config)
+
+    # each member draws its own, reproducible noise :
+    random.seed(i)
     model.beta2.vector()[:] = 1000.
     u_error = U_e*random.randn(len(u_o))
     v_error = U_e*random.randn(len(v_o))
     model.u_o.vector().set_local(u_o+u_error)
     model.v_o.vector().set_local(v_o+v_error)
     A.solve()
+    return {'I' : dolfin.assemble(A.adjoint_instance.I),
+            'forward_solves' : A.counters['forward'],
+            'adjoint_solves' : A.counters['adjoint']}
+
+# each member runs this script again, which only builds the model, up to 
+# E.solve(), where it runs member() and exits; setup() runs once, in this 
+# process only.  Running this script again resumes an interrupted 
+# ensemble :
+config['ensemble'] = { 'n_members' : 50,
+                       'n_workers' : 4,
+                       'store' : 'ensemble.json' }
+
+E = src.solvers.EnsembleSolver(member, config, setup)
+E.solve()
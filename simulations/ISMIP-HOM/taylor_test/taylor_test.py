@@ -0,0 +1,292 @@
+import sys
+src_directory = '../../../'
+sys.path.append(src_directory)
+
+import src.model
+import src.solvers
+import src.physics
+import src.physical_constants
+import src.helper
+import pylab
+import dolfin
+import json
+import time
+import os
+
+dolfin.set_log_active(False)
+
+# Taylor remainder tests of the adjoint gradients on small ISMIP-HOM C
+# meshes, with the wall times of the forward and adjoint solves.  Each run
+# appends one line per case to results/taylor_test.json, so that the rates
+# and times can be tracked from one revision to the next.  The rates of
+# r_1 should approach 2.
+#
+# Besides the gradients that UFL derives from the objectives, this covers 
+# the parts of src/physics.py that are derived by hand : the adjoint
+# right-hand side of the PointObservations misfit ('points' objective), 
+# the sign and assembly of the AdjointSensitivity gradients, and the 
+# hand-written adjoint operator of VelocityBalance_2, through its Uobs, 
+# adot and H gradients.  Two gradients are left out as they are not exact
+# by construction : the enthalpy path of AdjointSensitivity neglects the 
+# feedback of the velocity on the enthalpy, and the dS[1] gradient of 
+# VelocityBalance_2 holds dS[0] fixed, which solve_forward renormalizes.
+
+alpha = pylab.deg2rad(0.1)
+L     = 80000
+
+class Surface(dolfin.Expression):
+    def __init__(self):
+        pass
+    def eval(self,values,x):
+        values[0] = -x[0]*pylab.tan(alpha)
+
+class Bed(dolfin.Expression):
+    def __init__(self):
+        pass
+    def eval(self,values,x):
+        values[0] = -x[0]*pylab.tan(alpha) - 1000.0
+
+class Beta2(dolfin.Expression):
+    def __init__(self):
+        pass
+    def eval(self,values,x):
+        values[0] = 1000 + 1000.*pylab.sin(2*pylab.pi*x[0]/L)*pylab.sin(2*pylab.pi*x[1]/L)
+
+nparams = src.helper.default_nonlin_solver_params()
+nparams['newton_solver']['relaxation_parameter']=1.0
+nparams['newton_solver']['relative_tolerance']=1e-12
+nparams['newton_solver']['absolute_tolerance']=1e-10
+nparams['newton_solver']['maximum_iterations']=50
+nparams['newton_solver']['error_on_nonconvergence']=False
+nparams['newton_solver']['report']=False
+
+config = { 'mode' : 'steady',
+        'coupled' :
+            { 'on' : False,
+                'inner_tol': 0.0,
+                'max_iter' : 1
+            },
+        't_start' : None,
+        't_end' : None,
+        'time_step' : None,
+        'velocity' :
+            { 'on' : True,
+                'newton_params' : nparams,
+                'viscosity_mode' : 'isothermal',
+                'b_linear' : None,
+                'use_T0': False,
+                'T0' : None,
+                'A0' : 1e-16,
+                'beta2' : Beta2(),
+                'r' : 0.0,
+                'E' : 1,
+                'approximation' : 'fo',
+                'boundaries' : None
+            },
+        'enthalpy' :
+            { 'on': False,
+                'use_surface_climate': False,
+                'T_surface' : None,
+
+            },
+        'free_surface' :
+            { 'on': False,
+                'thklim': None,
+                'use_pdd': False,
+                'observed_smb': None,
+            },
+        'age' :
+            { 'on': False,
+                'use_smb_for_ela': False,
+                'ela': None,
+            },
+            'surface_climate' :
+            { 'on': False,
+                'T_ma': None,
+                'T_ju': None,
+                'beta_w': None,
+                'sigma': None,
+                'precip': None
+            },
+            'adjoint' :
+            { 'alpha' : [1e-2],
+                'beta' : 0.0,
+                'max_fun' : 20,
+                'objective_function' : None,
+                'animate' : False,
+                'bounds' : None,
+                'control_variable' : None,
+                'regularization_type' : None
+            },
+            'output_path' : './results/',
+            'wall_markers' : [],
+            'periodic_boundary_conditions' : True,
+            'log': False }
+
+sizes           = [8, 12]
+nz              = 4
+objectives      = ['logarithmic', 'linear', 'kinematic', 'points']
+regularizations = ['TV', 'Tikhonov']
+
+if not os.path.exists('results'):
+    os.makedirs('results')
+revision = time.strftime('%Y-%m-%d %H:%M:%S')
+out      = open('results/taylor_test.json', 'a')
+
+def record(case):
+    case['date'] = revision
+    out.write(json.dumps(case) + '\n')
+    out.flush()
+
+for nx in sizes:
+    model = src.model.Model()
+    model.set_geometry(Surface(), Bed())
+    model.generate_uniform_mesh(nx, nx, nz, xmin=0, xmax=L, ymin=0, ymax=L,
+                                generate_pbcs=True)
+    model.set_parameters(src.physical_constants.IceParameters())
+    model.initialize_variables()
+
+    # targets from the true beta2 :
+    F = src.solvers.SteadySolver(model,config)
+    F.solve()
+    model.u_o.vector().set_local(model.u.vector().get_local())
+    model.v_o.vector().set_local(model.v.vector().get_local())
+    model.eps_reg = 1e-5
+
+    n  = model.beta2.vector().size()
+    m0 = 1000.0 * pylab.ones(n)
+    pylab.seed(0)
+    dm = 100.0 * pylab.rand(n)
+
+    # scattered surface observations of the true velocity, for 'points' :
+    xy  = L * (0.05 + 0.9 * pylab.rand(10*nx, 2))
+    obs = src.physics.PointObservations(model.Q2, xy, pylab.zeros((len(xy),2)))
+    d   = obs.evaluate(model.U).reshape(-1, 2)
+    config['adjoint']['observations'] = \
+        src.physics.PointObservations(model.Q2, xy, d, sigma=10.0)
+
+    for objective in objectives:
+        for regularization in regularizations:
+            print 'nx = %i, %s objective, %s regularization' \
+                  % (nx, objective, regularization)
+            config['adjoint']['objective_function']  = objective
+            config['adjoint']['regularization_type'] = regularization
+            config['adjoint']['control_variable']    = [model.beta2]
+            A = src.solvers.AdjointSolver(model,config)
+
+            t0 = time.time()
+            A.forward_state(m0)
+            t_forward = time.time() - t0
+
+            t0 = time.time()
+            dJ = A.gradient(m0)
+            t_adjoint = time.time() - t0
+
+            J = lambda m : A.forward_state(m)['I']
+            r = src.helper.taylor_test(J, dJ, m0, dm)
+
+            r.update({'case'           : 'AdjointVelocityBP',
+                      'nx'             : nx,
+                      'objective'      : objective,
+                      'regularization' : regularization,
+                      't_forward'      : t_forward,
+                      't_adjoint'      : t_adjoint})
+            record(r)
+
+# sensitivity of the mean square surface speed to beta2 and S, by 
+# AdjointSensitivity, about the true beta2 :
+for nx in sizes:
+    model = src.model.Model()
+    model.set_geometry(Surface(), Bed())
+    model.generate_uniform_mesh(nx, nx, nz, xmin=0, xmax=L, ymin=0, ymax=L,
+                                generate_pbcs=True)
+    model.set_parameters(src.physical_constants.IceParameters())
+    model.initialize_variables()
+    model.eps_reg = 1e-5
+    
+    U = model.U
+    G = (U[0]**2 + U[1]**2) * model.ds(2)
+    
+    for name, scale in [('beta2', 100.0), ('S', 10.0)]:
+        print 'nx = %i, sensitivity to %s' % (nx, name)
+        Sens = src.solvers.SensitivitySolver(model, config, G, fields=[name])
+        f    = getattr(model, name)
+        m0   = f.vector().array().copy()
+        pylab.seed(0)
+        dm   = scale * pylab.rand(len(m0))
+        
+        def J(m):
+            f.vector().set_local(m)
+            f.vector().apply('insert')
+            Sens.forward_model.solve()
+            return dolfin.assemble(G)
+        
+        t0 = time.time()
+        J(m0)
+        t_forward = time.time() - t0
+
+        t0 = time.time()
+        dJ = Sens.solve(forward=False)[name].vector().array()
+        t_adjoint = time.time() - t0
+
+        r = src.helper.taylor_test(J, dJ, m0, dm)
+        J(m0)
+        r.update({'case'      : 'AdjointSensitivity',
+                  'nx'        : nx,
+                  'field'     : name,
+                  't_forward' : t_forward,
+                  't_adjoint' : t_adjoint})
+        record(r)
+
+# gradients of the balance velocity misfit with respect to Uobs, adot and 
+# H, on a flat sheet of varying thickness :
+for nx in sizes:
+    mesh = dolfin.RectangleMesh(0, 0, L, L, 4*nx, 4*nx)
+    Q    = dolfin.FunctionSpace(mesh, 'CG', 1)
+    H    = dolfin.interpolate(dolfin.Expression(
+             '1000 + 500*sin(pi*x[0]/L)*sin(pi*x[1]/L)', L=L), Q)
+    S    = dolfin.interpolate(dolfin.Expression(
+             '1000 + 500*sin(pi*x[0]/L)*sin(pi*x[1]/L) - 1e-3*x[0]', L=L), Q)
+    adot = dolfin.interpolate(dolfin.Constant(0.3), Q)
+    Uobs = dolfin.interpolate(dolfin.Expression('50*x[0]/L', L=L), Q)
+    mask = dolfin.CellFunctionSizet(mesh)
+    mask.set_all(1)
+
+    prb = src.physics.VelocityBalance_2(mesh, H, S, adot, 8.0, Uobs=Uobs,
+                                        Uobs_mask=mask,
+                                        alpha=[0.0,1e2,0.0,0.0])
+
+    controls = [('Uobs', prb.Uobs, 1.0), ('adot', prb.adot, 0.1),
+                ('H', prb.H, 10.0)]
+    for i, (name, f, scale) in enumerate(controls):
+        print 'nx = %i, balance velocity gradient wrt %s' % (4*nx, name)
+
+        def J(m):
+            f.vector().set_local(m)
+            f.vector().apply('insert')
+            prb.solve_forward()
+            return prb.objective()
+
+        m0 = f.vector().array().copy()
+        pylab.seed(0)
+        dm = scale * pylab.rand(len(m0))
+
+        t0 = time.time()
+        J(m0)
+        t_forward = time.time() - t0
+
+        t0 = time.time()
+        prb.solve_adjoint()
+        dJ = prb.get_gradient()[i]
+        t_adjoint = time.time() - t0
+
+        r = src.helper.taylor_test(J, dJ, m0, dm)
+        J(m0)
+        r.update({'case'      : 'VelocityBalance_2',
+                  'nx'        : 4*nx,
+                  'control'   : name,
+                  't_forward' : t_forward,
+                  't_adjoint' : t_adjoint})
+        record(r)
+
+out.close()
@@ -2,13 +2,13 @@ import sys
 import os
 src_directory = '../../../'
 sys.path.append(src_directory)
-from src.utilities     import DataInput,DataOutput
+from src.utilities     import DataInput,DataOutput,CellBins
 from data.data_factory import DataFactory
 from src.physics       import VelocityBalance_2
+from src.solvers       import BalanceVelocityAssimilationSolver
 import numpy as numpy
 from pylab             import *
 from dolfin            import *
-from scipy.optimize import fmin_l_bfgs_b
 import os
 
 set_log_active(True)
@@ -57,13 +57,9 @@ Uobs   = dms.get_interpolation("sp",kx=1,ky=1)
 dhdt = dsr.get_interpolation('dhdt',kx=1,ky=1)
 vx  = dms.get_interpolation("vx",kx=1,ky=1) # no interpolation
 vy  = dms.get_interpolation("vy",kx=1,ky=1)
-vxerr  = dms.get_interpolation("ex",kx=1,ky=1) # no interpolation
-vyerr  = dms.get_interpolation("ey",kx=1,ky=1)
 
 N = as_vector([vx,vy])
 
-verr = project(abs(sqrt(abs(vxerr*2+vyerr**2 + 1e-3))))
-
 Uobs_o = Uobs.copy() # So that we can eliminate 'no data' point in a minute
 
 # Multiply the observed velocities by a 'shape factor' to go
@@ -79,48 +75,41 @@ Uobs = project(Uobs * (.8 + .2 / (1 + exp(-(Uobs - 50) * .25))))
 
 Uobs.vector()[Uobs_o.vector().array()<0] = NO_DATA # Relies on copy, Uobs_o
 
-U_sar_spline = dms.get_spline_expression("sp")
-
 # Create a mask that only uses lower error velocities.
 
 VELOCITY_THRESHOLD = 0.5   # A lower limit on credible InSAR measurements.
 V_ERROR_THRESHOLD = 0.15  # Errors larger than this fraction ignored
 
-insar_mask = CellFunctionSizet(mesh)
-insar_mask.set_all(0)
-for c in cells(mesh):
-    x,y = c.midpoint().x(),c.midpoint().y()
-    Uval = U_sar_spline(x,y)
-    vxerrval = vxerr(x,y)
-    verrval  = verr(x,y)
-
-    if Uval>VELOCITY_THRESHOLD and vxerrval != NO_DATA\
-                            and verrval/Uval < V_ERROR_THRESHOLD:
-        insar_mask[c] = 1
-
-# Create a per vertex data type that has velocity errors where mask is true
-# and infinity else where
-Uerr = VertexFunctionDouble(mesh)
-Uerr.set_all(MAX_V_ERR)  # This is 'infinite' error, the search is unbound
-for v in vertices(mesh):
-    x,y      = v.x(0), v.x(1)
-    Uval     = U_sar_spline(x,y)
-    vxerrval = vxerr(x,y)
-    verrval  = verr(x,y)
-
-    if Uval>VELOCITY_THRESHOLD and vxerrval != NO_DATA\
-                            and verrval/Uval < V_ERROR_THRESHOLD:
-        Uerr[v] = verrval
+# Bin the InSAR pixels into the cells of the mesh, keeping the credible,
+# low error pixels.  The cells with data make up the mask, and weigh into 
+# the misfit with the inverse variance of their mean.
+bins  = CellBins(dms, mesh)
+sp    = dms.data['sp']
+ex    = dms.data['ex']
+ey    = dms.data['ey']
+v_err = numpy.sqrt(ex**2 + ey**2)
+valid = (sp > VELOCITY_THRESHOLD) & (ex != NO_DATA) & (ey != NO_DATA) \
+        & (v_err < V_ERROR_THRESHOLD * sp)
+sar   = bins.bin(sp, err=v_err, valid=valid)
+
+insar_mask  = bins.get_mask(sar['mask'])
+Uobs_weight = bins.get_function(sar['weight'])
+
+# Velocity errors where the mask is true and 'infinite' error elsewhere, 
+# so that the search is unbound.  The InSAR errors are correlated over 
+# many pixels, so the error of a cell mean does not shrink like 1/sqrt(N)
+# as sar['std'] does; the bounds and scaling use the error of a single 
+# pixel, the fully correlated limit, as they did before the binning.
+v2d  = Uobs.function_space().dofmap().vertex_to_dof_map(mesh)
+Uerr = Function(Uobs.function_space())
+Uerr.vector().set_local(bins.get_vertex_values(sar['err'], sar['mask'],
+                                               MAX_V_ERR)[v2d])
  
 # Problem definition
 SMOOTH_RADIUS = 20.  # How many ice thicknesses to smooth over 
 prb   = VelocityBalance_2(mesh, H, S, adot, SMOOTH_RADIUS,\
               Uobs=Uobs,Uobs_mask=insar_mask,N_data = N,NO_DATA = NO_DATA,\
-              alpha = [1.e9,1.e10,1.e1,1.e5])
-
-# bounds = Uobs_bounds + ahat_bounds + H_bounds + Ny_bounds
-
-n = len(mesh.coordinates())
+              alpha = [1.e9,1.e10,1.e1,1.e5],Uobs_weight=Uobs_weight)
 
 # IO
 Uopt_file = File('results5km/Uopt.pvd')
@@ -148,22 +137,7 @@ Herr_file << Herr
 Uerr_file << Uerr
 
 
-def _I_fun(x,*args):
-    prb.Uobs.vector()[:]    = x[:n]
-    prb.adot.vector()[:]    = x[n:2*n]
-    prb.H.vector()[:]       = x[2*n:3*n]
-    prb.dS[1].vector()[:]   = x[3*n:]
-
-    prb.solve_forward()
-    I = assemble(prb.I)
-    return I
-
-def _J_fun(x,*args):
-    prb.Uobs.vector()[:]    = x[:n]
-    prb.adot.vector()[:]    = x[n:2*n]
-    prb.H.vector()[:]       = x[2*n:3*n]
-    prb.dS[1].vector()[:]   = x[3*n:]
-
+def _write(prb):
     # I/O
     Uopt_file << prb.Ubmag
     Uobs_file << prb.Uobs
@@ -185,21 +159,13 @@ def _J_fun(x,*args):
           assemble(project(Constant(1),prb.Q) * prb.dx_masked(1)))
     print "================================================================"
 
-    prb.solve_adjoint()
-    g = prb.get_gradient()
-    print args
-    for i in args:
-        g[i][:] = 0.
-
-    return hstack(g)
-
 
 amerr = 1.0
 aaerr = 40.0
 ahat_bounds = [(min(r-amerr*abs(r),r-aaerr),max(r+amerr*abs(r),r+aaerr)) for r in adot.vector().array()] 
 
 small_u = VELOCITY_THRESHOLD/2. # Minimal error in velocity
-Uobs_bounds = [(min(Uobs_i - Uerr_i,Uobs_i-small_u), max(Uobs_i+Uerr_i,Uobs_i+small_u)) for Uobs_i,Uerr_i in zip(Uobs.vector().array(),Uerr.array())] 
+Uobs_bounds = [(min(Uobs_i - Uerr_i,Uobs_i-small_u), max(Uobs_i+Uerr_i,Uobs_i+small_u)) for Uobs_i,Uerr_i in zip(Uobs.vector().array(),Uerr.vector().array())] 
 
 small_h = 35. # Minimal uncertainty: replaces Bamber's zeros. ~35 is what Morlighem used
 H_bounds = [(min(H_i - Herr_i,H_i-small_h), max(H_i + Herr_i,H_i+small_h)) \
@@ -214,16 +180,21 @@ Ny_err = project(Constant(Ny_err) * (.1 + (1. / (1 + exp(-(prb.Ubmag - 50.) * .2
 
 Ny_bounds = [(min(Ny-Ny_err_i,-1.),max(Ny+Ny_err_i,1.)) for Ny,Ny_err_i in zip(prb.dS[1].vector().array(),Ny_err.vector().array())] 
 
-bounds = Uobs_bounds + ahat_bounds + H_bounds + Ny_bounds
-x0 = hstack((Uobs.vector().array(),adot.vector().array(),\
-         H.vector().array(),prb.dS[1].vector().array()))
-
-# Search in the direction of each gradient, sequentially
-for f in range(20):
-    freeze = [(f)%4,(f+1)%4,(f+2)%4]
-    fmin_l_bfgs_b(_I_fun,x0,fprime=_J_fun,bounds=bounds,iprint=1,args=(freeze),maxfun=20)
-    x0 = hstack((prb.Uobs.vector().array(),prb.adot.vector().array(),\
-             prb.H.vector().array(),prb.dS[1].vector().array()))
+# Optimize all four controls jointly, each scaled by its error
+bounds = [array(b).T for b in (Uobs_bounds, ahat_bounds, H_bounds, Ny_bounds)]
+scale  = [Uerr.vector().array() + small_u,
+          numpy.maximum(amerr*abs(adot.vector().array()), aaerr),
+          Herr.vector().array() + small_h,
+          Ny_err.vector().array()]
+
+config = {'balance_assimilation' : {'bounds'       : bounds,
+                                    'scale'        : scale,
+                                    'max_fun'      : 400,
+                                    'gtol'         : 1e-5,
+                                    'restart_file' : 'results5km/x_opt.npy'}}
+
+bva = BalanceVelocityAssimilationSolver(prb, config)
+bva.solve(callback=_write)
 
 Uopt_file_xml << prb.Ubmag
 bed_file_xml << project(S - prb.H,dbam.func_space)
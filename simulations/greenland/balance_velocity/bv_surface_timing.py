@@ -0,0 +1,102 @@
+import sys
+src_directory = '../../../'
+sys.path.append(src_directory)
+
+import src.model
+import src.solvers
+import src.physical_constants
+import time
+from dolfin              import *
+from data.data_factory   import DataFactory
+from meshes.mesh_factory import MeshFactory
+from src.utilities       import DataInput
+
+# Wall times of the balance velocity on the planar surface mesh against the
+# former formulation over ds(2) of the full 3D function space, on the coarse
+# Greenland mesh.
+
+set_log_active(False)
+
+vara = DataFactory.get_searise(thklim = 50.0)
+
+mesh                    = MeshFactory.get_greenland_coarse()
+flat_mesh               = MeshFactory.get_greenland_coarse()
+mesh.coordinates()[:,2] = mesh.coordinates()[:,2]/1000.0
+
+dd      = DataInput(None, vara, mesh=mesh)
+Surface = dd.get_spline_expression('h')
+Bed     = dd.get_spline_expression('b')
+SMB     = dd.get_spline_expression('adot')
+
+config = {'balance_velocity' : {'kappa' : 10.0,
+                                'smb'   : SMB}}
+
+model = src.model.Model()
+model.set_geometry(Surface, Bed)
+model.set_mesh(mesh, flat_mesh=flat_mesh, deform=True)
+model.set_parameters(src.physical_constants.IceParameters())
+model.initialize_variables()
+
+# surface mesh :
+t0 = time.time()
+bv = src.solvers.BalanceVelocitySolver(model, config)
+t_setup = time.time() - t0
+
+t0 = time.time()
+bv.solve()
+t_surface = time.time() - t0
+U_surface = model.U.vector().get_local()
+
+# former 3D formulation :
+t0      = time.time()
+kappa   = config['balance_velocity']['kappa']
+rho     = model.rho
+g       = model.g
+Q_flat  = model.Q_flat
+ds      = model.ds
+phi     = TestFunction(Q_flat)
+dU      = TrialFunction(Q_flat)
+Nx      = TrialFunction(Q_flat)
+Ny      = TrialFunction(Q_flat)
+H_      = Function(Q_flat)
+S_      = Function(Q_flat)
+dSdx    = Function(Q_flat)
+dSdy    = Function(Q_flat)
+U       = Function(Q_flat)
+smb_    = project(SMB, Q_flat)
+H_.vector().set_local(model.S.vector().get_local() -
+                      model.B.vector().get_local())
+S_.vector().set_local(model.S.vector().get_local())
+
+R_dSdx = + Nx * phi * ds(2) \
+         - rho * g * H_ * S_.dx(0) * phi * ds(2) \
+         + (kappa*H_)**2 * (phi.dx(0)*Nx.dx(0) + phi.dx(1)*Nx.dx(1)) * ds(2)
+R_dSdy = + Ny * phi * ds(2) \
+         - rho * g * H_ * S_.dx(1) * phi * ds(2) \
+         + (kappa*H_)**2 * (phi.dx(0)*Ny.dx(0) + phi.dx(1)*Ny.dx(1)) * ds(2)
+
+slope  = sqrt(dSdx**2 + dSdy**2) + 1e-5
+dS     = as_vector([-dSdx/slope, -dSdy/slope])
+h      = CellSize(model.flat_mesh)
+tau    = h/(2.0 * sqrt(dot(dS*H_, dS*H_)))
+term1  = phi + tau*(Dx(H_*phi*dS[0], 0) + Dx(H_*phi*dS[1], 1))
+term2  = Dx(dU*dS[0]*H_, 0) + Dx(dU*dS[1]*H_, 1) - smb_
+dI     = term1 * term2 * ds(2)
+
+for R, f in [(R_dSdx, dSdx), (R_dSdy, dSdy), (dI, U)]:
+    A = assemble(lhs(R))
+    A.ident_zeros()
+    b = assemble(rhs(R))
+    solve(A, f.vector(), b)
+t_full = time.time() - t0
+
+dU = abs(U.vector().get_local() - U_surface).max()
+
+print 'unknowns (3D space / surface mesh) : %i / %i' \
+      % (Q_flat.dim(), bv.bv_instance.Q_s.dim())
+print 'surface mesh setup                 : %.2f s' % t_setup
+print 'surface mesh solve                 : %.2f s' % t_surface
+print '3D space setup and solve           : %.2f s' % t_full
+print 'speed-up                           : %.1f' \
+      % (t_full / (t_setup + t_surface))
+print 'max |U_3D - U_surface|             : %.3e' % dU
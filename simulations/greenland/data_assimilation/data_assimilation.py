@@ -13,7 +13,6 @@ from src.utilities       import DataInput
 from dolfin              import *
 
 set_log_active(True)
-parameters['form_compiler']['quadrature_degree'] = 1
 
 vara = DataFactory.get_searise()
 
@@ -65,7 +64,9 @@ config = { 'mode'                         : 'steady',
              'r'              : 1.0,
              'E'              : 1.0,
              'approximation'  : 'fo',
-             'boundaries'     : None
+             'boundaries'     : None,
+             'continuation'   : {'eps_reg' : 1e-2, 'n' : 1.0},
+             'quadrature_degree' : {'viscous' : 1}
            },
            'enthalpy' : 
            { 
@@ -73,7 +74,8 @@ config = { 'mode'                         : 'steady',
              'use_surface_climate' : False,
              'T_surface'           : SurfaceTemperature,
              'q_geo'               : BasalHeatFlux,
-             'lateral_boundaries'  : None
+             'lateral_boundaries'  : None,
+             'quadrature_degree'   : {'strain_heating' : 1}
            },
            'free_surface' :
            { 
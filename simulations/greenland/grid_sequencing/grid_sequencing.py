@@ -0,0 +1,76 @@
+import sys
+src_directory = '../../../'
+sys.path.append(src_directory)
+
+import src.model
+import src.physics
+import src.physical_constants
+import src.helper
+import time
+import dolfin
+from data.data_factory   import DataFactory
+from meshes.mesh_factory import MeshFactory
+from src.utilities       import DataInput
+
+dolfin.set_log_active(True)
+
+# Cold first-order velocity solves on the medium Greenland mesh, from zero 
+# velocity and from the solution on the coarse mesh (grid sequencing).  The
+# second solve on each level reuses the cached transfer operators.
+
+vara = DataFactory.get_searise(thklim = 50.0)
+
+nonlin_solver_params = src.helper.default_nonlin_solver_params()
+nonlin_solver_params['newton_solver']['relaxation_parameter']    = 0.7
+nonlin_solver_params['newton_solver']['relative_tolerance']      = 1e-3
+nonlin_solver_params['newton_solver']['maximum_iterations']      = 30
+nonlin_solver_params['newton_solver']['error_on_nonconvergence'] = False
+nonlin_solver_params['linear_solver']                            = 'mumps'
+nonlin_solver_params['preconditioner']                           = 'default'
+
+config = { 'mode'                         : 'steady',
+           'output_path'                  : './results/',
+           'wall_markers'                 : [],
+           'periodic_boundary_conditions' : False,
+           'log'                          : False,
+           'enthalpy'                     : {'on' : False},
+           'velocity' : 
+           { 
+             'on'             : True,
+             'newton_params'  : nonlin_solver_params,
+             'viscosity_mode' : 'isothermal',
+             'b_linear'       : None,
+             'use_T0'         : False,
+             'T0'             : None,
+             'A0'             : 1e-16,
+             'beta2'          : 2.0,
+             'r'              : 1.0,
+             'E'              : 1.0,
+             'approximation'  : 'fo',
+             'boundaries'     : None
+           }}
+
+def get_model(mesh):
+    flat_mesh = dolfin.Mesh(mesh)
+    dd        = DataInput(None, vara, mesh=mesh)
+    model     = src.model.Model()
+    model.set_geometry(dd.get_spline_expression('h'), 
+                       dd.get_spline_expression('b'))
+    model.set_mesh(mesh, flat_mesh=flat_mesh, deform=True)
+    model.set_parameters(src.physical_constants.IceParameters())
+    model.initialize_variables()
+    model.eps_reg = 1e-5
+    return model
+
+fine   = get_model(MeshFactory.get_greenland_medium())
+coarse = get_model(MeshFactory.get_greenland_coarse())
+
+for levels in [None, [{'model' : coarse}]]:
+    config['velocity']['levels'] = levels
+    velocity = src.physics.VelocityBP(fine, config)
+    for i in range(2):
+        fine.U.vector()[:] = 0.0
+        t0 = time.time()
+        velocity.solve()
+        print 'levels : %s, solve %i : %.2f s' \
+              % (levels is not None, i, time.time() - t0)
@@ -37,7 +37,9 @@ meshes used in the simulations.
 """
 
 from dolfin import *
+from scipy.sparse import csr_matrix
 import pylab as p
+import time
 
 
 def download_file(url, direc, folder, extract=False):
@@ -109,6 +111,10 @@ def extrude_z(f, b, d, model):
 
   and solving.  
   
+  On a layered mesh, functions are extruded up from the bed (<b> = 3) or 
+  down from the surface (<b> = 2) directly along the columns of 
+  model.columns, without a solve.
+  
   :param f     : Dolfin function defined along a boundary
   :param b     : Boundary condition
   :param d     : Subdomain over which to perform differentiation
@@ -116,6 +122,12 @@ def extrude_z(f, b, d, model):
   """
   Q   = model.Q
 
+  # layered meshes are extruded directly along the columns :
+  if d == 2 and b in (2, 3) and isinstance(f, Function) \
+     and model.columns.structured:
+    boundary = {2 : 'surface', 3 : 'bed'}[b]
+    return model.columns.extrude(f, boundary, Function(Q))
+
   # Define test and trial based on function space.
   ffe = TrialFunction(Q)
   phi = TestFunction(Q)
@@ -131,6 +143,337 @@ def extrude_z(f, b, d, model):
   return fe
 
 
+class LinearSolveCache(object):
+  """
+  Cache of the assembled and LU-factorized left-hand sides of linear 
+  problems, keyed on the form signature, the function spaces of its
+  arguments and the coefficients it depends on.  Problems that share a
+  left-hand side, such as the x and y components of a smoothed gradient,
+  are factorized once and every right-hand side is solved against the 
+  same factorization.
+
+  The cache does not track the values of the coefficients; call clear()
+  whenever a coefficient of a cached left-hand side changes.
+  
+  :param method : LU method passed to the dolfin LUSolver
+  """
+  def __init__(self, method='default'):
+    self.method  = method
+    self.solvers = {}
+
+  def key(self, a):
+    """
+    Returns the cache key of the bilinear form <a>.
+    """
+    from ufl.algorithms import extract_arguments
+    V = tuple(v.function_space().id() for v in extract_arguments(a))
+    c = tuple(f.count() for f in a.coefficients())
+    return (a.signature(), V, c)
+
+  def get_solver(self, a):
+    """
+    Returns the LUSolver of the bilinear form <a>, assembling and 
+    factorizing it on the first call.
+    """
+    k = self.key(a)
+    if k not in self.solvers:
+      solver = LUSolver(assemble(a), self.method)
+      solver.parameters['reuse_factorization'] = True
+      self.solvers[k] = solver
+    return self.solvers[k]
+
+  def solve(self, a, L, u):
+    """
+    Solve a(v,u_i) = L_i(v) for each pair of the lists <L> and <u>, 
+    against the one factorization of <a>.
+
+    :param a : Bilinear form
+    :param L : Linear form, or list of linear forms
+    :param u : Function, or list of Functions to hold the solutions
+    """
+    if not isinstance(L, list):
+      L, u = [L], [u]
+    solver = self.get_solver(a)
+    for L_i, u_i in zip(L, u):
+      solver.solve(u_i.vector(), assemble(L_i))
+
+  def clear(self):
+    """
+    Discard all the cached factorizations.
+    """
+    self.solvers = {}
+
+
+class Columns(object):
+  """
+  Index of the vertical columns of vertices of a layered mesh, such as the 
+  extruded meshes of :class:`~src.model.Model`, with vectorized vertical 
+  operators on piecewise-linear Functions.  The vertices are grouped by 
+  their (x,y) coordinates, and each column is ordered from the bed to the 
+  surface.  Integrals are evaluated by the trapezoidal rule along the 
+  vertical edges, which is exact for piecewise-linear functions, at O(N) 
+  cost and without a linear solve.
+
+  :attr:`index` holds the vertex indices of shape (n_columns, n_layers), 
+  and :attr:`column` the column of each vertex.
+  
+  The mesh is structured if every column holds the same number of 
+  vertices; only then are the operators available, and callers fall back
+  to the variational solves otherwise.  The z coordinates are read at each
+  call, so the index remains valid as the mesh is deformed vertically.
+  
+  The index is built from the process-local mesh and vertex dofs, and a 
+  partition may split the columns between processes, so that the mesh is 
+  never structured in parallel.  All processes then take the same branch
+  of the collective solves.
+
+  :param mesh : Dolfin 3D mesh
+  :param tol  : Relative tolerance on the (x,y) coordinates of a column
+  """
+  def __init__(self, mesh, tol=1e-8):
+    self.mesh       = mesh
+    self.dofs       = {}
+    self.structured = False
+    self.index      = None
+    self.column     = None
+    if MPI.num_processes() > 1:
+      return
+    
+    x      = mesh.coordinates()
+    L      = max(p.ptp(x[:,0]), p.ptp(x[:,1]), 1e-16)
+    xy     = p.around((x[:,:2] - x[:,:2].min(axis=0)) / (L*tol))
+    xy, c  = p.unique(xy[:,0] + 1j*xy[:,1], return_inverse=True)
+    c      = c.ravel()
+    counts = p.bincount(c)
+   
+    self.structured = counts.min() == counts.max() and counts.min() > 1
+    self.column     = c
+    if self.structured:
+      # vertex indices of shape (n_columns, n_layers), bed to surface :
+      order      = p.lexsort((x[:,2], c))
+      self.index = order.reshape(len(counts), counts[0])
+
+  def get_dofs(self, V):
+    """
+    Returns the cached vertex dofs of the CG1 FunctionSpace <V>.
+    """
+    k = V.id()
+    if k not in self.dofs:
+      self.dofs[k] = get_vertex_dofs(V)
+    return self.dofs[k]
+
+  def get_values(self, f):
+    """
+    Returns the values of the Function <f> on the columns, as an array of 
+    shape (n_columns, n_layers).
+    """
+    v2d = self.get_dofs(f.function_space())
+    return f.vector().get_local()[v2d][self.index]
+
+  def set_values(self, f, values):
+    """
+    Set the values of the Function <f> from the array <values> of shape
+    (n_columns, n_layers), and return <f>.
+    """
+    v2d    = self.get_dofs(f.function_space())
+    v      = f.vector().get_local()
+    vv     = p.empty(self.mesh.num_vertices())
+    vv[self.index] = values
+    v[v2d] = vv
+    f.vector().set_local(v)
+    f.vector().apply('insert')
+    return f
+
+  def get_z(self):
+    """
+    Returns the z coordinates of the columns.
+    """
+    return self.mesh.coordinates()[:,2][self.index]
+
+  def get_out(self, f, out):
+    """
+    Returns <out>, or a new Function in the space of <f> if it is None.
+    """
+    if out is None:
+      out = Function(f.function_space())
+    return out
+
+  def extrude(self, f, boundary='surface', out=None):
+    """
+    Extrude the values of <f> on the 'surface' or 'bed' <boundary> down or 
+    up the columns, into the Function <out> if given.
+    """
+    j = {'surface' : -1, 'bed' : 0}[boundary]
+    v = self.get_values(f)
+    return self.set_values(self.get_out(f, out), 
+                           p.tile(v[:,[j]], (1, v.shape[1])))
+
+  def integrate(self, f, boundary='bed', out=None):
+    """
+    Vertical integral of <f> from the 'bed' or 'surface' <boundary> to each 
+    vertex, into the Function <out> if given.
+    """
+    I = self.integrate_values(self.get_values(f))
+    if boundary == 'surface':
+      I = I[:,[-1]] - I
+    return self.set_values(self.get_out(f, out), I)
+
+  def integrate_values(self, v):
+    """
+    Returns the vertical integral from the bed to each vertex of the column 
+    values <v>, of shape (n_columns, n_layers).
+    """
+    dz      = p.diff(self.get_z(), axis=1)
+    I       = p.zeros(v.shape)
+    I[:,1:] = p.cumsum(0.5 * (v[:,1:] + v[:,:-1]) * dz, axis=1)
+    return I
+
+  def depth_integral(self, f, out=None):
+    """
+    Integral of <f> over the thickness, extruded over the columns, into the
+    Function <out> if given.
+    """
+    v   = self.get_values(f)
+    dz  = p.diff(self.get_z(), axis=1)
+    I   = p.sum(0.5 * (v[:,1:] + v[:,:-1]) * dz, axis=1)
+    return self.set_values(self.get_out(f, out), 
+                           p.tile(I[:,None], (1, v.shape[1])))
+
+  def vertical_average(self, f, out=None):
+    """
+    Vertical average of <f>, extruded over the columns, into the Function 
+    <out> if given.
+    """
+    z   = self.get_z()
+    H   = z[:,-1] - z[:,0]
+    H[H <= 0] = 1.0
+    out = self.depth_integral(f, out)
+    return self.set_values(out, self.get_values(out) / H[:,None])
+
+  def depth_integrated_flux(self, u, v, H=None):
+    """
+    Depth-integrated flux (qx, qy) of the horizontal velocity (<u>, <v>), 
+    extruded over the columns.  If <H> is given, the velocity is assumed
+    to be depth-averaged (e.g. from the shallow shelf approximation), and 
+    the flux is <H> times the velocity.
+    """
+    if H is None:
+      return self.depth_integral(u), self.depth_integral(v)
+    qx  = self.get_values(u) * self.get_values(H)
+    qy  = self.get_values(v) * self.get_values(H)
+    return self.set_values(Function(u.function_space()), qx), \
+           self.set_values(Function(v.function_space()), qy)
+
+  def vertical_velocity(self, u, v, B, out=None):
+    """
+    Vertical velocity from incompressibility, integrating the horizontal 
+    divergence of (<u>, <v>) up from the basal kinematic condition
+    w = u B_x + v B_y on the bed <B>.  The divergence and basal condition
+    are projected onto the vertices with a lumped mass matrix.
+    """
+    V    = u.function_space()
+    phi  = TestFunction(V)
+    m    = assemble(phi*dx).get_local()
+    m[m == 0.0] = 1.0
+    div  = Function(V)
+    w_b  = Function(V)
+    div.vector().set_local(assemble((u.dx(0) + v.dx(1))*phi*dx)
+                           .get_local() / m)
+    w_b.vector().set_local(assemble((u*B.dx(0) + v*B.dx(1))*phi*dx)
+                           .get_local() / m)
+    w    = self.get_values(w_b)[:,[0]] - self.get_values(self.integrate(div))
+    return self.set_values(self.get_out(u, out), w)
+
+
+def get_barycentric_matrix(mesh, x):
+  """
+  Returns the sparse matrix of the interpolation of piecewise-linear 
+  functions from the vertices of <mesh> to the points <x>, holding the 
+  barycentric coordinates of each point in the cell that contains it.  
+  Points slightly outside the mesh, as happens along curved boundaries, 
+  take the values of the closest cell.
+
+  :param mesh : Dolfin mesh
+  :param x    : Array of shape (n, d) of the coordinates of the points
+  :rtype      : csr_matrix of shape (n, mesh.num_vertices())
+  """
+  tree   = mesh.bounding_box_tree()
+  x_s    = mesh.coordinates()
+  cells  = mesh.cells()
+  d      = x_s.shape[1]
+  n      = len(x)
+  c      = p.zeros(n, dtype=int)
+  for i, xi in enumerate(x):
+    c[i] = tree.compute_first_entity_collision(Point(*xi))
+    if c[i] >= mesh.num_cells():
+      c[i] = tree.compute_closest_entity(Point(*xi))[0]
+  
+  # barycentric coordinates in the cells, clipped outside of them :
+  X       = x_s[cells[c]]
+  T       = p.transpose(X[:,1:] - X[:,[0]], (0,2,1))
+  l       = p.zeros((n, d+1))
+  l[:,1:] = p.linalg.solve(T, (x - X[:,0])[:,:,None])[:,:,0]
+  l[:,0]  = 1 - l[:,1:].sum(axis=1)
+  l       = p.clip(l, 0, 1)
+  l      /= l.sum(axis=1)[:,None]
+  
+  rows    = p.repeat(p.arange(n), d+1)
+  return csr_matrix((l.ravel(), (rows, cells[c].ravel())), 
+                    shape=(n, len(x_s)))
+
+
+class MeshHierarchy(object):
+  """
+  Transfer of piecewise-linear Functions between meshes of the same domain,
+  such as the levels of a grid sequence.  The interpolation from one mesh
+  to another is assembled once as a sparse matrix of the barycentric 
+  weights of the target vertices in the cells of the source mesh, and 
+  cached for every later transfer.  Vertices slightly outside the source 
+  mesh, as happens along curved boundaries, take the values of the 
+  closest cell.
+  """
+  def __init__(self):
+    self.matrices = {}
+    self.dofs     = {}
+
+  def get_matrix(self, mesh_s, mesh_t):
+    """
+    Returns the interpolation matrix from the vertices of <mesh_s> to the
+    vertices of <mesh_t>.
+    """
+    k = (mesh_s.id(), mesh_t.id())
+    if k not in self.matrices:
+      self.matrices[k] = get_barycentric_matrix(mesh_s, mesh_t.coordinates())
+    return self.matrices[k]
+
+  def get_dofs(self, V, i=None):
+    """
+    Returns the cached vertex dofs of the CG1 FunctionSpace <V>, or of its
+    <i>th subspace.
+    """
+    k = (V.id(), i)
+    if k not in self.dofs:
+      self.dofs[k] = get_vertex_dofs(V if i is None else V.sub(i))
+    return self.dofs[k]
+
+  def transfer(self, f, g):
+    """
+    Interpolate the CG1 Function <f>, scalar or mixed, onto the Function
+    <g> of the same kind on another mesh, and return <g>.
+    """
+    V_f = f.function_space()
+    V_g = g.function_space()
+    M   = self.get_matrix(V_f.mesh(), V_g.mesh())
+    n   = V_f.num_sub_spaces()
+    a_f = f.vector().get_local()
+    a_g = g.vector().get_local()
+    for i in (range(n) if n > 0 else [None]):
+      a_g[self.get_dofs(V_g, i)] = M.dot(a_f[self.get_dofs(V_f, i)])
+    g.vector().set_local(a_g)
+    g.vector().apply('insert')
+    return g
+
+
 class IsotropicMeshRefiner(object):
   """
   In this class, the cells in the mesh are isotropically refined above a 
@@ -177,9 +520,11 @@ class IsotropicMeshRefiner(object):
     Hxy  = Function(V)
     Hyy  = Function(V)
   
-    solve(a_xx == L_xx, Hxx)
-    solve(a_xy == L_xy, Hxy)
-    solve(a_yy == L_yy, Hyy)
+    # the three mass matrices share a key, so are factorized once :
+    lsc  = LinearSolveCache()
+    lsc.solve(a_xx, L_xx, Hxx)
+    lsc.solve(a_xy, L_xy, Hxy)
+    lsc.solve(a_yy, L_yy, Hyy)
     e_list = []
     e_list_calc = []
     
@@ -364,9 +709,11 @@ class AnisotropicMeshRefiner(object):
     Mxy  = Function(V)
     Myy  = Function(V)
   
-    solve(a_xx == L_xx, Hxx)
-    solve(a_xy == L_xy, Hxy)
-    solve(a_yy == L_yy, Hyy)
+    # the three mass matrices share a key, so are factorized once :
+    lsc  = LinearSolveCache()
+    lsc.solve(a_xx, L_xx, Hxx)
+    lsc.solve(a_xy, L_xy, Hxy)
+    lsc.solve(a_yy, L_yy, Hyy)
     e_list = []
 
     for v in vertices(mesh):
@@ -556,6 +903,54 @@ def default_nonlin_solver_params():
   stokes_params['newton_solver']['report'] = True
   return stokes_params
 
+def taylor_test(J, dJ, m0, dm, n=5, eps=1e-2):
+  """
+  Verifies the gradient <dJ> of the functional <J> at <m0> by the Taylor 
+  remainders in the direction <dm>,
+
+    r_0(h) = |J(m0 + h dm) - J(m0)|              = O(h)
+    r_1(h) = |J(m0 + h dm) - J(m0) - h dJ . dm|  = O(h^2),
+
+  for h = eps, eps/2, ..., eps/2**(n-1).  The convergence rates of r_1 
+  approach 2 if the gradient is correct, and 1 otherwise.
+  
+  :param J   : Function of a numpy array returning a float
+  :param dJ  : Gradient array of J at m0
+  :param m0  : Array at which to test
+  :param dm  : Array of the perturbation direction
+  :param n   : Number of perturbations
+  :param eps : Size of the first perturbation
+  :rtype     : Dictionary holding the perturbations 'h', the remainders 
+               'r_0' and 'r_1' and their convergence rates 'rate_0' and 
+               'rate_1'
+  """
+  J0  = J(m0)
+  h   = eps * 0.5**p.arange(n)
+  r_0 = []
+  r_1 = []
+  for hh in h:
+    Jh = J(m0 + hh*dm)
+    r_0.append(abs(Jh - J0))
+    r_1.append(abs(Jh - J0 - hh*p.dot(dJ, dm)))
+  r_0 = p.array(r_0)
+  r_1 = p.array(r_1)
+  
+  rate_0 = p.log(r_0[:-1] / r_0[1:]) / p.log(2)
+  rate_1 = p.log(r_1[:-1] / r_1[1:]) / p.log(2)
+  
+  print "Taylor test :"
+  for i in range(n):
+    rates = ''
+    if i > 0:
+      rates = '%6.3f %6.3f' % (rate_0[i-1], rate_1[i-1])
+    print '  h = %.3e  r_0 = %.3e  r_1 = %.3e  %s' % (h[i], r_0[i], r_1[i],
+                                                      rates)
+  return {'h'      : h.tolist(), 
+          'r_0'    : r_0.tolist(), 
+          'r_1'    : r_1.tolist(),
+          'rate_0' : rate_0.tolist(), 
+          'rate_1' : rate_1.tolist()}
+
 def calculate_vertical_average(model,u):
   """
   Calculates the vertical average of a given function space and function.  
@@ -564,6 +959,9 @@ def calculate_vertical_average(model,u):
   :param u: Function representing the model's function space
   :rtype: Dolfin projection and Function of the vertical average
   """
+  if isinstance(u, Function) and model.columns.structured:
+    return model.columns.vertical_average(u, Function(model.Q))
+
   uhat = TrialFunction(model.Q)
   Hhat = TrialFunction(model.Q)
   phi  = TestFunction(model.Q)
@@ -677,6 +1075,115 @@ def extract_boundary_mesh(mesh,surface_facet,marker,variable_list = []):
 
   return surface_mesh,surface_variable_list
     
+def extract_surface_mesh(mesh, ff, marker=2):
+  """
+  Returns the planar mesh formed by the (x,y) coordinates of the facets of
+  <mesh> marked <marker> in the FacetFunction <ff>, along with the array of
+  the indices of the vertices of <mesh> under each of its vertices.
+
+  :param mesh: The 3D dolfin mesh
+  :param ff: FacetFunction of the boundary markers of <mesh>
+  :param int marker: Marker of the facets to extract (2 is the surface)
+  :rtype: Tuple of the 2D dolfin mesh and the vertex map array
+  """
+  D     = mesh.topology().dim()
+  mesh.init(D-1, 0)
+  fcts  = p.where(ff.array() == marker)[0]
+  tris  = p.array([Facet(mesh, int(i)).entities(0) for i in fcts])
+  v_map, cells = p.unique(tris.ravel(), return_inverse=True)
+  cells = cells.reshape(tris.shape).astype(p.uintp)
+  x     = mesh.coordinates()[v_map]
+
+  surface = Mesh()
+  editor  = MeshEditor()
+  editor.open(surface, 'triangle', D-1, D-1)
+  editor.init_vertices(len(v_map))
+  editor.init_cells(len(cells))
+  for i in range(len(v_map)):
+    editor.add_vertex(i, Point(x[i,0], x[i,1]))
+  for i in range(len(cells)):
+    editor.add_cell(i, cells[i])
+  editor.close()
+  return surface, v_map
+
+def get_vertex_dofs(V):
+  """
+  Returns the array of the degrees of freedom of the piecewise-linear scalar
+  function space <V>, indexed by the vertices of its mesh.
+
+  :param V: CG1 dolfin FunctionSpace, or scalar subspace of a CG1 vector
+            or mixed space
+  :rtype: Integer array of length mesh.num_vertices()
+  """
+  mesh  = V.mesh()
+  dm    = V.dofmap()
+  if len(V.component()) == 0:
+    return p.array(dm.vertex_to_dof_map(mesh), dtype=int)
+  
+  # dolfin does not tabulate the map of a subspace, so go through the cells :
+  dofs  = p.array([dm.cell_dofs(i) for i in range(mesh.num_cells())])
+  v2d   = p.zeros(mesh.num_vertices(), dtype=int)
+  v2d[mesh.cells().ravel()] = dofs.ravel()
+  return v2d
+
+def set_quadrature_degree(measure, degree):
+  """
+  Returns the integration <measure> with the quadrature degree <degree>, or
+  <measure> itself if <degree> is None, in which case the form compiler 
+  estimates the degree from the integrand.
+
+  :param measure : UFL measure, such as dx or ds(3)
+  :param degree  : Quadrature degree, or None
+  """
+  if degree is None:
+    return measure
+  return measure(metadata={'quadrature_degree' : degree})
+
+def quadrature_report(forms, repeat=3):
+  """
+  Print, for each integral of the named <forms>, the polynomial degree of 
+  the integrand estimated by UFL, the quadrature degree used and the mean
+  time of its assembly, so that the quadrature degrees of the physics 
+  classes (config[...]['quadrature_degree']) may be chosen.
+
+  :param forms  : List of (name, UFL form) tuples
+  :param repeat : Number of timed assemblies of each integral
+  :rtype        : List of dictionaries, one for each integral
+  """
+  from ufl import Form as UFLForm
+  from ufl.algorithms import estimate_total_polynomial_degree
+  q_global = parameters['form_compiler']['quadrature_degree']
+  
+  print '%-24s %-14s %9s %6s %10s' % ('form', 'integral', 'estimated', 
+                                      'used', 'time [s]')
+  report = []
+  for name, f in forms:
+    for itg in f.integrals():
+      if hasattr(itg, 'integral_type'):
+        kind = '%s(%s)' % (itg.integral_type(), itg.subdomain_id())
+        data = itg.metadata()
+      else:
+        kind = '%s(%s)' % (itg.measure().domain_type(), 
+                           itg.measure().domain_id())
+        data = itg.measure().metadata() or {}
+      est    = estimate_total_polynomial_degree(itg.integrand())
+      q      = data.get('quadrature_degree')
+      if q is None:
+        q = q_global if q_global is not None and q_global >= 0 else est
+      
+      # the first assembly compiles the kernel :
+      f_i = UFLForm([itg])
+      assemble(f_i)
+      t0  = time.time()
+      for i in range(repeat):
+        assemble(f_i)
+      t   = (time.time() - t0) / repeat
+      
+      print '%-24s %-14s %9i %6i %10.4f' % (name, kind, est, q, t)
+      report.append({'form' : name, 'integral' : kind, 'estimated' : est,
+                     'degree' : q, 'time' : t})
+  return report
+
 def generate_expression_from_gridded_data(x,y,var,kx=1,ky=1):
   """
   This function creates a dolfin 2D expression from data input
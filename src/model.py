@@ -1,4 +1,6 @@
 from dolfin import *
+from helper import Columns
+from physical_constants import PhysicalConstant
 
 class Model(object):
   """ 
@@ -43,28 +45,33 @@ class Model(object):
     self.mesh      = UnitCubeMesh(nx,ny,nz)
     self.flat_mesh = UnitCubeMesh(nx,ny,nz)
     
-    # generate periodic boundary conditions if required :
+    # generate periodic boundary conditions if required.  The sub domain is
+    # compiled, as inside() and map() are called for every vertex when the 
+    # constrained spaces are built :
     if generate_pbcs:
-      class PeriodicBoundary(SubDomain):
-    # Left boundary is "target domain" G
-        def inside(self, x, on_boundary):
-        # return True if on left or bottom boundary AND NOT on one of the two corners (0, 1) and (1, 0)
-          return bool((near(x[0], 0) or near(x[1], 0)) and (not ((near(x[0], 0) and near(x[1], 1)) or (near(x[0], 1) and near(x[1], 0)))) and on_boundary)
-
-        def map(self, x, y):
-          if near(x[0], 1) and near(x[1], 1):
-            y[0] = x[0] - 1.
-            y[1] = x[1] - 1.
-            y[2] = x[2]
-          elif near(x[0], 1):
-            y[0] = x[0] - 1.
-            y[1] = x[1]
-            y[2] = x[2]
-          else:   # near(x[1], 1)
-            y[0] = x[0]
-            y[1] = x[1] - 1.
-            y[2] = x[2]
-      pBC       = PeriodicBoundary()
+      code = """
+      class PeriodicBoundary : public SubDomain
+      {
+      public:
+        
+        // left or bottom boundary, without the corners (0, 1) and (1, 0) :
+        bool inside(const Array<double>& x, bool on_boundary) const
+        {
+          return (near(x[0], 0) || near(x[1], 0)) &&
+                 !((near(x[0], 0) && near(x[1], 1)) || 
+                   (near(x[0], 1) && near(x[1], 0))) && on_boundary;
+        }
+        
+        // right and top boundaries mapped onto the left and bottom :
+        void map(const Array<double>& x, Array<double>& y) const
+        {
+          y[0] = near(x[0], 1) ? x[0] - 1.0 : x[0];
+          y[1] = near(x[1], 1) ? x[1] - 1.0 : x[1];
+          y[2] = x[2];
+        }
+      };
+      """
+      pBC       = compile_extension_module(code).PeriodicBoundary()
       self.Q         = FunctionSpace(self.mesh, "CG", 1, 
                                      constrained_domain = pBC)
       self.Q_non_periodic = FunctionSpace(self.mesh, "CG", 1)
@@ -180,6 +187,18 @@ class Model(object):
    
     self.ds = Measure('ds')[self.ff]
      
+  @property
+  def columns(self):
+    """
+    The :class:`~src.helper.Columns` of the mesh, for the vertical 
+    operators, built on the first use so that models on unstructured 
+    meshes which never ask for them do not index the mesh.
+    """
+    if getattr(self, '_columns', None) is None \
+       or self._columns.mesh is not self.mesh:
+      self._columns = Columns(self.mesh)
+    return self._columns
+
   def set_parameters(self, params):
     """
     Sets the model's dictionary of parameters
@@ -188,6 +207,41 @@ class Model(object):
        containing model-relavent parameters
     """
     self.params = params
+
+  def get_constant(self, name):
+    """
+    Returns the dolfin Constant holding the scalar parameter <name>, 
+    updated to the current value of the attribute, so that parameters 
+    assigned directly (e.g. model.eps_reg = 1e-5) are picked up when a 
+    physics class is set up.  Forms built on the Constant do not depend on
+    its value, so that sweeps over the parameter reuse the compiled 
+    kernels.  Parameters that have been replaced by Functions, such as 
+    q_geo, are returned as they are.
+
+    :param name : Name of a parameter of :attr:`params`
+    """
+    value = getattr(self, name)
+    if not isinstance(value, (int, float)):
+      return value
+    if name not in self.constants:
+      self.constants[name] = Constant(value)
+    else:
+      self.constants[name].assign(float(value))
+    return self.constants[name]
+
+  def set_parameter(self, name, value):
+    """
+    Set the scalar parameter <name> to <value>, in place in the forms of 
+    the physics classes already set up.
+    
+    :param name  : Name of a parameter of :attr:`params`
+    :param value : New value of the parameter
+    """
+    old = getattr(self, name)
+    setattr(self, name, PhysicalConstant(value, 
+                                         getattr(old, 'description', None),
+                                         getattr(old, 'units',       None)))
+    self.get_constant(name)
     
   def initialize_variables(self):
     """
@@ -195,6 +249,7 @@ class Model(object):
     by the individually created model.
     """
     self.params.globalize_parameters(self) # make all the variables available 
+    self.constants = {}                    # runtime Constants of these
     self.calculate_boundaries()            # calculate the boundaries
 
     # Function Space
@@ -216,6 +271,7 @@ class Model(object):
       self.B           = interpolate(self.B_ex, self.Q_non_periodic)
       self.Shat          = Function(self.Q_flat_non_periodic)
       self.dSdt          = Function(self.Q_flat)
+
     # Coordinates of various types 
     self.x             = self.Q.cell().x
     self.sigma         = project((self.x[2] - self.B) / (self.S - self.B))
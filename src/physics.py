@@ -28,8 +28,446 @@ based on lapse rates
 
 from pylab  import ndarray
 from dolfin import *
+from collections import OrderedDict
+from scipy.sparse import csr_matrix
+from scipy.interpolate import LinearNDInterpolator
 import numpy
 import numpy.linalg as linalg
+from helper import extract_surface_mesh, get_vertex_dofs, \
+                   get_barycentric_matrix, LinearSolveCache, MeshHierarchy, \
+                   set_quadrature_degree
+
+
+class NewtonProblem(NonlinearProblem):
+  """
+  Nonlinear problem solved by its own dolfin NewtonSolver, with a 
+  persistent PETSc LU or Krylov solver, that keeps a reference to the last
+  assembled Jacobian, so that it and its factorization may be reused after
+  the solve (e.g. as the operator of the adjoint system).  The parameters
+  are read at each solve, so that changes to them between solves, or new 
+  parameters passed to :meth:`solve`, take effect.
+
+  The Newton solver assembles the Jacobian at the iterate before its last 
+  update, and not at all if it converges at the first iteration, so its 
+  factorization never belongs to the solution.  The state each Jacobian 
+  was assembled at is recorded, and :meth:`update_jacobian` reassembles 
+  it at the solution if they differ.  If :attr:`final_jacobian` is set, as
+  :class:`AdjointVelocityBP` does, :meth:`finalize` assembles and 
+  factorizes the Jacobian at the solution once the forward solve is done.
+  Every transposed solve at that state, the adjoint solve of a gradient 
+  and the tangent linear and second adjoint solves of the Hessian actions,
+  is then a back-substitution.  The price is one assembly and 
+  factorization per forward solve, paid even if no adjoint follows.
+
+  :param F             : Form of the residual
+  :param J             : Form of the Jacobian of <F>
+  :param newton_params : Parameters of NonlinearVariationalSolver, of which
+                         the 'linear_solver', 'preconditioner' and 
+                         'newton_solver' entries are used
+  :param bcs           : (Optional) list of Dirichlet boundary conditions
+  """
+  def __init__(self, F, J, newton_params, bcs=None):
+    NonlinearProblem.__init__(self)
+    self.F_form = F
+    self.J_form = J
+    self.bcs    = bcs or []
+    self.A      = None               # last assembled Jacobian
+    self.x      = None               # solution vector of the last solve
+    self.x_A    = None               # state at which A was assembled
+    self.factor = True               # whether A needs to be factorized
+    
+    self.newton_params  = newton_params
+    self.solver_type    = None
+    self.final_jacobian = False
+    self.set_parameters()
+
+  def set_parameters(self, newton_params=None):
+    """
+    Set the parameters of the Newton solver from <newton_params>, or from 
+    those last given, creating the linear solver if its type has changed.
+    """
+    if newton_params is not None:
+      self.newton_params = newton_params
+    newton_params = self.newton_params
+    
+    lin_solver  = newton_params['linear_solver']
+    precond     = newton_params['preconditioner']
+    if (lin_solver, precond) != self.solver_type:
+      self.solver_type = (lin_solver, precond)
+      self.factor      = True
+      if lin_solver in ['default', 'lu', 'mumps', 'petsc', 'umfpack', 
+                        'superlu', 'superlu_dist']:
+        if lin_solver == 'lu':
+          lin_solver = 'default'
+        self.linear_solver = PETScLUSolver(lin_solver)
+      else:
+        self.linear_solver = PETScKrylovSolver(lin_solver, precond)
+      self.newton_solver = NewtonSolver(self.linear_solver, 
+                                        PETScFactory.instance())
+    
+    nparams = newton_params['newton_solver']
+    for k in ['maximum_iterations', 'relative_tolerance', 
+              'absolute_tolerance', 'relaxation_parameter', 
+              'convergence_criterion', 'report', 'error_on_nonconvergence']:
+      self.newton_solver.parameters[k] = nparams[k]
+
+  def F(self, b, x):
+    assemble(self.F_form, tensor=b)
+    for bc in self.bcs:
+      bc.apply(b, x)
+
+  def J(self, A, x):
+    assemble(self.J_form, tensor=A)
+    for bc in self.bcs:
+      bc.apply(A)
+    self.A      = A
+    self.x_A    = x.copy()
+    self.factor = True
+
+  def solve(self, x, newton_params=None):
+    """
+    Newton solve into the vector <x>, holding the initial guess.  The 
+    Jacobian of a previous solve is forgotten, as the coefficients of the 
+    forms may have changed since.
+
+    :param x             : Solution vector
+    :param newton_params : (Optional) parameters replacing those last given
+    :rtype               : tuple of the number of iterations and whether 
+                           it converged
+    """
+    self.set_parameters(newton_params)
+    self.x   = x
+    self.x_A = None
+    return self.newton_solver.solve(self, x)
+
+  def finalize(self):
+    """
+    Assemble and factorize the Jacobian at the solution of the last solve
+    if :attr:`final_jacobian` is set, for the transposed solves of an 
+    adjoint.  Called once after the forward solve, and not after the 
+    intermediate solves of a continuation.
+    """
+    if self.final_jacobian and self.x is not None:
+      self.update_jacobian()
+      if self.factor:
+        self.factorize()
+
+  def update_jacobian(self):
+    """
+    Make :attr:`A` the Jacobian at the current value of the solution 
+    vector of the last solve, which may also have been set to another 
+    state since, reassembling it if it was assembled at another state.
+
+    :rtype : bool, True if :attr:`A` was reassembled
+    """
+    x = self.x
+    if self.x_A is not None:
+      dx = x.copy()
+      dx.axpy(-1.0, self.x_A)
+      if dx.norm('linf') == 0.0:
+        return False
+    if self.A is None:
+      self.A = PETScMatrix()
+    self.J(self.A, x)
+    return True
+
+  def factorize(self):
+    """
+    Factorize :attr:`A` in the linear solver, or set up its 
+    preconditioner, for :meth:`solve_transpose`.  Without petsc4py this is
+    left to the first transposed solve.
+    """
+    try:
+      ksp = self.linear_solver.ksp()
+      A   = as_backend_type(self.A).mat()
+      ksp.setOperators(A, A)
+      ksp.setUp()
+      self.factor = False
+    except (AttributeError, TypeError):
+      pass
+
+  def solve_transpose(self, x, b):
+    """
+    Solves the transposed system of the Jacobian :attr:`A`, factorizing it 
+    only if it has not been since it was assembled.  Call 
+    :meth:`update_jacobian` first, to make sure :attr:`A` belongs to the 
+    current state.
+
+    :param x : Vector to hold the solution
+    :param b : Right-hand side vector
+    """
+    if self.factor:
+      self.factorize()
+    try:
+      ksp = self.linear_solver.ksp()
+      ksp.solveTranspose(as_backend_type(b).vec(), as_backend_type(x).vec())
+    
+    # without petsc4py, rely on the symmetry of the Jacobian :
+    except (AttributeError, TypeError):
+      reuse       = not self.factor
+      self.factor = False
+      self.linear_solver.set_operator(self.A)
+      if isinstance(self.linear_solver, PETScLUSolver):
+        self.linear_solver.parameters['reuse_factorization'] = reuse
+        self.linear_solver.solve(x, b)
+        self.linear_solver.parameters['reuse_factorization'] = False
+      else:
+        self.linear_solver.parameters['preconditioner']['reuse'] = reuse
+        self.linear_solver.solve(x, b)
+        self.linear_solver.parameters['preconditioner']['reuse'] = False
+
+
+class ViscosityContinuation(object):
+  r"""
+  Continuation of the nonlinear viscosity for the Newton solves of 
+  :class:`VelocityStokes` and :class:`VelocityBP`.  The strain rate 
+  regularization and the flow law exponent enter the variational 
+  principle as the Constants :attr:`eps_reg` and :attr:`n`, and the 
+  hardness is scaled by :attr:`b_scale`, so that a cold solve may start 
+  from a softer, nearly linear problem and walk to the target without 
+  recompiling any form.  The parameters are given by the optional 
+  dictionary config['velocity']['continuation'] :
+
+  +------------+--------------------------------------------+---------+
+  |Key         |Description                                 |Default  |
+  +============+============================================+=========+
+  |eps_reg     |Initial strain rate regularization          |target   |
+  +------------+--------------------------------------------+---------+
+  |n           |Initial flow law exponent                   |target   |
+  +------------+--------------------------------------------+---------+
+  |eps_ref     |Squared strain rate at which the viscosity  |eps_reg  |
+  |            |is kept fixed as n is varied                |         |
+  +------------+--------------------------------------------+---------+
+  |steps       |Initial number of steps to the target       |4        |
+  +------------+--------------------------------------------+---------+
+  |iterations  |Newton iterations per step aimed at         |4        |
+  +------------+--------------------------------------------+---------+
+  |rtol        |Relative tolerance of the intermediate steps|1e-3     |
+  +------------+--------------------------------------------+---------+
+  |min_step    |Smallest step before giving up              |1e-3     |
+  +------------+--------------------------------------------+---------+
+  |always      |Also continue from a previous solution      |False    |
+  +------------+--------------------------------------------+---------+
+
+  The regularization is varied geometrically and the exponent linearly in
+  the step parameter :math:`t \in [0,1]`.  Each converged step is the 
+  initial guess of the next; the step is doubled if Newton took fewer 
+  than 'iterations' iterations, halved if it took more than twice as many,
+  and a failed step is retried from the last converged state with half the
+  step.  Once the step falls below 'min_step', on either branch, the 
+  continuation stops and the target is solved from the last converged 
+  state.  Only the final step is solved to the tolerance of the Newton 
+  parameters.  By default the continuation only runs from a cold start, 
+  i.e. a zero velocity; the iteration counts of the last solve are held by
+  :attr:`history`.
+
+  The targets may be the runtime Constants of the model (see 
+  :meth:`~src.model.Model.get_constant`), and are read at each solve.
+
+  :param config  : Dictionary object containing information on physical 
+                   attributes such as velocties, age, and surface climate
+  :param eps_reg : Target strain rate regularization
+  :param n       : Target flow law exponent
+  """
+  def __init__(self, config, eps_reg, n):
+    self.params   = config['velocity'].get('continuation', None)
+    self.targets  = (eps_reg, n)
+    self.target   = (float(eps_reg), float(n))
+    self.eps_reg  = Constant(float(eps_reg))
+    self.n        = Constant(float(n))
+    self.b_scale  = Constant(1.0)
+    self.history  = []
+
+  def set_parameter(self, t):
+    """
+    Set the regularization, exponent and hardness scale at the step 
+    parameter <t>, with <t> = 1 the target.
+    """
+    eps_t, n_t = self.target
+    if self.params is None or t >= 1.0:
+      eps, n = eps_t, n_t
+    else:
+      eps_0 = self.params.get('eps_reg', eps_t)
+      n_0   = self.params.get('n',       n_t)
+      eps   = eps_0**(1 - t) * eps_t**t
+      n     = n_0 + t * (n_t - n_0)
+    
+    self.eps_reg.assign(eps)
+    self.n.assign(n)
+    
+    # viscosity at eps_ref independent of n :
+    if n != n_t:
+      eps_ref = self.params.get('eps_ref', self.params.get('eps_reg', eps_t))
+      self.b_scale.assign(eps_ref**((1-n_t)/(2*n_t) - (1-n)/(2*n)))
+    else:
+      self.b_scale.assign(1.0)
+
+  def solve(self, newton_solve, newton_params, U):
+    """
+    Continue the Newton solve <newton_solve>, a function returning the 
+    number of iterations and whether it converged, to the target.  
+    
+    :param newton_solve  : Function performing one Newton solve into <U>
+    :param newton_params : Parameters of the Newton solver, whose 
+                           'relative_tolerance' and 
+                           'error_on_nonconvergence' are relaxed for the 
+                           intermediate steps
+    :param U             : Function holding the solution
+    :rtype               : tuple of the total number of iterations and 
+                           whether the final solve converged
+    """
+    params       = self.params
+    self.history = []
+    self.target  = tuple(float(x) for x in self.targets)
+    cold         = U.vector().norm('l2') == 0.0
+    
+    if params is not None and (cold or params.get('always', False)):
+      rtol       = newton_params['relative_tolerance']
+      error      = newton_params['error_on_nonconvergence']
+      newton_params['relative_tolerance']      = params.get('rtol', 1e-3)
+      newton_params['error_on_nonconvergence'] = False
+      
+      target     = params.get('iterations', 4)
+      min_step   = params.get('min_step', 1e-3)
+      dt         = 1.0 / params.get('steps', 4)
+      U_0        = U.vector().copy()
+      t          = None
+      s          = 0.0
+      try:
+        while s < 1.0:
+          self.set_parameter(s)
+          its, converged = newton_solve()
+          self.history.append((float(self.eps_reg), float(self.n), 
+                               its, converged))
+          
+          if converged:
+            t = s
+            U_0.set_local(U.vector().array())
+            U_0.apply('insert')
+            if   its < target:
+              dt *= 2.0
+            elif its > 2*target:
+              dt *= 0.5
+          
+          # retry from the last converged state :
+          else:
+            U.vector().set_local(U_0.array())
+            U.vector().apply('insert')
+            dt *= 0.5
+          
+          # give up on the continuation, solving the target from the last
+          # converged state :
+          if t is None or dt < min_step:
+            break
+          s = min(t + dt, 1.0)
+      
+      finally:
+        newton_params['relative_tolerance']      = rtol
+        newton_params['error_on_nonconvergence'] = error
+
+    self.set_parameter(1.0)
+    its, converged = newton_solve()
+    self.history.append((self.target[0], self.target[1], its, converged))
+    return sum([h[2] for h in self.history]), converged
+
+
+class RateFactor(object):
+  r"""
+  Temperature dependent rate factor of the 'full' viscosity mode of 
+  :class:`VelocityStokes` and :class:`VelocityBP`,
+
+  :Equation:
+     .. math::
+      b(T,W,E) = \left[E a(T^*) \left(1 + 181.25 W\right) 
+      e^{-\frac{Q(T^*)}{RT^*}}\right]^{\frac{-1}{n}},
+
+  held as the Function :attr:`b`, a coefficient of the variational 
+  principle.  The temperature does not change during a velocity solve, so
+  the conditionals and the exponential are evaluated by a lumped 
+  projection in :meth:`update`, once before each solve and only if T, W, 
+  E, S, the mesh or the parameters have changed since the last one.  
+
+  By default :attr:`b` is piecewise linear; if 
+  config['velocity']['rate_factor'] is 'DG0', it holds the cell averages 
+  instead.  It is never model.b, so that the strain heating of 
+  :class:`Enthalpy` does not depend on the option.  The quadrature degree 
+  of the projection is given by the 'rate_factor' entry of 
+  config['velocity']['quadrature_degree'], 2 by default.
+
+  :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config : Dictionary object containing information on physical 
+                  attributes such as velocties, age, and surface climate
+  """
+  def __init__(self, model, config):
+    self.model  = model
+    
+    mesh        = model.mesh
+    T           = model.T
+    W           = model.W
+    E           = model.E
+    S           = model.S
+    x           = model.x
+    n           = model.get_constant('n')
+    gamma       = model.get_constant('gamma')
+    R           = model.get_constant('R')
+    
+    # the parameters as the forms see them :
+    self.constants = [n, gamma, R]
+
+    # pressure corrected temperature and rate factor :
+    Tstar = T + gamma * (S - x[2])
+    a_T   = conditional( lt(Tstar, 263.15), 1.1384496e-5, 5.45e10)
+    Q_T   = conditional( lt(Tstar, 263.15), 6e4,13.9e4)
+    self.expression = ( E * (a_T * (1 + 181.25*W)) \
+                        * exp( -Q_T / (R * Tstar)) )**(-1/n)
+
+    if config['velocity'].get('rate_factor', 'CG1') == 'DG0':
+      self.b = Function(FunctionSpace(mesh, 'DG', 0))
+    else:
+      self.b = Function(model.Q)
+    
+    q_deg  = config['velocity'].get('quadrature_degree', {})
+    dx_b   = set_quadrature_degree(dx, q_deg.get('rate_factor', 2))
+    phi    = TestFunction(self.b.function_space())
+    self.L = Form(self.expression * phi * dx_b)
+    self.M = Form(phi * dx)
+    
+    self.state = None
+
+  def get_state(self):
+    """
+    Returns the array of the values the rate factor depends on.
+    """
+    model = self.model
+    state = [f.vector().array() for f in [model.T, model.W, model.E, 
+                                          model.S]]
+    state.append(model.mesh.coordinates()[:,2])
+    state.append(numpy.array([float(c) for c in self.constants]))
+    return numpy.hstack(state)
+
+  def update(self):
+    """
+    Evaluates :attr:`b` if its dependencies have changed since the last 
+    call.
+
+    :rtype : bool, True if :attr:`b` was evaluated
+    """
+    state = self.get_state()
+    if self.state is not None and numpy.array_equal(state, self.state):
+      return False
+    self.state = state
+    
+    b = assemble(self.L).array() / assemble(self.M).array()
+    self.b.vector().set_local(b)
+    self.b.vector().apply('insert')
+    return True
+
+  def replace(self, form):
+    """
+    Returns <form> with :attr:`b` replaced by the expression of the rate 
+    factor, for differentiation with respect to T, W and E.
+    """
+    return replace(form, {self.b : self.expression})
 
 
 class VelocityStokes(object):
@@ -41,6 +479,13 @@ class VelocityStokes(object):
   :param config : Dictionary object containing information on physical 
 	                attributes such as velocties, age, and surface climate
 
+  The quadrature degrees of the 'viscous' integral, of the 'potential' 
+  integral of the other volume terms and of the 'sliding' integral of the
+  bed terms may be given by config['velocity']['quadrature_degree'] (see 
+  :func:`~src.helper.quadrature_report`).  In the 'full' viscosity mode 
+  the rate factor is the Function of :class:`RateFactor`, evaluated before
+  each solve.
+
   **Equations**
  
   +-------------------+---------------+---------------------------------------+
@@ -141,26 +586,26 @@ class VelocityStokes(object):
     self.config   = config
 
     mesh          = model.mesh
-    r             = config['velocity']['r']
+    r             = Constant(config['velocity']['r'])
     Q             = model.Q
     Q4            = model.Q4
-    n             = model.n
+    n             = model.get_constant('n')
     b             = model.b
     Tstar         = model.Tstar
     T             = model.T
-    gamma         = model.gamma
+    gamma         = model.get_constant('gamma')
     S             = model.S
     B             = model.B
     x             = model.x
     E             = model.E
     W             = model.W
-    R             = model.R
+    R             = model.get_constant('R')
     epsdot        = model.epsdot
-    eps_reg       = model.eps_reg
+    eps_reg       = model.get_constant('eps_reg')
     eta           = model.eta
-    rho           = model.rho
-    rho_w         = model.rho_w
-    g             = model.g
+    rho           = model.get_constant('rho')
+    rho_w         = model.get_constant('rho_w')
+    g             = model.get_constant('g')
     Vd            = model.Vd
     Pe            = model.Pe
     Sl            = model.Sl
@@ -200,7 +645,7 @@ class VelocityStokes(object):
         self.g     = g
       def eval(self, values, x):
         values[0] = -self.rho_w * self.g * min(0, x[2])
-    pres_b = pressure_boundary(rho_w, g)
+    pres_b = pressure_boundary(float(rho_w), float(g))
     fnorm  = FacetNormal(mesh)
     
     # Check if there are non-linear solver parameters defined.  If not, set 
@@ -231,8 +676,10 @@ class VelocityStokes(object):
 
     # Set the value of b, the temperature dependent ice hardness parameter,
 		# using the most recently calculated temperature field, if expected.
+    self.rate_factor = None
     if   config['velocity']['viscosity_mode'] == 'isothermal':
-      b = A0**(-1/n)
+      self.A0 = Constant(A0)
+      b       = self.A0**(-1/n)
     
     elif config['velocity']['viscosity_mode'] == 'linear':
       b = config['velocity']['b_linear']
@@ -240,14 +687,17 @@ class VelocityStokes(object):
       n = 1.0
     
     else:
-      # Define pressure corrected temperature
-      Tstar = T + gamma * (S - x[2])
-       
-      # Define ice hardness parameteri
-      a_T = conditional( lt(Tstar, 263.15), 1.1384496e-5, 5.45e10 )
-      Q_T = conditional( lt(Tstar, 263.15), 6e4,13.9e4 )
-      b   = ( E * (a_T * (1 + 181.25*W)) * exp( -Q_T / (R * Tstar) ) )**(-1/n)
-    
+      # rate factor, evaluated before each solve :
+      self.rate_factor = RateFactor(model, config)
+      b                = self.rate_factor.b
+
+    # the regularization and exponent are Constants, so that the Newton 
+    # solve may be continued from a softer problem :
+    self.continuation = ViscosityContinuation(config, eps_reg, n)
+    eps_reg           = self.continuation.eps_reg
+    n                 = self.continuation.n
+    b                 = self.continuation.b_scale * b
+
     # Second invariant of the strain rate tensor squared
     term   = + 0.5*(   (u.dx(1) + v.dx(0))**2  \
                      + (u.dx(2) + w.dx(0))**2  \
@@ -273,14 +723,22 @@ class VelocityStokes(object):
     # 6) pressure constraint :
     Pb     = -P * fnorm 
 
-    g      = Constant((0.0, 0.0, g))
+    g      = as_vector([0.0, 0.0, g])
     h      = CellSize(mesh)
     tau    = h**2 / (12 * b * rho**2)
     Lsq    = -tau * dot( (grad(P) + rho*g), (grad(P) + rho*g) )
     
+    # quadrature degrees of the integrals, estimated by the form compiler 
+    # if not given :
+    q_deg  = config['velocity'].get('quadrature_degree', {})
+    dx_v   = set_quadrature_degree(dx,    q_deg.get('viscous'))
+    dx_p   = set_quadrature_degree(dx,    q_deg.get('potential'))
+    dGrnd  = set_quadrature_degree(dGrnd, q_deg.get('sliding'))
+
     # Variational principle
-    A      = (Vd + Pe + Pc + Lsq)*dx + Sl*dGrnd + Nc*dGrnd# + Pb*dFloat
+    A      = Vd*dx_v + (Pe + Pc + Lsq)*dx_p + Sl*dGrnd + Nc*dGrnd# + Pb*dFloat
 
+    self.A       = A
     model.A      = A
     model.epsdot = epsdot
     model.Vd     = Vd
@@ -336,9 +794,16 @@ class VelocityStokes(object):
       self.bcs.append(DirichletBC(Q4.sub(1), model.v, model.ff, 4))
       self.bcs.append(DirichletBC(Q4.sub(2), model.w, model.ff, 4))
        
-    # Solve the nonlinear equations via Newton's method
-    solve(self.F == 0, model.U, bcs=self.bcs, J = self.J, 
-          solver_parameters = self.newton_params)
+    if self.rate_factor is not None:
+      self.rate_factor.update()
+       
+    # Solve the nonlinear equations via Newton's method, continued from a 
+    # softer problem if asked :
+    problem = NonlinearVariationalProblem(self.F, model.U, self.bcs, self.J)
+    solver  = NonlinearVariationalSolver(problem)
+    solver.parameters.update(self.newton_params)
+    self.continuation.solve(solver.solve, 
+                            solver.parameters['newton_solver'], model.U)
 
     # Project velocity field from physics-level vector variable, 
     # to scalar model variables
@@ -365,6 +830,12 @@ class VelocityBP(object):
   This class uses a simplification of the full Stokes' functional by expressing
   vertical velocities in terms of horizontal ones through incompressibility
   and bed impenetrability constraints.
+
+  The quadrature degrees of the 'viscous', 'potential' and 'sliding' 
+  integrals may be given by config['velocity']['quadrature_degree'] (see 
+  :func:`~src.helper.quadrature_report`).  In the 'full' viscosity mode 
+  the rate factor is the Function of :class:`RateFactor`, evaluated before
+  each solve.
   	
   **Equations**
 	
@@ -479,26 +950,26 @@ class VelocityBP(object):
     self.config   = config
 
     mesh          = model.mesh
-    r             = config['velocity']['r']
+    r             = Constant(config['velocity']['r'])
     Q             = model.Q
     Q2            = model.Q2
-    n             = model.n
+    n             = model.get_constant('n')
     b             = model.b
     Tstar         = model.Tstar
     T             = model.T
-    gamma         = model.gamma
+    gamma         = model.get_constant('gamma')
     S             = model.S
     B             = model.B
     x             = model.x
     E             = model.E
     W             = model.W
-    R             = model.R
+    R             = model.get_constant('R')
     epsdot        = model.epsdot
-    eps_reg       = model.eps_reg
+    eps_reg       = model.get_constant('eps_reg')
     eta           = model.eta
-    rho           = model.rho
-    rho_w         = model.rho_w
-    g             = model.g
+    rho           = model.get_constant('rho')
+    rho_w         = model.get_constant('rho_w')
+    g             = model.get_constant('g')
     Vd            = model.Vd
     Pe            = model.Pe
     Sl            = model.Sl
@@ -512,7 +983,7 @@ class VelocityBP(object):
         self.g     = g
       def eval(self, values, x):
         values[0] = -self.rho_w * self.g * min(0, x[2])
-    pres_b = pressure_boundary(rho_w, g)
+    pres_b = pressure_boundary(float(rho_w), float(g))
     fnorm  = FacetNormal(mesh)
     
     newton_params = config['velocity']['newton_params']
@@ -580,8 +1051,10 @@ class VelocityBP(object):
 
     # Set the value of b, the temperature dependent ice hardness parameter,
     # using the most recently calculated temperature field, if expected.
+    self.rate_factor = None
     if   config['velocity']['viscosity_mode'] == 'isothermal':
-      b = A0**(-1/n)
+      self.A0 = Constant(A0)
+      b       = self.A0**(-1/n)
     
     elif config['velocity']['viscosity_mode'] == 'linear':
       b = config['velocity']['b_linear']
@@ -592,18 +1065,21 @@ class VelocityBP(object):
       n = 1.0
     
     elif config['velocity']['viscosity_mode'] == 'full':
-      # Define pressure corrected temperature
-      Tstar = T + gamma * (S - x[2])
-       
-      # Define ice hardness parameterization :
-      a_T   = conditional( lt(Tstar, 263.15), 1.1384496e-5, 5.45e10)
-      Q_T   = conditional( lt(Tstar, 263.15), 6e4,13.9e4)
-      b     = ( E * (a_T * (1 + 181.25*W)) * exp( -Q_T / (R * Tstar)) )**(-1/n)
+      # rate factor, evaluated before each solve :
+      self.rate_factor = RateFactor(model, config)
+      b                = self.rate_factor.b
     
     else:
       print "Acceptable choices for 'viscosity_mode' are 'linear', " + \
             "'isothermal', or 'full'."
 
+    # the regularization and exponent are Constants, so that the Newton 
+    # solve may be continued from a softer problem :
+    self.continuation = ViscosityContinuation(config, eps_reg, n)
+    eps_reg           = self.continuation.eps_reg
+    n                 = self.continuation.n
+    b                 = self.continuation.b_scale * b
+
     # second invariant of the strain rate tensor squared :
     term     = + 0.5 * (u.dx(2)**2 + v.dx(2)**2 + (u.dx(1) + v.dx(0))**2) \
                +        u.dx(0)**2 + v.dx(1)**2 + (u.dx(0) + v.dx(1))**2
@@ -622,8 +1098,15 @@ class VelocityBP(object):
     # 4) pressure boundary
     Pb       = -pres_b * fnorm
 
+    # quadrature degrees of the integrals, estimated by the form compiler 
+    # if not given :
+    q_deg    = config['velocity'].get('quadrature_degree', {})
+    dx_v     = set_quadrature_degree(dx,    q_deg.get('viscous'))
+    dx_p     = set_quadrature_degree(dx,    q_deg.get('potential'))
+    dGrnd_s  = set_quadrature_degree(dGrnd, q_deg.get('sliding'))
+
     # Variational principle
-    A        = (Vd + Pe)*dx + Sl*dGrnd #+ Pb*dFloat
+    A        = Vd*dx_v + Pe*dx_p + Sl*dGrnd_s #+ Pb*dFloat
 
     # Calculate the first variation (the action) of the variational 
     # principle in the direction of the test function
@@ -632,6 +1115,11 @@ class VelocityBP(object):
     # Calculate the first variation of the action (the Jacobian) in
     # the direction of a small perturbation in U
     self.J   = derivative(self.F, U, dU)
+
+    # Newton solver which holds on to its Jacobian and linear solver, so 
+    # that the adjoint may reuse the factorization of the Jacobian at the 
+    # solution :
+    self.problem = NewtonProblem(self.F, self.J, self.newton_params)
  
     self.w_R = (u.dx(0) + v.dx(1) + dw.dx(2))*chi*dx - (u*B.dx(0) + v*B.dx(1) - dw)*chi*dGrnd
     
@@ -641,11 +1129,16 @@ class VelocityBP(object):
 
     self.delta_U = Function(Q)
 
+    # coarse levels of the grid sequence, set up on the first cold solve :
+    self.levels    = None
+    self.hierarchy = MeshHierarchy()
+
     model.eta   = eta
     model.Vd    = Vd
     model.Pe    = Pe
     model.Sl    = Sl
     model.Pb    = Pb
+    self.A      = A
     model.A     = A
     model.T     = T
     model.beta2 = beta2
@@ -662,12 +1155,20 @@ class VelocityBP(object):
     model  = self.model
     config = self.config
     
-    # solve nonlinear system :
-    solve(self.F == 0, model.U, J = self.J,
-          solver_parameters = self.newton_params)
-
-    # solve for vertical velocity :
-    solve(self.aw == self.Lw, model.w)
+    # start a cold solve from the solution on the coarse levels :
+    if config['velocity'].get('levels') \
+       and model.U.vector().norm('l2') == 0.0:
+      self.solve_coarse_levels()
+    
+    if self.rate_factor is not None:
+      self.rate_factor.update()
+    
+    # solve nonlinear system, continued from a softer problem if asked, 
+    # with the parameters as they are now :
+    nparams      = config['velocity']['newton_params'] or self.newton_params
+    newton_solve = lambda : self.problem.solve(model.U.vector(), nparams)
+    self.continuation.solve(newton_solve, nparams['newton_solver'], model.U)
+    self.problem.finalize()
 
     u = project(split(model.U)[0], model.Q)
     v = project(split(model.U)[1], model.Q)
@@ -675,13 +1176,517 @@ class VelocityBP(object):
     model.u.vector().set_local(u.vector().array())
     model.v.vector().set_local(v.vector().array())
 
+    # solve for vertical velocity, by integration up the columns if asked :
+    if config['velocity'].get('column_w', False) \
+       and model.columns.structured:
+      model.columns.vertical_velocity(model.u, model.v, model.B, model.w)
+    else:
+      solve(self.aw == self.Lw, model.w)
+
+  def get_coarse_levels(self):
+    """
+    Returns the VelocityBP instances of the levels of 
+    config['velocity']['levels'], coarsest first, created on the first 
+    call.  Each level is a dictionary holding a fully initialized coarse 
+    'model' of the same domain, such as one on the coarse or medium mesh 
+    of :class:`~meshes.mesh_factory.MeshFactory`, and may override 
+    entries of config['velocity'] such as 'newton_params'.
+    """
+    if self.levels is not None:
+      return self.levels
+    
+    config      = self.config
+    self.levels = []
+    for level in config['velocity']['levels']:
+      l_model    = level['model']
+      l_velocity = dict(config['velocity'])
+      l_velocity.update(level)
+      del l_velocity['levels']
+      del l_velocity['model']
+      
+      # the fields are interpolated from this model before each solve :
+      for k in ['beta2', 'E', 'T0']:
+        l_velocity[k] = None
+      l_velocity['use_T0'] = False
+      b_linear = l_velocity['b_linear']
+      if isinstance(b_linear, Function):
+        l_velocity['b_linear'] = self.hierarchy.transfer(b_linear, 
+                                                         Function(l_model.Q))
+      
+      l_config             = dict(config)
+      l_config['velocity'] = l_velocity
+      self.levels.append(VelocityBP(l_model, l_config))
+    return self.levels
+
+  def solve_coarse_levels(self):
+    """
+    Solve on each level of :meth:`get_coarse_levels`, coarsest first, with
+    the friction, temperature, water content and enhancement interpolated 
+    from the model, and each level starting from the solution of the 
+    previous one.  The last solution is interpolated onto model.U as the 
+    initial guess of the fine solve.  The transfer operators between the 
+    meshes are cached by :attr:`hierarchy`.
+    """
+    model = self.model
+    h     = self.hierarchy
+    
+    U     = None
+    for velocity in self.get_coarse_levels():
+      l_model = velocity.model
+      for name in ['beta2', 'T', 'W', 'E']:
+        h.transfer(getattr(model, name), getattr(l_model, name))
+      if U is not None:
+        h.transfer(U, l_model.U)
+      velocity.solve()
+      U = l_model.U
+    h.transfer(U, model.U)
+
+
+class VelocitySIA(object):
+  r"""
+  This class computes the velocity of the shallow ice approximation in 
+  closed form, column by column, on the layered mesh of <model>.  It is 
+  selected by config['velocity']['approximation'] = 'sia' and sets the same
+  fields as :class:`VelocityBP`, at a tiny fraction of the cost of a 
+  nonlinear 3D solve, for spin-ups and experiments such as EISMINT-II.
+  
+  :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config : Dictionary object containing information on physical 
+	                attributes such as velocties, age, and surface climate
+  
+  **Equations**
+
+  The horizontal velocity at height :math:`z` is
+
+  :Equation:
+     .. math::
+      \textbf{u}_{| |}(z) = \textbf{u}_b - 2\left(\rho g\right)^n 
+      \left|\nabla S\right|^{n-1} \nabla S \int_B^z A(z') 
+      \left(S - z'\right)^n dz',
+
+  with rate factor :math:`A = b(T)^{-n}` as in :class:`VelocityBP`, and 
+  sliding velocity :math:`\textbf{u}_b = -\rho g H \nabla S / (\beta^2 H^r)`
+  from the balance of basal traction and driving stress (none where
+  :math:`\beta^2 = 0`).  The integral is exact for a rate factor constant 
+  in each layer.  The surface slope is a lumped projection averaged over 
+  each column, and the vertical velocity follows from incompressibility 
+  (see :meth:`~src.helper.Columns.vertical_velocity`).
+  """
+  def __init__(self, model, config):
+    self.model  = model
+    self.config = config
+    
+    Q           = model.Q
+    S           = model.S
+    T           = model.T
+    beta2       = model.beta2
+    E           = model.E
+
+    if not model.columns.structured:
+      raise ValueError("The shallow ice approximation requires a mesh " +
+                       "of vertical columns, in a serial run.")
+
+    # initialize the temperature depending on input tpye :
+    if config['velocity']['use_T0']:
+      if   isinstance(config['velocity']['T0'], float):
+        T.vector()[:] = config['velocity']['T0']
+      
+      elif isinstance(config['velocity']['T0'], ndarray):
+        T.vector().set_local(config['velocity']['T0'])
+      
+      elif isinstance(config['velocity']['T0'], Expression):
+        T.interpolate(config['velocity']['T0'])
+
+    # initialize the bed friction coefficient :
+    if   isinstance(config['velocity']['beta2'], float):
+      beta2.vector()[:] = config['velocity']['beta2']
+    
+    elif isinstance(config['velocity']['beta2'], ndarray):
+      beta2.vector().set_local(config['velocity']['beta2'])
+    
+    elif isinstance(config['velocity']['beta2'], Expression):
+      beta2.interpolate(config['velocity']['beta2'])
+   
+    # initialize the enhancement factor :
+    if   isinstance(config['velocity']['E'], float):
+      E.vector()[:] = config['velocity']['E']
+    
+    elif isinstance(config['velocity']['E'], ndarray):
+      E.vector().set_local(config['velocity']['E'])
+    
+    elif isinstance(config['velocity']['E'], Expression):
+      E.interpolate(config['velocity']['E'])
+
+    # hardness of the linear viscosity mode :
+    if config['velocity']['viscosity_mode'] == 'linear':
+      b_linear = config['velocity']['b_linear']
+      if not isinstance(b_linear, Function):
+        b_linear = interpolate(b_linear, Q)
+      self.b_linear = b_linear
+
+    # lumped projections of the surface gradient onto the vertices :
+    phi          = TestFunction(Q)
+    self.m       = assemble(phi*dx).get_local()
+    self.dSdx    = S.dx(0) * phi * dx
+    self.dSdy    = S.dx(1) * phi * dx
+    self.m[self.m == 0.0] = 1.0
+    
+    # horizontal velocity in the mixed space of VelocityBP :
+    model.U      = Function(model.Q2)
+    self.u_dofs  = get_vertex_dofs(model.Q2.sub(0))
+    self.v_dofs  = get_vertex_dofs(model.Q2.sub(1))
+
+  def get_rate_factor(self, z, S):
+    """
+    Returns the rate factor A = b^{-n} and the exponent n on the columns,
+    given the column heights <z> and surface <S>.
+    """
+    model   = self.model
+    config  = self.config
+    columns = model.columns
+    n       = float(model.n)
+    mode    = config['velocity']['viscosity_mode']
+    
+    if   mode == 'isothermal':
+      A = config['velocity']['A0'] * numpy.ones(z.shape)
+    
+    elif mode == 'linear':
+      A = 1.0 / columns.get_values(self.b_linear)
+      n = 1.0
+    
+    elif mode == 'full':
+      T     = columns.get_values(model.T)
+      W     = columns.get_values(model.W)
+      E     = columns.get_values(model.E)
+      Tstar = T + float(model.gamma) * (S - z)
+      a_T   = numpy.where(Tstar < 263.15, 1.1384496e-5, 5.45e10)
+      Q_T   = numpy.where(Tstar < 263.15, 6e4, 13.9e4)
+      A     = E * a_T * (1 + 181.25*W) * numpy.exp(-Q_T / (float(model.R) 
+                                                           * Tstar))
+    
+    else:
+      raise ValueError("Acceptable choices for 'viscosity_mode' are " +
+                       "'linear', 'isothermal', or 'full'.")
+    return A, n
+
+  def get_slope(self, f):
+    """
+    Returns the column averages of the lumped projection of the form <f>.
+    """
+    columns = self.model.columns
+    g       = Function(self.model.Q)
+    g.vector().set_local(assemble(f).get_local() / self.m)
+    g.vector().apply('insert')
+    return columns.get_values(g).mean(axis=1)[:,None]
+
+  def get_velocity(self, sliding=True):
+    """ 
+    Returns the horizontal velocity of the shallow ice approximation and 
+    its vertical shear on the columns, along with the rate factor and 
+    exponent.  If <sliding> is False, only the deformational velocity is 
+    returned, as for the hybrid mode of :class:`VelocitySSA`.
+    """
+    model   = self.model
+    config  = self.config
+    columns = model.columns
+    rho     = float(model.rho)
+    g       = float(model.g)
+    r       = config['velocity']['r']
+
+    z       = columns.get_z()
+    S       = z[:,[-1]]
+    H       = S - z[:,[0]]
+    A, n    = self.get_rate_factor(z, S)
+    S_x     = self.get_slope(self.dSdx)
+    S_y     = self.get_slope(self.dSdy)
+    slope   = numpy.sqrt(S_x**2 + S_y**2)
+    
+    # sliding from the basal traction :
+    k_b     = numpy.zeros(H.shape)
+    if sliding:
+      beta2 = columns.get_values(model.beta2)[:,[0]] * H**r
+      k_b[beta2 > 0] = rho * g * H[beta2 > 0] / beta2[beta2 > 0]
+
+    # integral of A (S - z)^n from the bed, exact for A constant in layers :
+    d       = (S - z)**(n+1) / (n+1)
+    I       = numpy.zeros(z.shape)
+    I[:,1:] = numpy.cumsum(0.5*(A[:,1:] + A[:,:-1]) * (d[:,:-1] - d[:,1:]),
+                           axis=1)
+    
+    c       = 2 * (rho * g)**n * slope**(n-1)
+    u       = - (k_b + c*I) * S_x
+    v       = - (k_b + c*I) * S_y
+    u_z     = - c * A * (S - z)**n * S_x
+    v_z     = - c * A * (S - z)**n * S_y
+    return u, v, u_z, v_z, A, n
+
+  def set_velocity(self, u, v, u_z, v_z, A, n):
+    """
+    Set model.u, v, w and U from the column values of the horizontal 
+    velocity (<u>, <v>), and model.b and model.epsdot, for the strain 
+    heating of Enthalpy, from the vertical shear and the rate factor.
+    """
+    model   = self.model
+    columns = model.columns
+    eps_reg = float(model.eps_reg)
+    
+    columns.set_values(model.u, u)
+    columns.set_values(model.v, v)
+    columns.set_values(model.b, A**(-1/n))
+    columns.set_values(model.epsdot, 0.25*(u_z**2 + v_z**2) + eps_reg)
+    columns.vertical_velocity(model.u, model.v, model.B, model.w)
+
+    U = model.U.vector().get_local()
+    U[self.u_dofs] = model.u.vector().get_local()[columns.get_dofs(model.Q)]
+    U[self.v_dofs] = model.v.vector().get_local()[columns.get_dofs(model.Q)]
+    model.U.vector().set_local(U)
+    model.U.vector().apply('insert')
+
+  def solve(self):
+    """ 
+    Evaluate the velocity of the shallow ice approximation.
+    """
+    self.set_velocity(*self.get_velocity())
+
+
+class VelocitySSA(object):
+  r"""
+  This class solves the depth-integrated shallow shelf approximation on the 
+  footprint of the layered mesh of <model>, a planar mesh of its upper 
+  surface, and extrudes the velocity back down the columns.  It is 
+  selected by config['velocity']['approximation'] = 'ssa', or by 'hybrid' 
+  to add the deformational velocity of the shallow ice approximation 
+  (:class:`VelocitySIA`) to the sliding velocity of the shelf equations.
+  
+  :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config : Dictionary object containing information on physical 
+	                attributes such as velocties, age, and surface climate
+
+  **Equations**
+
+  The velocity minimizes the depth-integrated variational principle
+
+  :Equation:
+     .. math::
+      \mathcal{A}\left[\textbf{u}\right] = \int\limits_{\Omega} 
+      \frac{2n}{n+1} H \bar{b} \dot{\epsilon}^{\frac{n+1}{2n}} + 
+      \rho g H \textbf{u}\cdot\nabla S + \frac{\beta^2}{2} H^r 
+      \textbf{u}\cdot\textbf{u} \ d\Omega,
+
+  with :math:`\dot{\epsilon} = u_x^2 + v_y^2 + u_x v_y + \frac{1}{4}
+  \left(u_y + v_x\right)^2`, the restriction of the strain rate of 
+  :class:`VelocityBP` to a plug flow, and :math:`\bar{b}` the vertical 
+  average of the hardness of the 3D temperature field.  At the calving 
+  front, the boundary of the footprint where the mask of the model 
+  (see :meth:`~src.model.Model.set_geometry`) is floating, the 
+  depth-integrated ice pressure is balanced by the water pressure,
+
+  :Equation:
+     .. math::
+      \int\limits_{\Gamma_F} -\frac{g}{2}\left(\rho H^2 - \rho_w D^2
+      \right) \textbf{u}\cdot\textbf{n} \ d\Gamma,
+
+  with :math:`D` the depth of the ice base below sea level.  The other 
+  lateral boundaries are free of stress.
+
+  The footprint copies of the surface, thickness, friction and target 
+  velocities are held by :attr:`fields` and updated from <model> at each 
+  solve.  The velocity is held by model.U_ssa, and the variational 
+  principle by :attr:`A`, so that :class:`AdjointVelocityBP` may 
+  differentiate it with respect to beta2.  Periodic boundaries are not 
+  carried over to the footprint mesh.  The quadrature degrees are set as 
+  for :class:`VelocityBP`.
+  """
+  def __init__(self, model, config):
+    self.model  = model
+    self.config = config
+    
+    columns     = model.columns
+    r           = Constant(config['velocity']['r'])
+    rho         = model.get_constant('rho')
+    rho_w       = model.get_constant('rho_w')
+    g           = model.get_constant('g')
+    eps_reg     = model.get_constant('eps_reg')
+    n           = model.get_constant('n')
+    # initial fields, rate factor and deformational velocity :
+    self.sia    = VelocitySIA(model, config)
+    self.hybrid = config['velocity']['approximation'] == 'hybrid'
+    if config['velocity']['viscosity_mode'] == 'linear':
+      n = 1.0
+
+    # footprint mesh, and the column under each of its vertices :
+    surface, v_map = extract_surface_mesh(model.mesh, model.ff, 2)
+    Q           = FunctionSpace(surface, 'CG', 1)
+    Q2          = MixedFunctionSpace([Q]*2)
+    col         = columns.column[v_map]
+    self.vertex = numpy.zeros(len(columns.index), dtype=int)
+    self.vertex[col] = numpy.arange(len(col))
+    self.col    = col
+    self.Q      = Q
+    self.Q2     = Q2
+    self.s_dofs = get_vertex_dofs(Q)
+    self.u_dofs = get_vertex_dofs(Q2.sub(0))
+    self.v_dofs = get_vertex_dofs(Q2.sub(1))
+    
+    # footprint copies of the model fields :
+    self.fields = OrderedDict()
+    for name in ['S', 'H', 'b', 'beta2', 'u_o', 'v_o', 'U_o', 'u_d', 'v_d']:
+      self.fields[name] = Function(Q)
+    S           = self.fields['S']
+    H           = self.fields['H']
+    b           = self.fields['b']
+    beta2       = self.fields['beta2']
+    
+    Phi         = TestFunction(Q2)
+    dU          = TrialFunction(Q2)
+    model.U_ssa = Function(Q2)
+    U           = model.U_ssa
+    u, v        = split(U)
+
+    # strain rate of a plug flow :
+    epsdot      = + u.dx(0)**2 + v.dx(1)**2 + u.dx(0)*v.dx(1) \
+                  + 0.25*(u.dx(1) + v.dx(0))**2 + eps_reg
+
+    # 1) Viscous dissipation
+    Vd          = H * (2*n)/(n+1) * b * epsdot**((n+1)/(2*n))
+
+    # 2) Potential energy
+    Pe          = rho * g * H * (u * S.dx(0) + v * S.dx(1))
+
+    # 3) Dissipation by sliding
+    Sl          = 0.5 * beta2 * H**r * (u**2 + v**2)
+    
+    # 4) Pressure at the calving front, the depth-integrated difference of 
+    #    the ice and water pressures, with D the depth of the base below 
+    #    sea level :
+    D           = conditional(lt(S - H, 0.0), H - S, 0.0)
+    N           = FacetNormal(surface)
+    Pf          = - 0.5 * g * (rho * H**2 - rho_w * D**2) \
+                  * (u * N[0] + v * N[1])
+    
+    # the front is the boundary of the footprint over floating ice, given 
+    # by the mask of the model :
+    self.ff     = FacetFunction('size_t', surface, 0)
+    if model.mask is not None:
+      for f in facets(surface):
+        mid = f.midpoint()
+        if f.exterior() and model.mask(mid.x(), mid.y()) > 0:
+          self.ff[f] = 1
+    dFront      = Measure('ds')[self.ff](1)
+    
+    # quadrature degrees of the integrals, estimated by the form compiler 
+    # if not given :
+    q_deg       = config['velocity'].get('quadrature_degree', {})
+    dx_v        = set_quadrature_degree(dx, q_deg.get('viscous'))
+    dx_p        = set_quadrature_degree(dx, q_deg.get('potential'))
+    dx_s        = set_quadrature_degree(dx, q_deg.get('sliding'))
+    dFront      = set_quadrature_degree(dFront, q_deg.get('potential'))
+
+    # Variational principle
+    A           = Vd*dx_v + Pe*dx_p + Sl*dx_s + Pf*dFront
+    self.F      = derivative(A, U, Phi)
+    self.J      = derivative(self.F, U, dU)
+    
+    # Newton solver as in VelocityBP :
+    newton_params = config['velocity']['newton_params']
+    if not newton_params:
+      newton_params = NonlinearVariationalSolver.default_parameters()
+    self.newton_params = newton_params
+    self.problem  = NewtonProblem(self.F, self.J, newton_params)
+
+    self.U  = U
+    self.A  = A
+    self.Vd = Vd
+    self.Pe = Pe
+    self.Sl = Sl
+    self.Pf = Pf
+
+  def set_field(self, name, values):
+    """
+    Set the footprint field <name> from its column <values>.
+    """
+    f = self.fields[name]
+    a = numpy.zeros(self.Q.dim())
+    a[self.s_dofs] = values[self.col]
+    f.vector().set_local(a)
+    f.vector().apply('insert')
+
+  def to_model(self, g):
+    """
+    Returns the vector, in the space of model.Q, of the footprint vector 
+    <g> at the bed vertices of the columns, and zero elsewhere, such as 
+    a gradient with respect to the bed values of a 3D field.
+    """
+    model   = self.model
+    columns = model.columns
+    f       = Function(model.Q)
+    a       = numpy.zeros(model.Q.dim())
+    v2d     = columns.get_dofs(model.Q)
+    a[v2d[columns.index[:,0]]] = g.array()[self.s_dofs][self.vertex]
+    f.vector().set_local(a)
+    f.vector().apply('insert')
+    return Vector(f.vector())
+
+  def update(self):
+    """
+    Update the footprint fields from the model.
+    """
+    model   = self.model
+    columns = model.columns
+    
+    z       = columns.get_z()
+    S       = z[:,-1]
+    H       = S - z[:,0]
+    A, n    = self.sia.get_rate_factor(z, z[:,[-1]])
+    b       = columns.integrate_values(A**(-1/n))[:,-1] / H
+    
+    self.set_field('S',     S)
+    self.set_field('H',     H)
+    self.set_field('b',     b)
+    self.set_field('beta2', columns.get_values(model.beta2)[:,0])
+    for name in ['u_o', 'v_o', 'U_o']:
+      self.set_field(name, columns.get_values(getattr(model, name))[:,-1])
+
+  def solve(self):
+    """ 
+    Perform the Newton solve of the shallow shelf equations, and set the 
+    3D velocity.
+    """
+    model   = self.model
+    columns = model.columns
+    
+    self.update()
+    nparams = self.config['velocity']['newton_params'] or self.newton_params
+    self.problem.solve(self.U.vector(), nparams)
+    self.problem.finalize()
+    
+    # extrude the plug flow down the columns :
+    U    = self.U.vector().get_local()
+    m    = columns.index.shape[1]
+    u    = numpy.tile(U[self.u_dofs][self.vertex][:,None], (1, m))
+    v    = numpy.tile(U[self.v_dofs][self.vertex][:,None], (1, m))
+    
+    # deformational velocity of the hybrid mode, also held at the surface
+    # for the misfit of AdjointVelocityBP :
+    u_d, v_d, u_z, v_z, A, n = self.sia.get_velocity(sliding=False)
+    if not self.hybrid:
+      u_d = u_z = numpy.zeros(u.shape)
+      v_d = v_z = numpy.zeros(v.shape)
+    self.set_field('u_d', u_d[:,-1])
+    self.set_field('v_d', v_d[:,-1])
+    self.sia.set_velocity(u + u_d, v + v_d, u_z, v_z, A, n)
+
 
 class Enthalpy(object):
   r""" 
   This class solves the internal energy balance (enthalpy) in steady state or 
   transient, and converts that solution to temperature and water content.
 
-  Time stepping uses Crank-Nicholson, which is 2nd order accurate.
+  Time stepping uses Crank-Nicholson, which is 2nd order accurate.  The 
+  quadrature degrees of the 'supg' integrals of the advection-diffusion 
+  terms, of the 'strain_heating' integral and of the 'boundary' integral 
+  of the basal heat flux may be given by 
+  config['enthalpy']['quadrature_degree'].
     
   :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
   :param config : Dictionary object containing information on physical 
@@ -805,41 +1810,41 @@ class Enthalpy(object):
 
     T_surface   = config['enthalpy']['T_surface']
     q_geo       = config['enthalpy']['q_geo']
-    r           = config['velocity']['r']
+    r           = Constant(config['velocity']['r'])
 
     mesh          = model.mesh
     Q             = model.Q
     Q2            = model.Q2
     H             = model.H
     H0            = model.H0
-    n             = model.n
+    n             = model.get_constant('n')
     b             = model.b
     Tstar         = model.Tstar
     T             = model.T
     T0            = model.T0
     h_i           = model.h_i
-    L             = model.L
-    C             = model.C
-    C_w           = model.C_w
-    gamma         = model.gamma
+    L             = model.get_constant('L')
+    C             = model.get_constant('C')
+    C_w           = model.get_constant('C_w')
+    gamma         = model.get_constant('gamma')
     S             = model.S
     B             = model.B
     x             = model.x
     E             = model.E
     W             = model.W
-    R             = model.R
+    R             = model.get_constant('R')
     epsdot        = model.epsdot
-    eps_reg       = model.eps_reg
+    eps_reg       = model.get_constant('eps_reg')
     eta           = model.eta
-    rho           = model.rho
-    g             = model.g
+    rho           = model.get_constant('rho')
+    g             = model.get_constant('g')
     beta2         = model.beta2
     u             = model.u
     v             = model.v
     w             = model.w
     cold          = model.cold
     kappa         = model.kappa
-    k             = model.k
+    k             = model.get_constant('k')
     Hhat          = model.Hhat
     uhat          = model.uhat
     vhat          = model.vhat
@@ -880,6 +1885,13 @@ class Enthalpy(object):
     psi = TestFunction(Q)
     dH  = TrialFunction(Q)
 
+    # quadrature degrees of the integrals, estimated by the form compiler 
+    # if not given :
+    q_deg  = config['enthalpy'].get('quadrature_degree', {})
+    dx_a   = set_quadrature_degree(dx,    q_deg.get('supg'))
+    dx_s   = set_quadrature_degree(dx,    q_deg.get('strain_heating'))
+    dGrnd  = set_quadrature_degree(ds(3), q_deg.get('boundary'))
+
     # Pressure melting point
     T0  = 273.0 - gamma * (S - x[2])
 
@@ -922,10 +1934,10 @@ class Enthalpy(object):
       psihat = psi + h/(2*vnorm) * dot(U, grad(psi))
 
       # residual of model :
-      self.F = + rho * dot(U, grad(dH)) * psihat * dx \
-               + rho * kappa * dot(grad(psi), grad(dH)) * dx \
-               - (q_geo + q_friction) * psihat * ds(3) \
-               - Q_s * psihat * dx
+      self.F = + rho * dot(U, grad(dH)) * psihat * dx_a \
+               + rho * kappa * dot(grad(psi), grad(dH)) * dx_a \
+               - (q_geo + q_friction) * psihat * dGrnd \
+               - Q_s * psihat * dx_s
 
       self.a = lhs(self.F)
       self.L = rhs(self.F)
@@ -947,11 +1959,11 @@ class Enthalpy(object):
       Hmid = theta*dH + (1 - theta)*H0
       
       # implicit system (linearized) for enthalpy at time H_{n+1}
-      self.F = + rho * (dH - H0) / dt * psi * dx \
-               + rho * dot(U, grad(Hmid)) * psihat * dx \
-               + rho * kappa * dot(grad(psi), grad(Hmid)) * dx \
-               - (q_geo + q_friction) * psi * ds(3) \
-               - Q_s * psi * dx
+      self.F = + rho * (dH - H0) / dt * psi * dx_a \
+               + rho * dot(U, grad(Hmid)) * psihat * dx_a \
+               + rho * kappa * dot(grad(psi), grad(Hmid)) * dx_a \
+               - (q_geo + q_friction) * psi * dGrnd \
+               - Q_s * psi * dx_s
 
       self.a = lhs(self.F)
       self.L = rhs(self.F)
@@ -1065,12 +2077,12 @@ class Enthalpy(object):
     mhat      = model.mhat
     T_surface = model.T_surface
     H_surface = model.H_surface
-    C         = model.C
+    C         = model.get_constant('C')
     h_i       = model.h_i
     T         = model.T
     W         = model.W
     Mb        = model.Mb
-    L         = model.L
+    L         = model.get_constant('L')
     cold      = model.cold
 
     # Surface boundary condition
@@ -1130,7 +2142,9 @@ class Enthalpy(object):
 
 class FreeSurface(object):
   r""" 
-  Class for evolving the free surface of the ice through time.
+  Class for evolving the free surface of the ice through time.  The 
+  quadrature degree of the 'supg' integrals may be given by 
+  config['free_surface']['quadrature_degree'].
   
   :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
   :param config : Dictionary object containing information on physical 
@@ -1235,12 +2249,16 @@ class FreeSurface(object):
     upwind_term = h/(2.*unorm)*(self.uhat*phi.dx(0) + self.vhat*phi.dx(1))
     phihat      = phi + upwind_term
 
-    mass_matrix = dS * phihat * dSurf
+    # quadrature degree of the SUPG integrals :
+    q_deg       = config['free_surface'].get('quadrature_degree', {})
+    dSurf_a     = set_quadrature_degree(dSurf, q_deg.get('supg'))
+
+    mass_matrix = dS * phihat * dSurf_a
     lumped_mass = phi * dSurf
 
-    stiffness_matrix = - self.uhat * self.Shat.dx(0) * phihat * dSurf \
-                       - self.vhat * self.Shat.dx(1) * phihat * dSurf\
-                       + (self.what + self.ahat) * phihat * dSurf
+    stiffness_matrix = - self.uhat * self.Shat.dx(0) * phihat * dSurf_a \
+                       - self.vhat * self.Shat.dx(1) * phihat * dSurf_a \
+                       + (self.what + self.ahat) * phihat * dSurf_a
     
     # Calculate the nonlinear residual dependent scalar
     term1            = self.Shat.dx(0)**2 + self.Shat.dx(1)**2 + 1e-1
@@ -1248,7 +2266,7 @@ class FreeSurface(object):
                        + self.vhat*self.Shat.dx(1) \
                        - (self.what + self.ahat)
     C                = 10.0*h/(2*unorm) * term1 * term2**2
-    diffusion_matrix = C * dot(grad(phi), grad(self.Shat)) * dSurf
+    diffusion_matrix = C * dot(grad(phi), grad(self.Shat)) * dSurf_a
     
     # Set up the Galerkin-least squares formulation of the Stokes' functional
     A_pro         = - phi.dx(2)*dS*dx - dS*phi*dBase + dSdt*phi*dSurf 
@@ -1302,8 +2320,336 @@ class FreeSurface(object):
     else:
       m.ident_zeros()
       solve(m, model.dSdt.vector(), r)
+    
+    # extend the surface rate down the columns :
+    if model.columns.structured:
+      model.columns.extrude(model.dSdt, 'surface', model.dSdt)
+    else:
+      solve(lhs(self.A_pro) == rhs(self.A_pro), model.dSdt)
+
+class AdjointFreeSurface(object):
+  r"""
+  Discrete adjoint of one forward Euler time step of the free surface 
+  coupled to the first-order momentum balance, stepped backwards in time
+  by :class:`~src.solvers.TransientAdjointSolver`.
+
+  A step from the surface :math:`S_n` to :math:`S_{n+1}` consists of the 
+  velocity solve for :math:`\textbf{u}` and :math:`w` at :math:`S_n`, the 
+  upwinded kinematic equation for the rate of surface change 
+  :math:`\dot{S}` on the upper surface (as in :class:`FreeSurface`, 
+  without shock capturing and mass lumping), its extension down the 
+  columns of the mesh, and the update
+
+  :Equation:
+     .. math::
+      S_{n+1} = \max\left(S_n + \Delta t \dot{S}, B + H_{min}\right)
+
+  The objective is the time integral over the upper surface of either
+  :math:`\frac{1}{2}(S - S_o)^2` ('surface') or 
+  :math:`\frac{1}{2}(\dot{S} - \dot{S}_o)^2` ('dhdt'), where 
+  :math:`\dot{S}` is the kinematic rate of the velocity field.  The 
+  sensitivity of the velocity to the deformation of the mesh as the 
+  surface moves is neglected.
+
+  :param model    : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config   : Dictionary object containing information on physical 
+                    attributes such as velocties, age, and surface climate
+  :param velocity : :class:`VelocityBP` instance that solves the forward 
+                    model
+  """
+  def __init__(self, model, config, velocity):
+    """ Setup. """
+    self.model    = model
+    self.config   = config
+    self.velocity = velocity
+
+    mesh      = model.mesh
+    Q         = model.Q
+    Q2        = model.Q2
+    Q_S       = model.S.function_space()
+    U         = model.U
+    w         = model.w
+    S         = model.S
+    B         = model.B
+    smb       = model.smb
+    ds        = model.ds
+    dSurf     = ds(2)
+    dBase     = ds(3)
+    control   = config['transient_adjoint']['control_variable']
+    objective = config['transient_adjoint']['objective_function']
+
+    u, v      = split(U)
+    Phi       = TestFunction(Q2)
+    chi       = TestFunction(Q)
+    dw        = TrialFunction(Q)
+    xi        = TestFunction(Q_S)
+    dR        = TrialFunction(Q_S)
+    rho       = TestFunction(control.function_space())
+
+    self.dt     = Constant(config['time_step'])
+    self.weight = Constant(1.0)            # quadrature weight of the step
+    self.obs    = Function(Q_S)            # observed S or dS/dt
+    self.dSdt_s = Function(Q_S)            # rate of change on the surface
+    self.dSdt   = Function(Q_S)            # rate extended down the columns
+    self.B_S    = interpolate(B, Q_S)
+    self.active = numpy.zeros(len(S.vector().get_local()), dtype=bool)
+
+    # adjoint variables of U, w, dSdt_s and dSdt :
+    self.mu_U   = Function(Q2)
+    self.mu_w   = Function(Q)
+    self.mu_s   = Function(Q_S)
+    self.mu_d   = Function(Q_S)
+
+    # kinematic rate of surface change :
+    h         = CellSize(mesh)
+    unorm     = sqrt(u**2 + v**2 + 1e-1)
+    k         = - u*S.dx(0) - v*S.dx(1) + w + smb
+
+    # residuals of the forward model in the direction of <xx> :
+    def F_w(xx, ww):
+      return + (u.dx(0) + v.dx(1) + ww.dx(2))*xx*dx \
+             - (u*B.dx(0) + v*B.dx(1) - ww)*xx*dBase
+    
+    def F_s(xx, RR):
+      xxhat = xx + h/(2*unorm)*(u*xx.dx(0) + v*xx.dx(1))
+      return (RR - k)*xxhat*dSurf
+    
+    def F_d(xx, DD):
+      return - xx.dx(2)*DD*dx - DD*xx*dBase + self.dSdt_s*xx*dSurf
+
+    # forward systems for the rates :
+    self.a_s     = Form(lhs(F_s(xi, dR)))
+    self.L_s     = Form(rhs(F_s(xi, dR)))
+    self.a_d     = Form(lhs(F_d(xi, dR)))
+    self.L_d     = Form(rhs(F_d(xi, dR)))
+
+    # adjoint operators :
+    self.a_s_adj = Form(adjoint(lhs(F_s(xi, dR))))
+    self.a_d_adj = Form(adjoint(lhs(F_d(xi, dR))))
+    self.a_w_adj = Form(adjoint(lhs(F_w(chi, dw))))
+    self.a_U_adj = Form(velocity.J)
+
+    # objective of the time step :
+    if objective == 'surface':
+      j = 0.5 * (S - self.obs)**2 * dSurf
+    elif objective == 'dhdt':
+      j = 0.5 * (k - self.obs)**2 * dSurf
+    else:
+      raise ValueError("Valid objectives are 'surface' and 'dhdt'.")
+    self.I = self.weight * self.dt * j
+
+    # forward residuals in the direction of the adjoint variables, with the 
+    # rate factor depending on S :
+    L_U = derivative(model.A, U, self.mu_U)
+    if getattr(velocity, 'rate_factor', None) is not None:
+      L_U = velocity.rate_factor.replace(L_U)
+    L_w = F_w(self.mu_w, w)
+    L_s = F_s(self.mu_s, self.dSdt_s)
+    L_d = F_d(self.mu_d, self.dSdt)
+
+    # right-hand sides of the adjoint systems, in reverse order :
+    self.g_s = Form(-derivative(L_d, self.dSdt_s, xi))
+    self.g_w = Form(derivative(self.I - L_s, w, chi))
+    self.g_U = Form(derivative(self.I - L_s - L_w, U, Phi))
+    self.g_S = Form(derivative(self.I - L_s - L_U, S, xi))
+    self.g_c = Form(derivative(self.I - L_s - L_U, control, rho))
+
+  def set_observation(self, t):
+    """
+    Interpolate the observation at time <t> into :attr:`obs`.
+    """
+    obs = self.config['transient_adjoint']['observation'](t)
+    self.obs.interpolate(obs)
+
+  def deform_mesh(self):
+    """
+    Move the mesh vertices to fit the current surface.
+    """
+    model = self.model
+    S_v   = model.S.compute_vertex_values()
+    B_v   = model.B.compute_vertex_values()
+    sigma = model.sigma.compute_vertex_values()
+    model.mesh.coordinates()[:,2] = sigma*(S_v - B_v) + B_v
+
+  def solve_forward(self):
+    """
+    Solve for the velocity and the rate of surface change at the current 
+    surface, and determine the nodes which the thickness limit of the 
+    next update holds in place.
+    """
+    model  = self.model
+    thklim = self.config['free_surface']['thklim']
+
+    self.velocity.solve()
+
+    A = assemble(self.a_s, keep_diagonal=True)
+    A.ident_zeros()
+    solve(A, self.dSdt_s.vector(), assemble(self.L_s))
+    solve(assemble(self.a_d), self.dSdt.vector(), assemble(self.L_d))
+
+    S_n         = model.S.vector().get_local()
+    S_min       = self.B_S.vector().get_local() + thklim
+    dt          = self.config['time_step']
+    self.active = S_n + dt*self.dSdt.vector().get_local() < S_min
+
+  def update_surface(self):
+    """
+    Advance the surface with the rate of the last :meth:`solve_forward`.
+    """
+    model  = self.model
+    thklim = self.config['free_surface']['thklim']
+    dt     = self.config['time_step']
+    
+    S_n         = model.S.vector().get_local()
+    S_min       = self.B_S.vector().get_local() + thklim
+    S_np1       = S_n + dt*self.dSdt.vector().get_local()
+    S_np1[self.active] = S_min[self.active]
+    model.S.vector().set_local(S_np1)
+    model.S.vector().apply('insert')
+    self.deform_mesh()
+
+  def solve(self, g_S=None):
+    """
+    Solves the adjoint of the time step of the last :meth:`solve_forward`.
+    
+    :param g_S : Array holding the derivative of the objective of all later 
+                 time steps with respect to the surface after this step, 
+                 or None if this is the last time step
+    :rtype     : Tuple of the derivative of the objective of this and all 
+                 later steps with respect to the surface before the step, 
+                 and the gradient vector of this step
+    """
+    dt = self.config['time_step']
+    
+    # adjoint of the surface update and of the rates :
+    if g_S is None:
+      g_S = numpy.zeros(len(self.active))
+      self.mu_d.vector()[:] = 0.0
+      self.mu_s.vector()[:] = 0.0
+    else:
+      g_S              = g_S.copy()
+      g_S[self.active] = 0.0
+      b = self.mu_d.vector().copy()
+      b.set_local(dt*g_S)
+      b.apply('insert')
+      solve(assemble(self.a_d_adj), self.mu_d.vector(), b)
       
-    solve(lhs(self.A_pro) == rhs(self.A_pro), model.dSdt)
+      A = assemble(self.a_s_adj, keep_diagonal=True)
+      A.ident_zeros()
+      solve(A, self.mu_s.vector(), assemble(self.g_s))
+
+    # adjoint of the vertical and horizontal velocity :
+    solve(assemble(self.a_w_adj), self.mu_w.vector(), assemble(self.g_w))
+    solve(assemble(self.a_U_adj), self.mu_U.vector(), assemble(self.g_U))
+
+    g_S += assemble(self.g_S).get_local()
+    return g_S, assemble(self.g_c)
+
+
+class PointObservations(object):
+  r"""
+  Observation operator for data at scattered points, such as flight lines,
+  GPS or radar samples.  The interpolation of a Function of the continuous
+  piecewise-linear space <V> to the points is stored as a sparse matrix 
+  :math:`P` (see :func:`~src.helper.get_barycentric_matrix`), so that the 
+  misfit
+
+  :Equation:
+     .. math::
+      I = \frac{1}{2}\sum_i \left(\frac{(Pf)_i - d_i}{\sigma_i}\right)^2
+
+  and its derivatives are sparse matrix-vector products.  Points with 
+  fewer coordinates than the mesh, such as (x,y) positions on a 3D mesh,
+  are placed on the upper surface of the mesh, and must lie within its 
+  footprint.  The matrix acts on the process-local vectors, so that point
+  observations are only available in serial runs.
+
+  :param V     : Dolfin FunctionSpace of degree one, either scalar or mixed
+                 of scalar spaces such as model.Q2
+  :param x     : Array of shape (n, d) of the coordinates of the points
+  :param d     : Array of the observations, of shape (n, k) for a space 
+                 with k components
+  :param sigma : (Optional) standard deviation of the observations, float
+                 or array shaped like <d>
+  """
+  def __init__(self, V, x, d, sigma=1.0):
+    """ 
+    Locate the points and build the interpolation matrix.
+    """
+    mesh  = V.mesh()
+    gdim  = mesh.geometry().dim()
+    coord = mesh.coordinates()
+    x     = numpy.array(x, dtype=float)
+    
+    if MPI.num_processes() > 1:
+      raise NotImplementedError("Point observations are only available " +
+                                "in serial runs.")
+    if V.ufl_element().degree() != 1:
+      raise ValueError('Point observations require a space of degree 1.')
+    
+    # place planar points on the top of the columns of the mesh :
+    if x.shape[1] < gdim:
+      xy, idx = numpy.unique(numpy.round(coord[:,:2], 6).view('f8,f8'),
+                             return_inverse=True)
+      z_top   = numpy.zeros(len(xy)) - numpy.inf
+      numpy.maximum.at(z_top, idx.ravel(), coord[:,2])
+      xy      = xy.view('f8').reshape(-1, 2)
+      z       = LinearNDInterpolator(xy, z_top)(x)
+      outside = numpy.isnan(z)
+      if outside.any():
+        raise ValueError('%i of %i points lie outside of the footprint ' 
+                         % (outside.sum(), len(x)) + 'of the mesh.')
+      z      -= 1e-6 * (coord[:,2].max() - coord[:,2].min())
+      x       = numpy.column_stack([x, z])
+    
+    # one row per point and component, from the vertices to the dofs :
+    M     = get_barycentric_matrix(mesh, x).tocoo()
+    n_sub = V.num_sub_spaces()
+    subs  = [V.sub(k) for k in range(n_sub)] if n_sub > 0 else [V]
+    k_n   = len(subs)
+    rows  = []
+    cols  = []
+    for k, W in enumerate(subs):
+      rows.append(k_n*M.row + k)
+      cols.append(get_vertex_dofs(W)[M.col])
+    rows = numpy.hstack(rows)
+    cols = numpy.hstack(cols)
+    vals = numpy.tile(M.data, k_n)
+    
+    self.V     = V
+    self.x     = x
+    self.P     = csr_matrix((vals, (rows, cols)), shape=(k_n*len(x), V.dim()))
+    self.PT    = self.P.T.tocsr()
+    self.d     = numpy.array(d, dtype=float).ravel()
+    self.w     = 1.0 / (numpy.zeros(self.d.shape) + numpy.ravel(sigma))**2
+
+  def evaluate(self, f):
+    """
+    Returns the values of the Function <f> at the points.
+    """
+    return self.P.dot(f.vector().array())
+
+  def misfit(self, f):
+    """
+    Returns the misfit of the Function <f> to the observations.
+    """
+    r = self.evaluate(f) - self.d
+    return 0.5 * numpy.sum(self.w * r**2)
+
+  def gradient(self, f):
+    """
+    Returns the array of the derivative of the misfit with respect to the 
+    coefficients of the Function <f>.
+    """
+    return self.PT.dot(self.w * (self.evaluate(f) - self.d))
+
+  def hessian_action(self, df):
+    """
+    Returns the array of the action of the Hessian of the misfit in the 
+    direction of the Function <df>.
+    """
+    return self.PT.dot(self.w * self.P.dot(df.vector().array()))
+
 
 class AdjointVelocityBP(object):
   """ 
@@ -1314,14 +2660,41 @@ class AdjointVelocityBP(object):
   to topography optimization, or minimization of dHdt is now straightforward,
   and requires no math.
     
-  :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
-  :param config : Dictionary object containing information on physical 
-                  attributes such as velocties, age, and surface climate
+  For the first-order model, the adjoint operator is the (symmetric) 
+  Jacobian of the forward Newton solve, so if the velocity instance is 
+  given, it assembles and factorizes its Jacobian at the solution after 
+  each forward solve (see :class:`NewtonProblem`), and that factorization
+  is reused for the adjoint solve.
+
+  If the velocity instance is a :class:`VelocitySSA`, the adjoint is that 
+  of the shallow shelf equations on the footprint mesh, with beta2 as the 
+  only control, and the gradient is returned on the bed vertices of the 
+  3D mesh by :meth:`gradient`.  The action of the Hessian is not 
+  available in this case.
+
+  :param model    : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config   : Dictionary object containing information on physical 
+                    attributes such as velocties, age, and surface climate
+  :param velocity : (Optional) :class:`~src.physics.VelocityBP` or 
+                    :class:`~src.physics.VelocitySSA` instance that solves
+                    the forward model
   """
-  def __init__(self, model, config):
+  def __init__(self, model, config, velocity=None):
     """ Setup. """
     self.model  = model
     self.config = config
+    
+    # the Jacobian of the last Newton step only matches the forward state
+    # if the velocity is not followed by an enthalpy solve :
+    if isinstance(velocity, (VelocityBP, VelocitySSA)) \
+       and not config['enthalpy']['on']:
+      self.forward = velocity
+      velocity.problem.final_jacobian = True
+    else:
+      self.forward = None
+    
+    self.ssa      = isinstance(velocity, VelocitySSA)
+    self.velocity = velocity
 
     # the weight of the Tikhonov regularization
     alpha     = config['adjoint']['alpha'] 
@@ -1347,13 +2720,47 @@ class AdjointVelocityBP(object):
     control = config['adjoint']['control_variable']
     alpha = config['adjoint']['alpha']
 
-    if config['velocity']['approximation'] == 'fo':
+    # the misfit is evaluated over the surface, and the regularization 
+    # over the bed :
+    dSurf     = ds(2)
+    dGrnd     = ds(3)
+
+    if self.ssa:
+      if config['adjoint']['objective_function'] in ['kinematic', 'points']:
+        raise ValueError("The shallow shelf approximation supports the " +
+                         "'logarithmic' and 'linear' objectives.")
+      if any([c is not model.beta2 for c in control]):
+        raise ValueError("The shallow shelf approximation only supports " +
+                         "beta2 as control variable.")
+      
+      # footprint copies, with the deformational velocity of the hybrid 
+      # mode added to the plug flow at the surface :
+      fields    = velocity.fields
+      Q         = velocity.Q
+      Q_adj     = velocity.Q2
+      A         = velocity.A
+      U         = velocity.U
+      U_o       = fields['U_o']
+      u_o       = fields['u_o']
+      v_o       = fields['v_o']
+      U_s       = as_vector([U[0] + fields['u_d'], U[1] + fields['v_d']])
+      control   = [fields['beta2']]
+      dSurf     = dx
+      dGrnd     = dx
+    
+    elif config['velocity']['approximation'] == 'fo':
       Q_adj     = model.Q2
       A         = (Vd + Pe)*dx + Sl*ds(3)
+      U_s       = U
     else:
       Q_adj     = model.Q4
       # Variational pinciple
       A         = (Vd + Pe + Pc + Lsq)*dx + Sl*ds(3) + Nc*ds(3)
+      U_s       = U
+
+    # the principle of the forward model holds its quadrature degrees :
+    if isinstance(velocity, (VelocityBP, VelocityStokes)):
+      A         = velocity.A
 
     L         = TrialFunction(Q_adj)
     Phi       = TestFunction(Q_adj)
@@ -1368,29 +2775,46 @@ class AdjointVelocityBP(object):
     R = 0
     for a,c in zip(alpha,control):
       N = FacetNormal(model.mesh)
-      if config['adjoint']['regularization_type'] == 'TV':
+      if self.ssa:
+        grad_c = c.dx(0)**2 + c.dx(1)**2
+        if config['adjoint']['regularization_type'] == 'TV':
+          R += a * sqrt(grad_c + 1e-3) * dGrnd
+        elif config['adjoint']['regularization_type'] == 'Tikhonov':
+          R += a * grad_c * dGrnd
+        else:
+          print 'Valid regularizations are \'TV\' and \'Tikhonov\'.'
+      elif config['adjoint']['regularization_type'] == 'TV':
         R += a * sqrt((c.dx(0)*N[2] - c.dx(1)*N[0])**2 + (c.dx(1)*N[2] - c.dx(2)*N[1])**2 + 1e-3) * ds(3)
       elif config['adjoint']['regularization_type'] == 'Tikhonov':
         R += a * ((c.dx(0)*N[2] - c.dx(1)*N[0])**2 + (c.dx(1)*N[2] - c.dx(2)*N[1])**2) * ds(3)
       else:
         print 'Valid regularizations are \'TV\' and \'Tikhonov\'.'
     
+    # weight of the misfit over the surface, such as the cellwise weights of
+    # utilities.CellBins :
+    weight = config['adjoint'].get('weight', Constant(1.0))
+
     #Objective function.  This is a least squares on the surface plus a 
     # regularization term penalizing wiggles in beta2
     if config['adjoint']['objective_function'] == 'logarithmic':
       if U_o is not None:
-        self.I = + ln( (sqrt(U[0]**2 + U[1]**2) + 1.0) / \
-                       (abs(U_o) + 1.0))**2 * ds(2) + R
+        self.I = + weight * ln( (sqrt(U_s[0]**2 + U_s[1]**2) + 1.0) / \
+                                (abs(U_o) + 1.0))**2 * dSurf + R
     
       else:
-        self.I = + ln( (sqrt(U[0]**2 + U[1]**2) + 1.0) / \
-                       (sqrt( u_o**2 +  v_o**2) + 1.0))**2 * ds(2) + R
+        self.I = + weight * ln( (sqrt(U_s[0]**2 + U_s[1]**2) + 1.0) / \
+                                (sqrt( u_o**2 +  v_o**2) + 1.0))**2 * dSurf + R
     
     elif config['adjoint']['objective_function'] == 'kinematic':
-      self.I = + 0.5 * (U[0]*S.dx(0) + U[1]*S.dx(1) - (U[2] + adot))**2 * ds(2) + R
+      self.I = + weight * 0.5 * (U[0]*S.dx(0) + U[1]*S.dx(1) - (U[2] + adot))**2 * ds(2) + R
+
+    # misfit to the PointObservations of config['adjoint']['observations'],
+    # whose derivatives make up the right-hand sides of the adjoint system :
+    elif config['adjoint']['objective_function'] == 'points':
+      self.I = R
 
     else:
-      self.I = + 0.5 * ((U[0] - u_o)**2 + (U[1] - v_o)**2) * ds(2) + R
+      self.I = + weight * 0.5 * ((U_s[0] - u_o)**2 + (U_s[1] - v_o)**2) * dSurf + R
     
     # Objective function constrained to obey the forward model
     I_adjoint  = self.I + F_adjoint
@@ -1404,25 +2828,355 @@ class AdjointVelocityBP(object):
     # it as a function.
     F_gradient = derivative(A, U, model.Lam)
 
+    # controls of the precomputed rate factor enter through its expression :
+    rate_factor = getattr(velocity, 'rate_factor', None)
+    replace_b   = rate_factor is not None and \
+                  any([c is f for c in control for f in 
+                       [model.T, model.W, model.E, model.S]])
+    if replace_b:
+      F_gradient = rate_factor.replace(F_gradient)
+
     # This is a scalar quantity when discretized, as it contains no test or 
     # trial functions
     I_gradient = self.I + F_gradient
 
     # Differentiation wrt to the control variable in the direction of a test 
     # function yields a vector.  Assembly of this vector yields dJ/dbeta2
-    self.J = []
+    self.I_gradient = I_gradient
+    self.J_forms    = []
     for c in control:
-      self.J.append(derivative(I_gradient, c, rho))
+      self.J_forms.append(derivative(I_gradient, c, rho))
+
+    # compile the adjoint system and gradient forms once :
+    self.a_adj = Form(lhs(self.dI))
+    self.L_adj = None
+    if config['adjoint']['objective_function'] != 'points':
+      self.L_adj = Form(rhs(self.dI))
+    self.J     = [Form(JJ) for JJ in self.J_forms]
+
+    # Second order adjoint.  The action of the Hessian of the reduced 
+    # objective in the direction dc is given by the tangent linear solution
+    # dU of the forward model and the second adjoint dLam, both of which 
+    # share the (symmetric) operator of the adjoint system :
+    self.dU    = Function(Q_adj)
+    self.dLam  = Function(Q_adj)
+    self.dc    = [Function(model.Q) for c in control]
+    self.H     = None
+    
+    self.A   = A
+    self.R   = R
+    self.obs = None
+    if config['adjoint']['objective_function'] == 'points':
+      self.obs = config['adjoint']['observations']
+    
+    if self.ssa:
+      return
+
+    F_U        = derivative(A, U, Phi)
+    I_U        = derivative(I_gradient, U, Phi)
+    if replace_b:
+      F_U      = rate_factor.replace(F_U)
+    
+    R_tlm      = 0
+    R_soa      = derivative(I_U, U, self.dU)
+    for c, dc in zip(control, self.dc):
+      R_tlm   += derivative(F_U, c, dc)
+      R_soa   += derivative(I_U, c, dc)
+    self.L_tlm = Form(-R_tlm)
+    self.L_soa = Form(-R_soa)
+    
+    # the Hessian of the misfit alone excludes the regularization :
+    self.H        = []
+    self.H_misfit = []
+    for c_j, JJ in zip(control, self.J_forms):
+      HH = derivative(JJ, U, self.dU) + derivative(JJ, model.Lam, self.dLam)
+      HR = 0
+      for c, dc in zip(control, self.dc):
+        HH += derivative(JJ, c, dc)
+        HR += derivative(derivative(R, c_j, rho), c, dc)
+      self.H.append(Form(HH))
+      self.H_misfit.append(Form(HH - HR))
+
+  def objective(self):
+    """
+    Returns the objective at the current forward state.
+    """
+    I = assemble(self.I)
+    if self.obs is not None:
+      I += self.obs.misfit(self.model.U)
+    return I
 
-  def solve(self):
+  def add_observations(self, b, g):
+    """
+    Subtract the array <g> of a derivative of the misfit to the point 
+    observations from the assembled right-hand side <b>.
+    """
+    b.set_local(b.array() - g)
+    b.apply('insert')
+
+  def assemble_operator(self, reuse_jacobian=True):
+    """
+    Returns the left-hand side of the adjoint system at the current 
+    forward state, to be passed on to :meth:`solve`.  This is the Jacobian
+    of the forward Newton solver if it may be reused, which it assembled 
+    at the solution after the forward solve, reassembled if the model has
+    been set to another state since, and is assembled otherwise.
+
+    :param reuse_jacobian : If False, always assemble the operator, e.g. 
+                            if the model holds the state of an older forward
+                            solve, so as to keep the forward Jacobian
+    """
+    self.update()
+    if reuse_jacobian and self.forward is not None \
+       and self.forward.problem.x is not None:
+      self.forward.problem.update_jacobian()
+      return self.forward.problem.A
+    return assemble(self.a_adj)
+
+  def update(self):
+    """
+    Update the footprint fields of the shallow shelf approximation from 
+    the model, which may hold a cached forward state.
+    """
+    if self.ssa:
+      self.velocity.update()
+
+  def gradient(self):
+    """
+    Returns the gradient of the objective with respect to each control, at
+    the current forward and adjoint state.
+
+    :rtype : list of assembled vectors, one for each control
+    """
+    if self.ssa:
+      return [self.velocity.to_model(assemble(JJ)) for JJ in self.J]
+    return [assemble(JJ) for JJ in self.J]
+
+  def solve(self, A=None):
     """
     Solves the bilinear residual created by differenciation of the 
     variational principle in combination with an objective function.
+
+    :param A : (Optional) adjoint operator previously returned by 
+               :meth:`assemble_operator` at the current forward state
     """
-    A = assemble(lhs(self.dI))
-    l = assemble(rhs(self.dI))
+    if A is None:
+      A = self.assemble_operator()
+    self.update()
+    if self.L_adj is not None:
+      l = assemble(self.L_adj)
+    else:
+      l = self.model.Lam.vector().copy()
+      l.zero()
+    if self.obs is not None:
+      self.add_observations(l, self.obs.gradient(self.model.U))
+    
+    self.solve_operator(A, self.model.Lam.vector(), l)
 
-    solve(A, self.model.Lam.vector(), l)
+  def is_forward_jacobian(self, A):
+    """
+    Returns True if the operator <A> is the Jacobian owned by the forward 
+    Newton solver, and therefore overwritten by the next forward solve.
+    """
+    return self.forward is not None and A is self.forward.problem.A
+
+  def solve_operator(self, A, x, b):
+    """
+    Solves the system with the adjoint operator <A> and right-hand side 
+    <b> into <x>, reusing the forward factorization if possible.
+    """
+    if self.is_forward_jacobian(A):
+      self.forward.problem.solve_transpose(x, b)
+    else:
+      solve(A, x, b)
+
+  def solve_tangent_linear(self, A=None):
+    """
+    Solves the tangent linear model for the velocity perturbation 
+    :attr:`dU` caused by the control perturbation currently held by 
+    :attr:`dc`.
+
+    :param A : (Optional) adjoint operator previously returned by 
+               :meth:`assemble_operator` at the current forward state
+    """
+    if A is None:
+      A = self.assemble_operator()
+    self.solve_operator(A, self.dU.vector(), assemble(self.L_tlm))
+
+  def hessian_action(self, A=None, misfit_only=False):
+    """
+    Returns the action of the Hessian of the objective with respect to 
+    each control in the direction currently held by :attr:`dc`.  This 
+    requires the forward state and the adjoint variable at the current 
+    control, and costs one tangent linear and one second adjoint solve.
+
+    :param A           : (Optional) adjoint operator previously returned by 
+                         :meth:`assemble_operator` at the current forward 
+                         state
+    :param misfit_only : If True, leave out the Hessian of the 
+                         regularization
+    :rtype             : list of assembled vectors, one for each control
+    """
+    if self.H is None:
+      raise NotImplementedError("The action of the Hessian is not " +
+                                "available for the shallow shelf " +
+                                "approximation.")
+    if A is None:
+      A = self.assemble_operator()
+    
+    # tangent linear model :
+    self.solve_tangent_linear(A)
+    
+    # second order adjoint :
+    l = assemble(self.L_soa)
+    if self.obs is not None:
+      self.add_observations(l, self.obs.hessian_action(self.dU))
+    self.solve_operator(A, self.dLam.vector(), l)
+
+    if misfit_only:
+      return [assemble(HH) for HH in self.H_misfit]
+    return [assemble(HH) for HH in self.H]
+
+
+class AdjointSensitivity(object):
+  r"""
+  Gradient of an arbitrary scalar functional :math:`G` of the first-order
+  velocity with respect to a number of model fields :math:`m`, computed 
+  with a single adjoint solve of the momentum balance :math:`F = 0` :
+
+  :Equation:
+     .. math::
+      \frac{dG}{dm} = \frac{\partial G}{\partial m} - \lambda^T 
+      \frac{\partial F}{\partial m}, \hspace{10mm}
+      \left(\frac{\partial F}{\partial \textbf{u}}\right)^T \lambda = 
+      \frac{\partial G}{\partial \textbf{u}}
+
+  :math:`G` is a UFL functional of model.U and, optionally, of the vertical
+  velocity model.w, such as the flux across a gate or the mean surface 
+  speed.  The fields enter through the equations, the mesh geometry is 
+  held fixed.  If the enthalpy instance is given and the viscosity depends
+  on temperature, the path through temperature and water content (and 
+  thereby the geothermal heat flux q_geo) is included by one adjoint 
+  enthalpy solve, neglecting the feedback of the velocity on the enthalpy.
+
+  :param model    : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config   : Dictionary object containing information on physical 
+                    attributes such as velocties, age, and surface climate
+  :param G        : Scalar UFL form of the diagnostic
+  :param velocity : :class:`VelocityBP` instance that solves the forward 
+                    model
+  :param enthalpy : (Optional) :class:`Enthalpy` instance
+  :param fields   : (Optional) list of the names of the model fields to 
+                    differentiate with respect to
+  """
+  def __init__(self, model, config, G, velocity, enthalpy=None, 
+               fields=['beta2', 'E', 'q_geo', 'S', 'B']):
+    """ Setup. """
+    self.model    = model
+    self.config   = config
+    self.fields   = fields
+    
+    Q         = model.Q
+    Q2        = model.Q2
+    U         = model.U
+    w         = model.w
+    B         = model.B
+    dBase     = model.ds(3)
+    u, v      = split(U)
+    Phi       = TestFunction(Q2)
+    chi       = TestFunction(Q)
+    dw        = TrialFunction(Q)
+
+    self.Lam  = Function(Q2)
+    self.mu_w = Function(Q)
+    self.mu_H = Function(Q)
+    
+    def depends(form, f):
+      return form != 0 and f in form.coefficients()
+
+    # adjoint of the vertical velocity, if the diagnostic depends on it :
+    F_w  = + (u.dx(0) + v.dx(1) + w.dx(2))*chi*dx \
+           - (u*B.dx(0) + v*B.dx(1) - w)*chi*dBase
+    L_w  = action(F_w, self.mu_w)
+    if depends(G, w):
+      self.a_w = Form(adjoint(derivative(F_w, w, dw)))
+      self.g_w = Form(derivative(G, w, chi))
+    else:
+      self.a_w = None
+      L_w      = 0
+
+    # adjoint of the momentum balance :
+    L_U      = derivative(model.A, U, self.Lam)
+    if getattr(velocity, 'rate_factor', None) is not None:
+      L_U    = velocity.rate_factor.replace(L_U)
+    self.a_U = Form(velocity.J)
+    self.g_U = Form(derivative(G, U, Phi) - derivative(L_w, U, Phi) 
+                    if depends(L_w, U) else derivative(G, U, Phi))
+
+    # adjoint of the enthalpy through the temperature dependent rate factor:
+    L_H = 0
+    if enthalpy is not None and depends(L_U, model.T):
+      self.a_H  = Form(adjoint(enthalpy.a))
+      self.g_T  = Form(derivative(G - L_U, model.T, chi))
+      self.g_W  = Form(derivative(G - L_U, model.W, chi))
+      self.bc_H = [DirichletBC(Q, 0.0, model.ff, 2)]
+      if config.get('enthalpy', {}).get('lateral_boundaries') is not None:
+        self.bc_H.append(DirichletBC(Q, 0.0, model.ff, 4))
+      L_H       = action(action(enthalpy.a, model.H), self.mu_H) \
+                  - action(enthalpy.L, self.mu_H)
+    self.enthalpy = enthalpy if L_H != 0 else None
+    
+    # gradient with respect to each field :
+    self.g = OrderedDict()
+    for name in fields:
+      f   = getattr(model, name)
+      rho = TestFunction(f.function_space())
+      g   = None
+      for L, sign in [(G, 1), (L_U, -1), (L_w, -1), (L_H, -1)]:
+        if depends(L, f):
+          dL = derivative(L, f, rho) if sign > 0 else -derivative(L, f, rho)
+          g  = dL if g is None else g + dL
+      self.g[name] = Form(g) if g is not None else None
+
+  def solve(self):
+    """
+    Solves the adjoint systems at the current forward state.
+
+    :rtype : OrderedDict of Functions holding the gradient of the 
+             diagnostic with respect to the coefficients of each field
+    """
+    model = self.model
+
+    if self.a_w is not None:
+      solve(assemble(self.a_w), self.mu_w.vector(), assemble(self.g_w))
+    solve(assemble(self.a_U), self.Lam.vector(), assemble(self.g_U))
+    
+    if self.enthalpy is not None:
+      # derivatives of the temperature and water content wrt enthalpy, 
+      # where they are not held at the pressure melting point or limits :
+      H     = model.H.vector().get_local()
+      h_i   = project(model.h_i, model.Q).vector().get_local()
+      W     = (H - h_i) / float(model.L)
+      cold  = (H < h_i).astype('float')
+      wet   = ((W > 0) & (W < 0.01)).astype('float')
+      g_H   = + cold * assemble(self.g_T).get_local() / float(model.C) \
+              + wet  * assemble(self.g_W).get_local() / float(model.L)
+      
+      b = self.mu_H.vector().copy()
+      b.set_local(g_H)
+      b.apply('insert')
+      A = assemble(self.a_H)
+      for bc in self.bc_H:
+        bc.apply(A, b)
+      solve(A, self.mu_H.vector(), b)
+
+    grads = OrderedDict()
+    for name, g in self.g.items():
+      f           = getattr(model, name)
+      grads[name] = Function(f.function_space())
+      if g is not None:
+        grads[name].vector()[:] = assemble(g)
+    return grads
 
 
 class SurfaceClimate(object):
@@ -1466,7 +3220,8 @@ class Age(object):
 
   This equation, however, is numerically challenging due to its being 
   hyperbolic.  This is addressed by using a streamline upwind Petrov 
-  Galerkin (SUPG) weighting.
+  Galerkin (SUPG) weighting, with the quadrature degree of the 'supg' 
+  integrals given by config['age']['quadrature_degree'] if set.
   
   :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
   :param config : Dictionary object containing information on physical 
@@ -1484,6 +3239,10 @@ class Age(object):
     a   = TrialFunction(model.Q)
     phi = TestFunction(model.Q)
 
+    # quadrature degree of the SUPG integrals :
+    q_deg = config['age'].get('quadrature_degree', {})
+    dx_a  = set_quadrature_degree(dx, q_deg.get('supg'))
+
     # Steady state
     if config['mode'] == 'steady':
       # SUPG method :
@@ -1496,7 +3255,7 @@ class Age(object):
       R = dot(U,grad(a)) - 1.0
 
       # Weak form of residual
-      self.F = R * phihat * dx
+      self.F = R * phihat * dx_a
 
     else:
       # Starting and midpoint quantities
@@ -1520,9 +3279,39 @@ class Age(object):
       a_mid = 0.5*(a + self.ahat)
       
       # Weak form of time dependent residual
-      self.F = + (a - a0)/dt * phi * dx \
-               + dot(U, grad(a_mid)) * phihat * dx \
-               - 1.0 * phihat * dx
+      self.F = + (a - a0)/dt * phi * dx_a \
+               + dot(U, grad(a_mid)) * phihat * dx_a \
+               - 1.0 * phihat * dx_a
+
+    # zero age on the boundary above the ELA, marked on the first solve :
+    self.facet_vertices = None
+    self.ela_markers    = None
+    self.bc_age         = None
+
+  def update_boundary_condition(self):
+    """
+    Marks the exterior facets whose midpoint is above the ELA 
+    config['age']['ela'] in :attr:`ela_markers`, and sets the zero age 
+    condition :attr:`bc_age` on them.  The condition is only rebuilt if 
+    the marked facets have changed, e.g. as the mesh is deformed by the 
+    free surface.
+    """
+    model = self.model
+    mesh  = model.mesh
+    
+    # the vertices of the facets do not change with the mesh coordinates :
+    if self.facet_vertices is None:
+      self.facet_vertices = numpy.array([f.entities(0) 
+                                         for f in facets(mesh)])
+      self.ela_markers    = FacetFunction('size_t', mesh, 0)
+    
+    z_mid = mesh.coordinates()[self.facet_vertices, 2].mean(axis=1)
+    above = (model.ff.array() != 0) & (z_mid > self.config['age']['ela'])
+    above = above.astype(self.ela_markers.array().dtype)
+    
+    if self.bc_age is None or (above != self.ela_markers.array()).any():
+      self.ela_markers.array()[:] = above
+      self.bc_age = DirichletBC(model.Q, 0.0, self.ela_markers, 1)
 
   def solve(self, ahat=None, a0=None, uhat=None, what=None, vhat=None):
     """ 
@@ -1545,17 +3334,19 @@ class Age(object):
       model.what.vector()[:] = what.vector().array()
       model.vhat.vector()[:] = vhat.vector().array()
 
-    def above_ela(x,on_boundary):
-      return (x[2]>config['age']['ela']) and on_boundary
-
-    self.bc_age = DirichletBC(model.Q, 0, model.ff, above_ela)
+    self.update_boundary_condition()
 
     # Solve!
     solve(lhs(self.F) == rhs(self.F), model.A, self.bc_age)
 
 
 class VelocityBalance(object):
-  
+  """
+  Balance velocity of the upper surface of <model>.  The smoothed driving
+  stress and the SUPG flux balance are solved on a planar mesh of the
+  surface facets, and the results are copied back to the 3D functions of
+  <model> with the cached vertex-dof index of the surface.
+  """
   def __init__(self, model, config):
     
     self.model  = model
@@ -1563,88 +3354,121 @@ class VelocityBalance(object):
     
     kappa       = config['balance_velocity']['kappa']
     smb         = config['balance_velocity']['smb']
-    g           = model.g
-    rho         = model.rho
-
-    flat_mesh   = model.flat_mesh
-    Q_flat      = model.Q_flat
-    B           = model.B.vector().get_local()
-    S           = model.S.vector().get_local()
-    dSdx        = model.dSdx
-    dSdy        = model.dSdy
-    U           = model.U
-
-    phi         = TestFunction(Q_flat)
-    dU          = TrialFunction(Q_flat)
+    g           = model.get_constant('g')
+    rho         = model.get_constant('rho')
+    # planar surface mesh and the 3D dofs under each of its dofs :
+    surface, v_map = extract_surface_mesh(model.mesh, model.ff, 2)
+    Q_s         = FunctionSpace(surface, 'CG', 1)
+    s_dofs      = get_vertex_dofs(Q_s)
+    self.Q_s    = Q_s
+    self.s_dofs = s_dofs
+    self.Q_dofs = get_vertex_dofs(model.Q)[v_map]
+    self.f_dofs = get_vertex_dofs(model.Q_flat)[v_map]
+
+    phi         = TestFunction(Q_s)
+    dU          = TrialFunction(Q_s)
                 
-    Nx          = TrialFunction(Q_flat)
-    Ny          = TrialFunction(Q_flat)
-    H_          = Function(Q_flat)
-    S_          = Function(Q_flat)
-    smb_        = project(smb, Q_flat)
-    
-    ds          = model.ds
-    
-    H_.vector().set_local(S - B)
-    S_.vector().set_local(S)
+    Nx          = TrialFunction(Q_s)
+    Ny          = TrialFunction(Q_s)
+    H_          = Function(Q_s)
+    S_          = Function(Q_s)
+    dSdx        = Function(Q_s)
+    dSdy        = Function(Q_s)
+    U           = Function(Q_s)
+    if isinstance(smb, Function):
+      smb_      = self.to_surface(smb, self.Q_dofs)
+    else:
+      smb_      = interpolate(smb, Q_s)
 
-    R_dSdx = + Nx * phi * ds(2) \
-             - rho * g * H_ * S_.dx(0) * phi * ds(2) \
-             + (l*H_)**2 * (phi.dx(0)*Nx.dx(0) + phi.dx(1)*Nx.dx(1)) * ds(2)
-    R_dSdy = + Ny * phi * ds(2) \
-             - rho * g * H_ * S_.dx(1) * phi*ds(2) \
-             + (l*H_)**2 * (phi.dx(0)*Ny.dx(0) + phi.dx(1)*Ny.dx(1)) * ds(2)
+    R_dSdx = + Nx * phi * dx \
+             - rho * g * H_ * S_.dx(0) * phi * dx \
+             + (kappa*H_)**2 * (phi.dx(0)*Nx.dx(0) + phi.dx(1)*Nx.dx(1)) * dx
+    R_dSdy = + Ny * phi * dx \
+             - rho * g * H_ * S_.dx(1) * phi * dx \
+             + (kappa*H_)**2 * (phi.dx(0)*Ny.dx(0) + phi.dx(1)*Ny.dx(1)) * dx
 
     slope  = sqrt(dSdx**2 + dSdy**2) + 1e-5
     dS     = as_vector([-dSdx/slope, -dSdy/slope])
     
-    def inside(x,on_boundary):
-      return on_boundary
-    
     # SUPG method :
-    h      = CellSize(flat_mesh)
+    h      = CellSize(surface)
     U_eff  = sqrt(dot(dS*H_, dS*H_))
     tau    = h/(2.0 * U_eff)
     
     term1  = phi + tau*(Dx(H_*phi*dS[0], 0) + Dx(H_*phi*dS[1], 1))
     term2  = Dx(dU*dS[0]*H_, 0) + Dx(dU*dS[1]*H_, 1) - smb_
-    dI     = term1 * term2 * ds(2)
+    dI     = term1 * term2 * dx
     
     self.R_dSdx = R_dSdx
     self.R_dSdy = R_dSdy
     self.dI     = dI
     self.dS     = dS
+    self.H_     = H_
+    self.S_     = S_
+    self.dSdx   = dSdx
+    self.dSdy   = dSdy
+    self.U      = U
+    self.lsc    = LinearSolveCache()
+
+  def to_surface(self, f, dofs, g=None):
+    """
+    Copy the surface values of the 3D function <f> into the function <g> of
+    the surface mesh, with <dofs> the dofs of <f> under the surface dofs.
+    """
+    if g is None:
+      g = Function(self.Q_s)
+    v = numpy.zeros(self.Q_s.dim())
+    v[self.s_dofs] = f.vector().get_local()[dofs]
+    g.vector().set_local(v)
+    g.vector().apply('insert')
+    return g
+
+  def to_model(self, g, f, dofs):
+    """
+    Copy the values of the surface function <g> into the 3D function <f>,
+    with <dofs> the dofs of <f> under the surface dofs.  The values of <f>
+    off the surface are set to zero.
+    """
+    v = numpy.zeros(f.function_space().dim())
+    v[dofs] = g.vector().get_local()[self.s_dofs]
+    f.vector().set_local(v)
+    f.vector().apply('insert')
 
   def solve(self):
-    U    = self.model.U
-    dSdx = self.model.dSdx
-    dSdy = self.model.dSdy
-
-    a_x  = assemble(lhs(self.R_dSdx))
-    a_x.ident_zeros()
-    L_x  = assemble(rhs(self.R_dSdx))
-
-    a_y  = assemble(lhs(self.R_dSdy))
-    a_y.ident_zeros()
-    L_y  = assemble(rhs(self.R_dSdy))
+    model = self.model
+    H_    = self.H_
+    S_    = self.S_
 
-    solve(a_x, dSdx.vector(), L_x)
-    solve(a_y, dSdy.vector(), L_y)
+    self.to_surface(model.S, self.Q_dofs, S_)
+    self.to_surface(model.B, self.Q_dofs, H_)
+    H_.vector().set_local(S_.vector().get_local() - H_.vector().get_local())
+    H_.vector().apply('insert')
 
-    a_U  = assemble(lhs(self.dI))
-    a_U.ident_zeros()
-    L_U  = assemble(rhs(self.dI))
+    # the smoothing operators depend on H_, so are factorized once per solve :
+    self.lsc.clear()
+    self.lsc.solve(lhs(self.R_dSdx), rhs(self.R_dSdx), self.dSdx)
+    self.lsc.solve(lhs(self.R_dSdy), rhs(self.R_dSdy), self.dSdy)
+    solve(lhs(self.dI) == rhs(self.dI), self.U)
 
-    solve(a_U, U.vector(), L_U)
-    u_b = project(U * self.dS[0])
-    v_b = project(U * self.dS[1])
-    self.model.u_balance.vector().set_local(u_b.vector().get_local())
-    self.model.v_balance.vector().set_local(v_b.vector().get_local())
+    u_b = project(self.U * self.dS[0], self.Q_s)
+    v_b = project(self.U * self.dS[1], self.Q_s)
+    
+    self.to_model(self.dSdx, model.dSdx,      self.f_dofs)
+    self.to_model(self.dSdy, model.dSdy,      self.f_dofs)
+    self.to_model(self.U,    model.U,         self.f_dofs)
+    self.to_model(u_b,       model.u_balance, self.Q_dofs)
+    self.to_model(v_b,       model.v_balance, self.Q_dofs)
     
 
 class VelocityBalance_2(object):
-
-  def __init__(self, mesh, H, S, adot, l,dhdt=0.0, Uobs=None,Uobs_mask=None,N_data = None,NO_DATA=-9999,alpha=[0.0,0.0,0.0,0.]):
+  """
+  Balance velocity of a 2D <mesh> with its adjoint and the gradients of the
+  objective with respect to Uobs, adot, H and dS[1].  The smoothing solves 
+  and the compilation of all forms happen once, at construction; 
+  solve_forward, solve_adjoint and get_gradient only reassemble into 
+  preallocated tensors and solve.
+  """
+  def __init__(self, mesh, H, S, adot, l,dhdt=0.0, Uobs=None,Uobs_mask=None,N_data = None,NO_DATA=-9999,alpha=[0.0,0.0,0.0,0.],Uobs_weight=None):
 
     set_log_level(PROGRESS)
 
@@ -1686,8 +3510,10 @@ class VelocityBalance_2(object):
     R_dSdy = + (Ny*phi - rho*g*H*S.dx(1) * phi \
              + (kappa*H)**2 * dot(grad(phi), grad(Ny))) * dx
     
-    solve(lhs(R_dSdx) == rhs(R_dSdx), dSdx)
-    solve(lhs(R_dSdy) == rhs(R_dSdy), dSdy)
+    # both components share the smoothing operator :
+    lsc = LinearSolveCache()
+    lsc.solve(lhs(R_dSdx), rhs(R_dSdx), dSdx)
+    lsc.solve(lhs(R_dSdy), rhs(R_dSdy), dSdy)
 
     # Replace values of slope that are known
     # I don't think this works in parallel, but it works for now...
@@ -1710,19 +3536,14 @@ class VelocityBalance_2(object):
     R_dSdy = + (Ny*phi - dSdy * phi \
              + (kappa*H)**2 * dot(grad(phi), grad(Ny))) * dx
     
-    solve(lhs(R_dSdx) == rhs(R_dSdx), dSdx2)
-    solve(lhs(R_dSdy) == rhs(R_dSdy), dSdy2)
+    lsc.solve(lhs(R_dSdx), rhs(R_dSdx), dSdx2)
+    lsc.solve(lhs(R_dSdy), rhs(R_dSdy), dSdy2)
 
     slope = project(sqrt(dSdx2**2 + dSdy2**2) + 1e-10, Q)
 
     dS = as_vector([project(-dSdx2 / slope, Q),
                         project(-dSdy2 / slope, Q)])
    
-    def inside(x,on_boundary):
-      return on_boundary
-       
-    dbc = DirichletBC(Q, 0.0, inside)
-    
     # test function :
     phi = TestFunction(Q)
     
@@ -1732,12 +3553,17 @@ class VelocityBalance_2(object):
 
     adot_0 = adot.copy()
 
+    # per-cell weights of the misfit, such as those of utilities.CellBins :
+    if Uobs_weight is None:
+      Uobs_weight = Constant(1.0)
+
     if Uobs_mask:
         dx_masked = Measure('dx')[Uobs_mask]
-        self.I = ln(abs(Ubmag+1.)/abs(Uobs+1.))**2*dx_masked(1) + alpha[0]*dot(grad(Uobs),grad(Uobs))*dx + alpha[1]*dot(grad(adot-adot_0),grad(adot-adot_0))*dx + alpha[2]*dot(grad(H),grad(H))*dx+ alpha[3]*dot(grad(dS[1]),grad(dS[1]))*dx
+        self.I = Uobs_weight*ln(abs(Ubmag+1.)/abs(Uobs+1.))**2*dx_masked(1) + alpha[0]*dot(grad(Uobs),grad(Uobs))*dx + alpha[1]*dot(grad(adot-adot_0),grad(adot-adot_0))*dx + alpha[2]*dot(grad(H),grad(H))*dx+ alpha[3]*dot(grad(dS[1]),grad(dS[1]))*dx
         #self.I = (Ubmag - Uobs)**2*dx_masked(1) + alpha[0]*dot(grad(Uobs),grad(Uobs))*dx + alpha[1]*dot(grad(adot-adot_0),grad(adot-adot_0))*dx + alpha[2]*dot(grad(H),grad(H))*dx
     else:
-        self.I = ln(abs(Ubmag+1.)/abs(Uobs+1.))**2*dx + alpha[0]*dot(grad(Uobs),grad(Uobs))*dx + alpha[1]*dot(grad(adot-adot_0),grad(adot - adot_0))*dx + alpha[2]*dot(grad(H),grad(H))*dx
+        dx_masked = dx
+        self.I = Uobs_weight*ln(abs(Ubmag+1.)/abs(Uobs+1.))**2*dx + alpha[0]*dot(grad(Uobs),grad(Uobs))*dx + alpha[1]*dot(grad(adot-adot_0),grad(adot - adot_0))*dx + alpha[2]*dot(grad(H),grad(H))*dx
     
     self.forward_model = (phi + tau*div(H*dS*phi)) * (div(dUbmag*dS*H) - adot + dhdt) * dx
 
@@ -1745,16 +3571,38 @@ class VelocityBalance_2(object):
 
     self.I += (lamda + tau*div(H*dS*lamda)) * (div(Ubmag*dS*H) - adot + dhdt) * dx
 
-    # Switch to use AD for the gradients:
-    self.g_Uobs = derivative(self.I,Uobs,phi)
-    self.g_adot = derivative(self.I,adot,phi)
-    self.g_H    = derivative(self.I,H,phi)
-    self.g_N    = derivative(self.I,dS[1],phi)
+    # Switch to use AD for the gradients, fused into one assembly over the 
+    # mixed space of the four controls Uobs, adot, H and dS[1] :
+    Q4   = MixedFunctionSpace([Q]*4)
+    psi  = TestFunction(Q4)
+    self.g = + derivative(self.I,Uobs,psi[0]) \
+             + derivative(self.I,adot,psi[1]) \
+             + derivative(self.I,H,psi[2]) \
+             + derivative(self.I,dS[1],psi[3])
 
     # Gradients computed by hand.
     #self.g_adot = -(lamda + tau*div(lamda*dS*H))*phi*dx + 2.*alpha[1]*dot(grad(adot),grad(phi))*dx
     #self.g_H = (lamda + tau*div(lamda*dS*H))*div(Ubmag*dS*phi)*dx + tau*div(lamda*dS*phi)*(div(Ubmag*dS*H) - adot + dhdt)*dx + 2.*alpha[2]*dot(grad(H),grad(phi))*dx
 
+    # mixed space dof of each dof of Q, for each control :
+    q_dofs = get_vertex_dofs(Q)
+    self.g_dofs = []
+    for i in range(4):
+      g_dofs = numpy.zeros(Q.dim(), dtype=int)
+      g_dofs[q_dofs] = get_vertex_dofs(Q4.sub(i))
+      self.g_dofs.append(g_dofs)
+
+    # compiled forms and preallocated tensors, reused by every solve :
+    self.a_forward = Form(lhs(self.forward_model))
+    self.L_forward = Form(rhs(self.forward_model))
+    self.a_adjoint = Form(lhs(self.adjoint_model))
+    self.L_adjoint = Form(rhs(self.adjoint_model))
+    self.I_form    = Form(self.I)
+    self.g_form    = Form(self.g)
+    self.A         = None
+    self.b         = None
+    self.g_vec     = None
+    self.solver    = LUSolver()
 
     self.H = H
     self.S = S
@@ -1766,7 +3614,6 @@ class VelocityBalance_2(object):
     self.dSdy = dSdy
     self.Ubmag = Ubmag
     self.lamda = lamda
-    self.dbc = dbc
     self.slope = slope
     self.residual = Ubmag*div(dS*H) - adot
     self.residual = project(self.residual, Q)
@@ -1788,25 +3635,44 @@ class VelocityBalance_2(object):
       self.dS[0].vector().set_local(nx)
       self.dS[1].vector().set_local(ny)
 
+  def solve_linear(self, a, L, x):
+    """
+    Assemble the compiled forms <a> and <L> into the preallocated matrix 
+    and vector, and solve for the vector <x>.
+    """
+    if self.A is None:
+      self.A = assemble(a)
+      self.b = assemble(L)
+    else:
+      assemble(a, tensor=self.A, reset_sparsity=False)
+      assemble(L, tensor=self.b, reset_sparsity=False)
+    self.solver.set_operator(self.A)
+    self.solver.solve(x, self.b)
 
   def solve_forward(self):
     # solve linear problem :
     self.update_velocity_directions()
-    solve(lhs(self.forward_model) == rhs(self.forward_model), self.Ubmag)
+    self.solve_linear(self.a_forward, self.L_forward, self.Ubmag.vector())
     self.Ubmag.vector()[self.Ubmag.vector().array()<0] = 0.0
 
   def solve_adjoint(self):
     self.update_velocity_directions()
     self.Uobs.vector()[self.Uobs.vector().array()<0] = 0.0
-    solve(lhs(self.adjoint_model) == rhs(self.adjoint_model), self.lamda)
+    self.solve_linear(self.a_adjoint, self.L_adjoint, self.lamda.vector())
+
+  def objective(self):
+    """
+    Returns the value of the objective functional.
+    """
+    return assemble(self.I_form)
    
   def get_gradient(self):
-    gU = assemble(self.g_Uobs)
-    gH = assemble(self.g_H)
-    gN = assemble(self.g_N)
-    ga = assemble(self.g_adot)
+    if self.g_vec is None:
+      self.g_vec = assemble(self.g_form)
+    else:
+      assemble(self.g_form, tensor=self.g_vec, reset_sparsity=False)
+    g = self.g_vec.array()
     #return ((gU.array() / linalg.norm(gU.array()) , ga.array() / linalg.norm(ga.array()),\
     #         gH.array() / linalg.norm(gH.array()) , gN.array() / linalg.norm(gN.array())))
 
-    return ((gU.array() , ga.array() ,\
-             gH.array() , gN.array() ))
+    return tuple(g[g_dofs] for g_dofs in self.g_dofs)
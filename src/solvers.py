@@ -1,7 +1,19 @@
-from pylab          import *
-from dolfin         import *
-from physics        import *
-from scipy.optimize import fmin_l_bfgs_b
+from pylab           import *
+from dolfin          import *
+from physics         import *
+from scipy.optimize  import fmin_l_bfgs_b
+from collections     import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from helper          import MeshHierarchy
+import hashlib
+import json
+import numpy
+import os
+import subprocess
+import sys
+import time
+import traceback
 
 class SteadySolver(object):
   """
@@ -31,8 +43,14 @@ class SteadySolver(object):
       elif config['velocity']['approximation'] == 'stokes':
         self.velocity_instance = VelocityStokes(model, config)
       
+      elif config['velocity']['approximation'] == 'sia':
+        self.velocity_instance = VelocitySIA(model, config)
+      
+      elif config['velocity']['approximation'] in ['ssa', 'hybrid']:
+        self.velocity_instance = VelocitySSA(model, config)
+      
       else:
-        print "Please use 'fo' or 'stokes'. "
+        print "Please use 'fo', 'stokes', 'sia', 'ssa' or 'hybrid'. "
     
     # enthalpy model :
     if config['enthalpy']['on']:
@@ -156,8 +174,14 @@ class TransientSolver(object):
       elif self.config['velocity']['approximation'] == 'stokes':
         self.velocity_instance = VelocityStokes(model, config)
       
+      elif self.config['velocity']['approximation'] == 'sia':
+        self.velocity_instance = VelocitySIA(model, config)
+      
+      elif self.config['velocity']['approximation'] in ['ssa', 'hybrid']:
+        self.velocity_instance = VelocitySSA(model, config)
+      
       else:
-        print "Please choose 'fo' or 'stokes'. "
+        print "Please choose 'fo', 'stokes', 'sia', 'ssa' or 'hybrid'. "
     
     # initialized enthalpy solver : 
     if self.config['enthalpy']['on']:
@@ -312,6 +336,443 @@ class TransientSolver(object):
       t          += dt
       self.step_time.append(time.time() - tic)
 
+def binomial(n, k):
+  """
+  Returns the binomial coefficient n! / (k! (n-k)!).
+  """
+  b = 1
+  for i in range(min(k, n-k)):
+    b = b * (n - i) / (i + 1)
+  return b
+
+
+class CheckpointStore(object):
+  """
+  Holds the surface at the checkpointed time steps of a 
+  :class:`TransientAdjointSolver`, in memory or, if <path> is given, as 
+  numpy files in that directory.
+
+  :param path : (Optional) directory to write the checkpoints to
+  """
+  def __init__(self, path=None):
+    self.path   = path
+    self.states = {}
+    if path is not None and not os.path.exists(path):
+      os.makedirs(path)
+
+  def filename(self, n):
+    """
+    Returns the file holding the checkpoint of time step <n>.
+    """
+    name = 'checkpoint_%i_%i.npy' % (MPI.process_number(), n)
+    return os.path.join(self.path, name)
+
+  def save(self, n, state):
+    """
+    Store the array <state> as the checkpoint of time step <n>.
+    """
+    if self.path is None:
+      self.states[n] = state.copy()
+    else:
+      numpy.save(self.filename(n), state)
+      self.states[n] = None
+
+  def load(self, n):
+    """
+    Returns the checkpoint of time step <n>.
+    """
+    if self.path is None:
+      return self.states[n].copy()
+    return numpy.load(self.filename(n))
+
+  def delete(self, n):
+    """
+    Free the checkpoint of time step <n>.
+    """
+    del self.states[n]
+    if self.path is not None:
+      os.remove(self.filename(n))
+
+  def clear(self):
+    """
+    Free all checkpoints.
+    """
+    for n in self.states.keys():
+      self.delete(n)
+
+
+class TransientAdjointSolver(object):
+  """
+  Computes the gradient of the time-integrated misfit of a transient run 
+  of the free surface and the first-order velocity with respect to the 
+  basal traction beta2 or the surface mass balance smb, by the discrete 
+  adjoint :class:`~src.physics.AdjointFreeSurface` stepped backwards in 
+  time.  The misfit is integrated with the trapezoidal rule over the 
+  states of the time steps from config['t_start'] to config['t_end'].
+
+  Rather than storing the surface of every time step, the reverse sweep 
+  uses binomial (revolve) checkpointing : with s checkpoints besides the 
+  initial state, N time steps are reversed with at most r forward 
+  recomputations of any step, where r is the smallest number such that
+  (s + r)! / (s! r!) >= N.  The config['transient_adjoint'] dictionary 
+  holds the keys
+
+    'control_variable'   : model.beta2 or model.smb
+    'objective_function' : 'surface' or 'dhdt'
+    'observation'        : function of time returning the observed surface
+                           or rate of surface change as Expression or 
+                           Function
+    'checkpoints'        : (Optional) number of checkpoints s
+    'memory_budget'      : (Optional) memory in MB for the checkpoints, 
+                           used if 'checkpoints' is not given
+    'checkpoint_path'    : (Optional) directory to hold the checkpoints 
+                           instead of memory
+
+  :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config : Dictionary object containing information on physical 
+	                attributes such as velocties, age, and surface climate
+  """
+  def __init__(self, model, config):
+    """
+    Initialize the velocity and the adjoint of the time step.
+    """
+    self.model  = model
+    self.config = config
+    
+    if config['velocity']['approximation'] != 'fo':
+      raise ValueError("The transient adjoint requires the 'fo' velocity.")
+    
+    self.velocity_instance = VelocityBP(model, config)
+    self.adjoint_instance  = AdjointFreeSurface(model, config, 
+                                                self.velocity_instance)
+    
+    path          = config['transient_adjoint'].get('checkpoint_path')
+    self.store    = CheckpointStore(path)
+    self.counters = {'forward_steps' : 0, 'adjoint_steps' : 0}
+
+  def get_n_steps(self):
+    """
+    Returns the number of time steps of the run.
+    """
+    config = self.config
+    return int(round((config['t_end'] - config['t_start']) / 
+                     config['time_step']))
+
+  def get_n_checkpoints(self):
+    """
+    Returns the number of checkpoints besides the initial state, from 
+    'checkpoints' or the 'memory_budget' of config['transient_adjoint'].
+    """
+    params = self.config['transient_adjoint']
+    n      = self.get_n_steps()
+    if params.get('checkpoints') is not None:
+      s = params['checkpoints']
+    elif params.get('memory_budget') is not None:
+      size = 8 * len(self.model.S.vector().get_local())
+      s    = int(params['memory_budget'] * 1024**2 / size) - 1
+    else:
+      s = n
+    return max(0, min(s, n))
+
+  def set_state(self, S):
+    """
+    Set the surface to the array <S> and fit the mesh to it.
+    """
+    self.model.S.vector().set_local(S)
+    self.model.S.vector().apply('insert')
+    self.adjoint_instance.deform_mesh()
+
+  def get_state(self):
+    """
+    Returns the array of the current surface.
+    """
+    return self.model.S.vector().get_local()
+
+  def set_step(self, n):
+    """
+    Set the observation and quadrature weight of time step <n>.
+    """
+    config = self.config
+    adj    = self.adjoint_instance
+    N      = self.get_n_steps()
+    adj.set_observation(config['t_start'] + n*config['time_step'])
+    if n == 0 or n == N:
+      adj.weight.assign(0.5)
+    else:
+      adj.weight.assign(1.0)
+
+  def advance(self, a, b):
+    """
+    Advance the surface from time step <a> to time step <b>.
+    """
+    for n in range(a, b):
+      self.adjoint_instance.solve_forward()
+      self.adjoint_instance.update_surface()
+      self.counters['forward_steps'] += 1
+
+  def adjoint_step(self, n, g_S):
+    """
+    Recompute the time step <n> from the current surface and solve its 
+    adjoint, given the derivative <g_S> of the later objective with 
+    respect to the next surface.  Returns the derivative with respect to 
+    the current surface.
+    """
+    adj = self.adjoint_instance
+    self.set_step(n)
+    adj.solve_forward()
+    
+    self.I   += assemble(adj.I)
+    g_S, g_c  = adj.solve(g_S)
+    self.g_c += g_c.get_local()
+    self.counters['adjoint_steps'] += 1
+    return g_S
+
+  def reverse(self, a, b, s, g_S):
+    """
+    Reverse the time steps <a> to <b> - 1, the surface of step <a> being 
+    checkpointed, with <s> free checkpoints, given the derivative <g_S> of 
+    the objective of the later steps with respect to the surface of step 
+    <b>.  Returns the derivative with respect to the surface of step <a>.
+    """
+    l = b - a
+    
+    if l == 1:
+      self.set_state(self.store.load(a))
+      return self.adjoint_step(a, g_S)
+    
+    # without checkpoints, recompute every step from the first one :
+    if s == 0:
+      for n in range(b-1, a-1, -1):
+        self.set_state(self.store.load(a))
+        self.advance(a, n)
+        g_S = self.adjoint_step(n, g_S)
+      return g_S
+    
+    # binomial split with r recomputations :
+    r = 1
+    while binomial(s + r, s) < l:
+      r += 1
+    m = a + max(1, l - binomial(s - 1 + r, s - 1))
+    
+    self.set_state(self.store.load(a))
+    self.advance(a, m)
+    self.store.save(m, self.get_state())
+    g_S = self.reverse(m, b, s - 1, g_S)
+    self.store.delete(m)
+    return self.reverse(a, m, s, g_S)
+
+  def objective(self):
+    """
+    Returns the time-integrated misfit of a forward run from the current 
+    surface, which is restored afterwards.
+    """
+    adj = self.adjoint_instance
+    S_0 = self.get_state()
+    N   = self.get_n_steps()
+    I   = 0.0
+    for n in range(N + 1):
+      self.set_step(n)
+      adj.solve_forward()
+      I += assemble(adj.I)
+      if n < N:
+        adj.update_surface()
+    self.set_state(S_0)
+    return I
+
+  def gradient(self):
+    """
+    Returns the time-integrated misfit of a forward run from the current 
+    surface and its gradient with respect to the control, computed by the 
+    checkpointed reverse sweep.  The surface is restored afterwards.
+    """
+    control = self.config['transient_adjoint']['control_variable']
+    N       = self.get_n_steps()
+    s       = self.get_n_checkpoints()
+    S_0     = self.get_state()
+    
+    self.I   = 0.0
+    self.g_c = zeros(len(control.vector().get_local()))
+    for k in self.counters.keys():
+      self.counters[k] = 0
+    
+    # the final state is the last step of the reverse sweep :
+    self.store.save(0, S_0)
+    self.reverse(0, N + 1, s, None)
+    self.store.clear()
+    self.set_state(S_0)
+    
+    if MPI.process_number() == 0:
+      print 'Transient adjoint : %i steps, %i checkpoints, %i forward ' \
+            'steps, %i adjoint steps' % (N, s, 
+                                         self.counters['forward_steps'],
+                                         self.counters['adjoint_steps'])
+    return self.I, self.g_c
+
+
+def get_global(m):
+  """
+  Takes a distributed object and returns a numpy array that
+  contains all global values.
+  """
+  if type(m) == float:
+    return array(m)
+ 
+  # return a numPy array of values or single value of Constant :
+  if type(m) == Constant:
+    a = p = zeros(m.value_size())
+    m.eval(a, p)
+    return a
+ 
+  # return a numPy array of values of a FEniCS function : 
+  elif type(m) in (function.Function, functions.function.Function):
+    m_v = m.vector()
+    m_a = DoubleArray(m.vector().size())
+ 
+    try:
+      m.vector().gather(m_a, arange(m_v.size(), dtype='intc'))
+      return array(m_a.array())
+    
+    except TypeError:
+      return m.vector().gather(arange(m_v.size(), dtype='intc'))
+  
+  # The following type had to be added to the orginal function so that
+  # it could accomodate the return from the adjoint system solve.
+  elif type(m) == cpp.la.Vector:
+    m_a = DoubleArray(m.size())
+ 
+    try:
+      m.gather(m_a, arange(m.size(), dtype='intc'))
+      return array(m_a.array())
+ 
+    except TypeError:
+      return m.gather(arange(m.size(), dtype='intc'))
+  
+  else:
+    raise TypeError, 'Unknown parameter type %s.' % str(type(m)) 
+
+
+def set_local_from_global(m, m_global_array):
+  """
+  Sets the local values of the distrbuted object m to the values contained 
+  in the global array m_global_array.
+  """
+  # This had to be changed, because the dolfin-adjoint constant.Constant is
+  # different from the constant of dolfin.
+  if type(m) == Constant:
+    if m.rank() == 0:
+      m.assign(m_global_array[0])
+  
+    else:
+      m.assign(Constant(tuple(m_global_array)))
+  
+  elif type(m) in (function.Function, functions.function.Function):
+    begin, end = m.vector().local_range()
+    m_a_local  = m_global_array[begin : end]
+    m.vector().set_local(m_a_local)
+    m.vector().apply('insert')
+  
+  else:
+    raise TypeError, 'Unknown parameter type'
+
+
+def fmin_newton_cg(func, x0, hessp, bounds, maxfun=100, gtol=1e-5, 
+                   cg_maxiter=20, iprint=-1):
+  """
+  Minimize a function subject to box constraints with an inexact projected
+  Newton-CG method.  The Newton system is solved on the free variables by
+  conjugate gradients truncated by an Eisenstat-Walker type forcing term or
+  on negative curvature, and the step is found by a projected Armijo 
+  backtracking line search.
+
+  :param func       : Function returning the objective and its gradient at x
+  :param x0         : Initial guess
+  :param hessp      : Function hessp(x, p) returning the action of the 
+                      Hessian at x in the direction p
+  :param bounds     : Array of shape (len(x0), 2) of lower and upper bounds
+  :param maxfun     : Maximum number of evaluations of <func>
+  :param gtol       : Tolerance on the max norm of the projected gradient
+  :param cg_maxiter : Maximum number of CG iterations per Newton iteration
+  :param iprint     : Print progress if positive
+  :rtype            : Tuple (x, f, d) as returned by fmin_l_bfgs_b, where the
+                      dictionary d holds 'grad', 'funcalls', 'nit' and 'task'
+  """
+  lb   = bounds[:,0]
+  ub   = bounds[:,1]
+  x    = minimum(maximum(x0, lb), ub)
+  f, g = func(x)
+  nfev = 1
+  nit  = 0
+
+  while True:
+    # projected gradient :
+    pg = minimum(maximum(x - g, lb), ub) - x
+    if abs(pg).max() <= gtol:
+      task = 'CONVERGENCE: NORM_OF_PROJECTED_GRADIENT_<=_PGTOL'
+      break
+    if nfev >= maxfun:
+      task = 'STOP: TOTAL NO. of f AND g EVALUATIONS EXCEEDS LIMIT'
+      break
+
+    # variables at a bound with the gradient pointing outwards are held 
+    # fixed for this iteration :
+    pgn    = numpy.linalg.norm(pg)
+    eps    = minimum(pgn, 1e-3 * maximum(1.0, abs(x).max()))
+    active = ((x <= lb + eps) & (g > 0)) | ((x >= ub - eps) & (g < 0))
+    free   = ~active
+
+    # truncated CG on the free variables :
+    gf  = where(free, g, 0.0)
+    gfn = numpy.linalg.norm(gf)
+    tol = minimum(0.5, numpy.sqrt(gfn)) * gfn
+    d   = zeros(len(x))
+    r   = -gf
+    p   = r.copy()
+    rr  = numpy.dot(r, r)
+    for k in range(cg_maxiter):
+      Hp  = where(free, hessp(x, p), 0.0)
+      pHp = numpy.dot(p, Hp)
+      
+      # negative curvature, fall back to steepest descent if need be :
+      if pHp <= 0:
+        if k == 0:
+          d = -gf
+        break
+      
+      a      = rr / pHp
+      d     += a * p
+      r     -= a * Hp
+      rr_new = numpy.dot(r, r)
+      if numpy.sqrt(rr_new) <= tol:
+        break
+      p      = r + rr_new / rr * p
+      rr     = rr_new
+    d = where(free, d, -g)
+
+    # projected backtracking line search :
+    t    = 1.0
+    done = False
+    while nfev < maxfun:
+      x_t      = minimum(maximum(x + t*d, lb), ub)
+      f_t, g_t = func(x_t)
+      nfev    += 1
+      if f_t <= f + 1e-4 * numpy.dot(g, x_t - x):
+        done = True
+        break
+      t *= 0.5
+    
+    if not done:
+      task = 'ABNORMAL_TERMINATION_IN_LNSRCH'
+      break
+    
+    x, f, g = x_t, f_t, g_t
+    nit    += 1
+    if iprint > 0:
+      s = 'Newton-CG iteration %i : f = %e, |P(g)| = %e, CG iterations = %i'
+      print s % (nit, f, abs(pg).max(), k + 1)
+
+  return x, f, {'grad' : g, 'funcalls' : nfev, 'nit' : nit, 'task' : task}
+
+
 class AdjointSolver(object):
   """
   This class minimizes the misfit between an observed surface velocity and 
@@ -320,6 +781,17 @@ class AdjointSolver(object):
   of the objective function by using an incomplete adjoint (the adjoint 
   of the linearized forward model).  Minimization is accomplished with the 
   quasi-Newton BFGS algorithm
+
+  The forward state (velocity and, if solved for, enthalpy) and the assembled
+  adjoint operator are cached under a hash of the control array, so that
+  each control visited by the optimizer costs exactly one forward and one 
+  adjoint solve.  The number of solves performed is recorded in 
+  :attr:`counters`.
+
+  If config['adjoint']['levels'] is given, the inversion first walks a 
+  hierarchy of coarser models of the same domain (see 
+  :meth:`solve_coarse_levels`), so that most iterations are spent on 
+  cheap meshes.
   
   :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
   :param config : Dictionary object containing information on physical 
@@ -336,7 +808,119 @@ class AdjointSolver(object):
 
     # initialize instances of the forward model, and the adjoint physics : 
     self.forward_model    = SteadySolver(model, config)
-    self.adjoint_instance = AdjointVelocityBP(model, config)
+    self.adjoint_instance = AdjointVelocityBP(model, config, 
+                              self.forward_model.velocity_instance)
+
+    # forward state cache, keyed by control hash :
+    self.cache_size  = config['adjoint'].get('cache_size', 4)
+    self.state_cache = OrderedDict()
+    self.counters    = {'forward' : 0, 'adjoint' : 0, 'hessian' : 0,
+                        'cache_hits' : 0}
+
+    # cached transfer operators between the meshes of the coarse levels :
+    self.hierarchy   = MeshHierarchy()
+
+  def get_control_names(self):
+    """
+    Returns the names of the model attributes which are the controls, so 
+    that they may be found on other models.
+    """
+    names = []
+    for c in self.config['adjoint']['control_variable']:
+      names.append([k for k,f in vars(self.model).items() if f is c][0])
+    return names
+
+  def prolong_from(self, coarse):
+    """
+    Interpolate the controls and the forward state of the AdjointSolver 
+    <coarse>, whose model is defined on a coarser mesh of the same domain,
+    onto this model as initial guess.
+    """
+    names = self.get_state_variables() + self.get_control_names()
+    for name in names:
+      self.hierarchy.transfer(getattr(coarse.model, name), 
+                              getattr(self.model, name))
+
+  def get_level_config(self, l_model, level, i):
+    """
+    Returns the configuration of the coarse level <level> number <i> of 
+    config['adjoint']['levels'], defined on <l_model>.  The sections 
+    'velocity' and 'enthalpy' are copied, and the fields they hold as 
+    arrays over the fine mesh are interpolated onto <l_model> instead.
+    """
+    model  = self.model
+    config = self.config
+    h      = self.hierarchy
+    names  = self.get_control_names()
+    
+    l_adjoint = dict(config['adjoint'])
+    l_adjoint.update(level)
+    del l_adjoint['levels']
+    del l_adjoint['model']
+    l_adjoint['control_variable'] = [getattr(l_model, n) for n in names]
+    l_adjoint['bounds']           = []
+    for c, bounds in zip(l_adjoint['control_variable'], 
+                         config['adjoint']['bounds']):
+      l_bounds = []
+      for bound in bounds:
+        if type(bound) == int or type(bound) == float:
+          l_bounds.append(bound)
+        else:
+          l_bounds.append(h.transfer(bound, Function(c.function_space())))
+      l_adjoint['bounds'].append(tuple(l_bounds))
+    
+    # the fine-mesh fields are interpolated, and not set from the arrays :
+    l_velocity = dict(config['velocity'])
+    l_velocity.pop('levels', None)
+    for k, name in [('beta2', 'beta2'), ('E', 'E'), ('T0', 'T')]:
+      if isinstance(l_velocity[k], ndarray):
+        h.transfer(getattr(model, name), getattr(l_model, name))
+        l_velocity[k] = None
+    if l_velocity['T0'] is None:
+      l_velocity['use_T0'] = False
+    if isinstance(l_velocity['b_linear'], Function):
+      l_velocity['b_linear'] = h.transfer(l_velocity['b_linear'], 
+                                          Function(l_model.Q))
+    
+    l_enthalpy = dict(config['enthalpy'])
+    for k in ['T_surface', 'q_geo']:
+      if isinstance(l_enthalpy.get(k), ndarray):
+        h.transfer(getattr(model, k), getattr(l_model, k))
+        l_enthalpy[k] = None
+    
+    l_config                = dict(config)
+    l_config['adjoint']     = l_adjoint
+    l_config['velocity']    = l_velocity
+    l_config['enthalpy']    = l_enthalpy
+    l_config['output_path'] = config['output_path'] + 'level_%i/' % i
+    return l_config
+
+  def solve_coarse_levels(self):
+    """
+    Invert on each level of config['adjoint']['levels'], coarsest first, 
+    and prolong the optimal controls and forward state of each level to 
+    the next one, ending with this model.  Each level is a dictionary 
+    holding a fully initialized coarse 'model' of the same domain, and may
+    override entries of config['adjoint'] such as 'max_fun' and 'gtol'.
+    The targets of the inversion are interpolated from this model, and 
+    the configuration of each level is given by :meth:`get_level_config`.
+    """
+    model  = self.model
+    config = self.config
+    
+    coarse = None
+    for i, level in enumerate(config['adjoint']['levels']):
+      l_model = level['model']
+      for name in ['u_o', 'v_o', 'U_o', 'adot']:
+        self.hierarchy.transfer(getattr(model, name), getattr(l_model, name))
+      
+      solver = AdjointSolver(l_model, self.get_level_config(l_model, level, i))
+      if coarse is not None:
+        solver.prolong_from(coarse)
+      solver.solve()
+      coarse = solver
+    
+    self.prolong_from(coarse)
 
   def set_target_velocity(self, u=None, v=None, U=None):
     """ 
@@ -371,14 +955,187 @@ class AdjointSolver(object):
 
       model.u_o.update()
       model.v_o.update()
+
+  def get_state_variables(self):
+    """
+    Returns the names of the model functions that make up the forward state
+    for the current configuration.
+    """
+    config = self.config
+    names  = ['U', 'u', 'v', 'w']
+    if config['velocity']['approximation'] == 'stokes':
+      names.append('P')
+    elif config['velocity']['approximation'] in ['ssa', 'hybrid']:
+      names.append('U_ssa')
+    if config['enthalpy']['on']:
+      names.extend(['H', 'T', 'W', 'Mb'])
+    return names
+
+  def set_control(self, c_array):
+    """
+    Distribute the global control array <c_array> into the control 
+    variables listed in config['adjoint']['control_variable'].
+    """
+    control = self.config['adjoint']['control_variable']
+    n       = len(c_array)/len(control)
+    for ii,c in enumerate(control):
+      set_local_from_global(c, c_array[ii*n:(ii+1)*n])
+
+  def get_control(self):
+    """
+    Returns the global array of all control variables.
+    """
+    m_global = []
+    for mm in self.config['adjoint']['control_variable']:
+      m_global.extend(get_global(mm))
+    return array(m_global)
+
+  def get_bounds(self):
+    """
+    Returns the array of shape (n, 2) of the lower and upper bounds of the 
+    global control array, from config['adjoint']['bounds'].
+    """
+    model = self.model
+    b     = []
+    # convert bounds to an array of tuples and serialise it in parallel environ.
+    for bounds in self.config['adjoint']['bounds']:
+      bounds_arr = []
+      for i in range(2):
+        if type(bounds[i]) == int or type(bounds[i]) == float:
+          bounds_arr.append(bounds[i] * ones(model.beta2.vector().size()))
+        else:
+          bounds_arr.append(get_global(bounds[i]))
+      b.append(array(bounds_arr).T)
+    return vstack(b)
+
+  def reset_cache(self):
+    """
+    Empty the forward state cache and zero the solve counters.
+    """
+    self.state_cache.clear()
+    for k in self.counters.keys():
+      self.counters[k] = 0
+
+  def forward_state(self, c_array):
+    """
+    Make the model hold the forward solution at the control <c_array>,
+    solving the forward model only if this control has not been visited.
+    Returns the cache entry of this control.
+    """
+    model = self.model
+    key   = hashlib.sha1(ascontiguousarray(c_array).tostring()).hexdigest()
+    self.set_control(c_array)
+
+    if key in self.state_cache:
+      entry = self.state_cache.pop(key)
+      for name, a in entry['state'].iteritems():
+        f = getattr(model, name)
+        f.vector().set_local(a)
+        f.vector().apply('insert')
+      self.counters['cache_hits'] += 1
+    
+    else:
+      self.forward_model.solve()
+      self.counters['forward'] += 1
+      state = {}
+      for name in self.get_state_variables():
+        state[name] = getattr(model, name).vector().array().copy()
+      entry = {'state'      : state,
+               'forward_id' : self.counters['forward'],
+               'I'          : self.adjoint_instance.objective()}
+      
+      # drop the oldest entries :
+      while len(self.state_cache) >= self.cache_size:
+        self.state_cache.popitem(last=False)
+
+    # most recently used entries are last :
+    self.state_cache[key] = entry
+    return entry
+
+  def adjoint_operator(self, entry):
+    """
+    Returns the adjoint operator for the cache entry <entry>, with the model
+    holding its forward state.  The forward Jacobian is only valid for the 
+    latest forward solve, any other operator is assembled and kept in the 
+    cache.
+    """
+    if 'A_adj' in entry:
+      return entry['A_adj']
+    
+    latest = entry['forward_id'] == self.counters['forward']
+    A      = self.adjoint_instance.assemble_operator(latest)
+    if not self.adjoint_instance.is_forward_jacobian(A):
+      entry['A_adj'] = A
+    return A
+
+  def adjoint_state(self, c_array):
+    """
+    Make the model hold the forward and adjoint solutions at the control 
+    <c_array>, solving the adjoint model only if this control has not been
+    visited.  Returns the cache entry of this control, which holds the 
+    gradient under the key 'dI'.
+    """
+    model = self.model
+    entry = self.forward_state(c_array)
+    
+    if 'Lam' in entry:
+      model.Lam.vector().set_local(entry['Lam'])
+      model.Lam.vector().apply('insert')
+    
+    else:
+      self.adjoint_instance.solve(A=self.adjoint_operator(entry))
+      self.counters['adjoint'] += 1
+      
+      Js = []
+      for JJ in self.adjoint_instance.gradient():
+        Js.extend(get_global(JJ))
+      entry['dI']  = array(Js)
+      entry['Lam'] = model.Lam.vector().array().copy()
+    
+    return entry
+
+  def gradient(self, c_array):
+    """
+    Returns the gradient of the objective at the control <c_array>.
+    """
+    return self.adjoint_state(c_array)['dI']
+
+  def set_direction(self, dc_array):
+    """
+    Distribute the global array <dc_array> into the control perturbations
+    of the adjoint model.
+    """
+    dc = self.adjoint_instance.dc
+    n  = len(dc_array)/len(dc)
+    for ii,c in enumerate(dc):
+      set_local_from_global(c, dc_array[ii*n:(ii+1)*n])
+
+  def hessian_action(self, c_array, dc_array, misfit_only=False):
+    """
+    Returns the action of the Hessian of the objective at the control 
+    <c_array> in the direction <dc_array>, by means of one tangent linear
+    and one second adjoint solve.  If <misfit_only> is True, the Hessian of
+    the regularization is left out.
+    """
+    entry = self.adjoint_state(c_array)
+    A     = self.adjoint_operator(entry)
+    self.set_direction(dc_array)
+    
+    Hs = []
+    for HH in self.adjoint_instance.hessian_action(A, misfit_only):
+      Hs.extend(get_global(HH))
+    self.counters['hessian'] += 1
+    return array(Hs)
       
   def solve(self):
     r""" 
     Perform the optimization.
 
-    First, we define functions that return the objective function and Jacobian.
-    These are passed to scipy's fmin_l_bfgs_b, which is a python wrapper for the
-    Fortran code of Nocedal et. al.
+    First, we define a function that returns the objective function and 
+    Jacobian at the same control.  This is passed to scipy's fmin_l_bfgs_b, 
+    which is a python wrapper for the Fortran code of Nocedal et. al., or, 
+    if config['adjoint']['optimizer'] is 'newton_cg', to 
+    :func:`fmin_newton_cg` along with second order adjoint Hessian actions.
 
     The functions are needed to make the calculation of the search direction 
     and update of search point take place globally, across all proccessors, 
@@ -393,98 +1150,29 @@ class AdjointSolver(object):
     model  = self.model
     config = self.config
     
-    def get_global(m):
-      """
-      Takes a distributed object and returns a numpy array that
-      contains all global values.
-      """
-      if type(m) == float:
-        return array(m)
-     
-      # return a numPy array of values or single value of Constant :
-      if type(m) == Constant:
-        a = p = zeros(m.value_size())
-        m.eval(a, p)
-        return a
-     
-      # return a numPy array of values of a FEniCS function : 
-      elif type(m) in (function.Function, functions.function.Function):
-        m_v = m.vector()
-        m_a = DoubleArray(m.vector().size())
-     
-        try:
-          m.vector().gather(m_a, arange(m_v.size(), dtype='intc'))
-          return array(m_a.array())
-        
-        except TypeError:
-          return m.vector().gather(arange(m_v.size(), dtype='intc'))
-      
-      # The following type had to be added to the orginal function so that
-      # it could accomodate the return from the adjoint system solve.
-      elif type(m) == cpp.la.Vector:
-        m_a = DoubleArray(m.size())
-     
-        try:
-          m.gather(m_a, arange(m.size(), dtype='intc'))
-          return array(m_a.array())
-     
-        except TypeError:
-          return m.gather(arange(m.size(), dtype='intc'))
-      
-      else:
-        raise TypeError, 'Unknown parameter type %s.' % str(type(m)) 
-
-    def set_local_from_global(m, m_global_array):
-      """
-      Sets the local values of the distrbuted object m to the values contained 
-      in the global array m_global_array.
-      """
-      # This had to be changed, because the dolfin-adjoint constant.Constant is
-      # different from the constant of dolfin.
-      if type(m) == Constant:
-        if m.rank() == 0:
-          m.assign(m_global_array[0])
-      
-        else:
-          m.assign(Constant(tuple(m_global_array)))
-      
-      elif type(m) in (function.Function, functions.function.Function):
-        begin, end = m.vector().local_range()
-        m_a_local  = m_global_array[begin : end]
-        m.vector().set_local(m_a_local)
-        m.vector().apply('insert')
-      
-      else:
-        raise TypeError, 'Unknown parameter type'
-
     def _I_fun(c_array, *args):
       """
       Solve forward model with given control, calculate objective function
       """
-      n = len(c_array)/len(config['adjoint']['control_variable'])
-      for ii,c in enumerate(config['adjoint']['control_variable']):
-        set_local_from_global(c, c_array[ii*n:(ii+1)*n])
-      self.forward_model.solve()
-      I = assemble(self.adjoint_instance.I)
-      return I
+      return self.forward_state(c_array)['I']
  
     def _J_fun(c_array, *args):
       """
       Solve adjoint model, calculate gradient
       """
-      # dolfin.adjoint method:
-      n = len(c_array)/len(config['adjoint']['control_variable'])
-      for ii,c in enumerate(config['adjoint']['control_variable']):
-        set_local_from_global(c, c_array[ii*n:(ii+1)*n])
-      self.adjoint_instance.solve()
+      return self.gradient(c_array)
+
+    def _IJ_fun(c_array, *args):
+      """
+      Solve forward and adjoint model with given control, return the 
+      objective function and its gradient.
+      """
+      I  = _I_fun(c_array)
+      Js = _J_fun(c_array)
 
       # This is not the best place for this, but we leave it here for now
       # so that we can see the impact of every line search update on the
       # variables of interest.
-      Js = []
-      for JJ in self.adjoint_instance.J:
-        Js.extend(get_global(assemble(JJ)))
-      Js   = array(Js)
       U    = project(as_vector([model.u, model.v, model.w]))
       dSdt = project(- ( model.u*model.S.dx(0) + model.v*model.S.dx(1) ) \
                      + (model.w + model.adot) )
@@ -493,7 +1181,7 @@ class AdjointSolver(object):
       file_b_xml << model.beta2 
       file_b_pvd << model.beta2
       file_dSdt_pvd << dSdt
-      return Js
+      return I, Js
 
     #===========================================================================
     # Set up file I/O
@@ -506,48 +1194,718 @@ class AdjointSolver(object):
 
     # Switching over to the parallel version of the optimization that is found 
     # in the dolfin-adjoint optimize.py file:
-    maxfun     = config['adjoint']['max_fun']
-    bounds_list     = config['adjoint']['bounds']
-    m_global   = []
-    for mm in config['adjoint']['control_variable']:
-      m_global.extend(get_global(mm))
-    m_global = array(m_global)
+    maxfun      = config['adjoint']['max_fun']
+    optimizer   = config['adjoint'].get('optimizer',   'l_bfgs_b')
+    gtol        = config['adjoint'].get('gtol',        1e-5)
+    cg_maxiter  = config['adjoint'].get('cg_max_iter', 20)
+    
+    # start from the solution on the coarser meshes :
+    if config['adjoint'].get('levels'):
+      self.solve_coarse_levels()
+    m_global    = self.get_control()
+
+    # the targets may have changed since the last call :
+    self.reset_cache()
 
     # Shut up all processors but the first one.
     if MPI.process_number() != 0:
       iprint = -1
     else:
       iprint = 1
-    b = []
-    # convert bounds to an array of tuples and serialise it in parallel environ.
-    for bounds in bounds_list:
-      bounds_arr = []
-      for i in range(2):
-        if type(bounds[i]) == int or type(bounds[i]) == float:
-          bounds_arr.append(bounds[i] * ones(model.beta2.vector().size()))
-        else:
-          bounds_arr.append(get_global(bounds[i]))
-      b.append(array(bounds_arr).T)
-    bounds = vstack(b)  
+    bounds = self.get_bounds()
     print bounds
        
     
     # minimize this stuff :
-    mopt, f, d = fmin_l_bfgs_b(_I_fun, m_global, fprime=_J_fun, bounds=bounds,
-                               maxfun=maxfun, iprint=iprint)
+    if optimizer == 'newton_cg':
+      mopt, f, d = fmin_newton_cg(_IJ_fun, m_global, self.hessian_action,
+                                  bounds, maxfun=maxfun, gtol=gtol,
+                                  cg_maxiter=cg_maxiter, iprint=iprint)
+    
+    elif optimizer == 'l_bfgs_b':
+      mopt, f, d = fmin_l_bfgs_b(_IJ_fun, m_global, bounds=bounds,
+                                 maxfun=maxfun, pgtol=gtol, iprint=iprint)
+    
+    else:
+      raise ValueError, "Valid optimizers are 'l_bfgs_b' and 'newton_cg'."
+
+    # leave the model holding the forward state of the optimal control :
+    self.forward_state(mopt)
+
+    if MPI.process_number() == 0:
+      s = 'forward solves : %i, adjoint solves : %i, ' + \
+          'Hessian actions : %i, cache hits : %i'
+      print s % (self.counters['forward'], self.counters['adjoint'],
+                 self.counters['hessian'], self.counters['cache_hits'])
+
+class SensitivitySolver(object):
+  """
+  Computes sensitivity maps of scalar diagnostics of the steady state, 
+  that is, the gradient of a diagnostic with respect to the fields beta2,
+  E, q_geo, S and B, by one adjoint solve of 
+  :class:`~src.physics.AdjointSensitivity` instead of one forward rerun 
+  per perturbed field.  The adjoint forms are compiled once, so that the 
+  sensitivities of the diagnostic are recomputed cheaply after each change
+  of the model.  For example, the sensitivity of the flux across the gate 
+  marked 7 in the facet function model.ff is computed by ::
+  
+    n     = FacetNormal(model.mesh)
+    G     = model.rho * dot(model.U, as_vector([n[0], n[1]])) * model.ds(7)
+    grads = SensitivitySolver(model, config, G).solve()
+  
+  :param model  : An instantiated 2D flowline ice :class:`~src.model.Model`
+  :param config : Dictionary object containing information on physical 
+	                attributes such as velocties, age, and surface climate
+  :param G      : Scalar UFL form of the diagnostic, of model.U and model.w
+  :param fields : List of the names of the model fields
+  """
+  def __init__(self, model, config, G, 
+               fields=['beta2', 'E', 'q_geo', 'S', 'B']):
+    """
+    Initialize the forward model and the adjoint of the diagnostic.
+    """
+    if config['velocity']['approximation'] != 'fo':
+      raise ValueError("Sensitivities require the 'fo' velocity.")
+    
+    self.model         = model
+    self.config        = config
+    self.G             = G
+    self.forward_model = SteadySolver(model, config)
+    
+    steady             = self.forward_model
+    enthalpy           = getattr(steady, 'enthalpy_instance', None)
+    self.adjoint       = AdjointSensitivity(model, config, G, 
+                                            steady.velocity_instance, 
+                                            enthalpy, fields)
+
+  def solve(self, forward=True):
+    """
+    Returns the gradient of the diagnostic with respect to each of the 
+    fields.
+
+    :param forward : If False, the model already holds the steady state 
+                     and the forward solve is skipped
+    :rtype         : OrderedDict of Functions holding the gradients
+    """
+    if forward:
+      self.forward_model.solve()
+    
+    grads = self.adjoint.solve()
+    
+    if MPI.process_number() == 0:
+      print 'G = %e' % assemble(self.G)
+      for name, g in grads.items():
+        print 'dG/d%s <min, max> : <%e, %e>' % (name, g.vector().min(), 
+                                                g.vector().max())
+    return grads
+
+
+class PosteriorSolver(object):
+  r"""
+  This class estimates the uncertainty of the controls found by an 
+  :class:`AdjointSolver` by a linearized Bayesian analysis about the 
+  maximum a posteriori (MAP) control.  With a diagonal Gaussian prior of 
+  mean :math:`c_{pr}` and standard deviation :math:`\sigma_{pr}`, the MAP 
+  control minimizes
+
+  .. math::
+     J(c) = \frac{1}{s} I(c) + \frac{1}{2}\left\Vert\frac{c - c_{pr}}
+     {\sigma_{pr}}\right\Vert^2,
+
+  with :math:`I` the misfit of the adjoint model and :math:`1/s` the noise
+  scaling below, and the posterior covariance is
+
+  .. math::
+     \Gamma_{post} = \left(\frac{1}{s}H_{misfit} + \Gamma_{pr}^{-1}
+     \right)^{-1} \approx \Gamma_{pr}^{1/2}\left(I - VDV^T\right)
+     \Gamma_{pr}^{1/2},
+
+  where :math:`V` and :math:`\Lambda` hold the dominant eigenpairs of the 
+  prior-preconditioned misfit Hessian :math:`s^{-1}\Gamma_{pr}^{1/2} 
+  H_{misfit} \Gamma_{pr}^{1/2}` and :math:`D = \Lambda(I + \Lambda)^{-1}`.  
+  The eigenpairs are found by a randomized eigensolver which needs 
+  2(rank + oversampling) Hessian actions, each costing one tangent linear 
+  and one second adjoint solve at the MAP control.
+
+  The noise model depends on the misfit :
+
+  * 'points' : the misfit of :class:`~src.physics.PointObservations` is
+    already weighted by the standard deviation of each observation, and 
+    :math:`s = 1`.
+  * 'linear' and 'kinematic' : the misfit is the integral of half the 
+    squared residual over the surface.  It is taken as the sum over 
+    independent observations of standard deviation 'noise_std', each 
+    representing the area 'noise_area' of the surface (e.g. the pixel 
+    area of the data, or the square of their correlation length), so that
+    :math:`s = \sigma^2 a` does not depend on the mesh.
+  * 'logarithmic' : as above, with 'noise_std' that of the logarithm of 
+    the speed, and :math:`s = 2\sigma^2 a` since the misfit lacks the 
+    factor one half.
+
+  Any regularization of the adjoint model is left out of :math:`I`, the 
+  prior taking its place.
+
+  :param adjoint : An :class:`AdjointSolver`
+  :param config  : Dictionary object containing information on physical 
+	                 attributes such as velocties, age, and surface climate.
+                   The entries of config['posterior'] are 'noise_std' and 
+                   'noise_area' (unless the misfit is 'points'), 
+                   'prior_mean' and 'prior_std' (float or global array, 
+                   the mean defaulting to the current control), 'rank', 
+                   'oversampling', 'seed' and 'max_fun', the maximum number
+                   of evaluations in the search of the MAP control
+  """
+  def __init__(self, adjoint, config):
+    """
+    Set up the prior and the noise model.
+    """
+    self.adjoint = adjoint
+    self.model   = adjoint.model
+    self.config  = config
+    
+    params       = config['posterior']
+    objective    = config['adjoint']['objective_function']
+    c_0          = adjoint.get_control()
+    self.c_map   = None
+    self.rank    = params['rank']
+    self.p       = params.get('oversampling', 10)
+    self.random  = numpy.random.RandomState(params.get('seed', 0))
+    self.c_pr    = params.get('prior_mean', c_0) * ones(len(c_0))
+    self.std_pr  = params['prior_std'] * ones(len(c_0))
+    
+    # noise scaling of the misfit :
+    if objective == 'points':
+      self.scale = 1.0
+    else:
+      self.scale = 1.0 / (params['noise_std']**2 * params['noise_area'])
+      if objective == 'logarithmic':
+        self.scale *= 0.5
+    
+    # the regularization of the adjoint model, left out of the misfit :
+    control = config['adjoint']['control_variable']
+    R       = adjoint.adjoint_instance.R
+    self.R  = None
+    if R != 0:
+      self.R  = Form(R)
+      self.dR = [Form(derivative(R, c, TestFunction(c.function_space())))
+                 for c in control]
+  
+  def misfit(self, c_array):
+    """
+    Returns the misfit of the adjoint model and its gradient at the control
+    <c_array>, without the regularization.
+    """
+    adjoint = self.adjoint
+    I       = adjoint.forward_state(c_array)['I']
+    dI      = adjoint.gradient(c_array).copy()
+    if self.R is not None:
+      dR = []
+      for g in self.dR:
+        dR.extend(get_global(assemble(g)))
+      I  -= assemble(self.R)
+      dI -= array(dR)
+    return I, dI
+
+  def objective(self, c_array):
+    """
+    Returns the negative log posterior, up to a constant, and its gradient
+    at the control <c_array>.
+    """
+    I, dI = self.misfit(c_array)
+    r     = (c_array - self.c_pr) / self.std_pr
+    return self.scale * I + 0.5 * numpy.dot(r, r), \
+           self.scale * dI + r / self.std_pr
+
+  def solve_map(self):
+    """
+    Find the MAP control by L-BFGS-B, starting from the current control, 
+    within the bounds of config['adjoint']['bounds'].
+    """
+    adjoint = self.adjoint
+    params  = self.config['posterior']
+    maxfun  = params.get('max_fun', self.config['adjoint']['max_fun'])
+    iprint  = 1 if MPI.process_number() == 0 else -1
+    bounds  = None
+    if self.config['adjoint']['bounds'] is not None:
+      bounds = adjoint.get_bounds()
+    
+    adjoint.reset_cache()
+    self.c_map, f, d = fmin_l_bfgs_b(self.objective, adjoint.get_control(),
+                                     bounds=bounds, maxfun=maxfun, 
+                                     iprint=iprint)
+    adjoint.forward_state(self.c_map)
+    
+  def misfit_hessian(self, x):
+    """
+    Returns the action of the prior-preconditioned misfit Hessian on <x>.
+    """
+    Hx = self.adjoint.hessian_action(self.c_map, self.std_pr * x, 
+                                     misfit_only=True)
+    return self.scale * self.std_pr * Hx
+
+  def solve(self):
+    """
+    Compute the dominant eigenpairs of the prior-preconditioned misfit 
+    Hessian at the MAP control by a two-pass randomized eigensolver, 
+    finding the MAP control first if need be.
+    """
+    if self.c_map is None:
+      self.solve_map()
+    
+    n = len(self.c_map)
+    k = self.rank + self.p
+    
+    # the same random matrix is drawn on all processes :
+    Omega = self.random.randn(n, k)
+    
+    # range of the Hessian :
+    Y = zeros((n, k))
+    for i in range(k):
+      Y[:,i] = self.misfit_hessian(Omega[:,i])
+    Qm, Rm = numpy.linalg.qr(Y)
+    
+    # the Hessian projected onto its range :
+    HQ = zeros((n, k))
+    for i in range(k):
+      HQ[:,i] = self.misfit_hessian(Qm[:,i])
+    T = numpy.dot(Qm.T, HQ)
+    T = 0.5 * (T + T.T)
+
+    lam, U   = numpy.linalg.eigh(T)
+    idx      = lam.argsort()[::-1][:self.rank]
+    
+    # away from the optimum the misfit Hessian may be indefinite :
+    self.lam = maximum(lam[idx], 0.0)
+    self.V   = numpy.dot(Qm, U[:,idx])
+    
+    if MPI.process_number() == 0:
+      print 'Hessian eigenvalues <max, min> : <%e, %e>' % (self.lam[0],
+                                                           self.lam[-1])
+
+  def variance(self):
+    """
+    Returns the pointwise posterior variance of the controls.
+    """
+    d = self.lam / (1.0 + self.lam)
+    return self.std_pr**2 * (1.0 - numpy.dot(self.V**2, d))
+
+  def sample(self, n_samples):
+    """
+    Returns an array of <n_samples> rows, each a draw of the controls from 
+    the posterior.
+    """
+    n = len(self.c_map)
+    d = 1.0 / numpy.sqrt(1.0 + self.lam) - 1.0
+    Z = self.random.randn(n_samples, n)
+    Z = Z + numpy.dot(numpy.dot(Z, self.V) * d, self.V.T)
+    return self.c_map + self.std_pr * Z
+
+  def velocity_samples(self, samples):
+    """
+    Returns a list of surface speed Functions for the control <samples>, 
+    linearized about the optimal control by the tangent linear model.
+    """
+    model   = self.model
+    adjoint = self.adjoint
+    entry   = adjoint.adjoint_state(self.c_map)
+    A       = adjoint.adjoint_operator(entry)
+    dU      = adjoint.adjoint_instance.dU
+    
+    speeds  = []
+    for c in samples:
+      adjoint.set_direction(c - self.c_map)
+      adjoint.adjoint_instance.solve_tangent_linear(A)
+      speeds.append(project(sqrt((model.U[0] + dU[0])**2 + \
+                                 (model.U[1] + dU[1])**2), model.Q))
+    return speeds
+
+  def write(self, n_samples):
+    """
+    Write the posterior standard deviation of the controls, <n_samples> 
+    posterior samples of the controls and surface speed, and the 
+    pointwise standard deviation of the speed samples to 
+    config['output_path'].
+    """
+    model   = self.model
+    path    = self.config['output_path']
+    control = self.config['adjoint']['control_variable']
+    n       = len(self.c_map)/len(control)
+    
+    std     = numpy.sqrt(self.variance())
+    samples = self.sample(n_samples)
+    speeds  = self.velocity_samples(samples)
+
+    for ii,c in enumerate(control):
+      f = Function(c.function_space())
+      set_local_from_global(f, std[ii*n:(ii+1)*n])
+      File(path + 'std_%i.pvd' % ii) << f
+      File(path + 'std_%i.xml' % ii) << f
+      for jj,s in enumerate(samples):
+        set_local_from_global(f, s[ii*n:(ii+1)*n])
+        File(path + 'sample_%i_%i.xml' % (ii, jj)) << f
+
+    Us    = array([get_global(U) for U in speeds])
+    U_std = Function(model.Q)
+    set_local_from_global(U_std, Us.std(axis=0))
+    File(path + 'U_std.pvd') << U_std
+    for jj,U in enumerate(speeds):
+      File(path + 'U_sample_%i.xml' % jj) << U
+
+    # leave the model at the optimal control :
+    adjoint.forward_state(self.c_map)
+
+
+class EnsembleSolver(object):
+  """
+  This class runs the members of an ensemble (e.g. inversions with 
+  perturbed targets, or forward runs with perturbed parameters) 
+  concurrently on one node.  Each member runs in a new interpreter which 
+  executes the calling script again, with the index of the member in the
+  environment variable ENSEMBLE_MEMBER, up to its call of :meth:`solve`, 
+  where it runs that member and exits.  Nothing is forked from a process 
+  in which PETSc and MPI are initialized, so each member builds its own 
+  model and solvers, while the compiled forms are read from the cache of 
+  the form compiler; the script should do no more than that before its 
+  call of :meth:`solve`.  Work shared by the members, such as a reference
+  solution, is done once by <setup> in the calling process, which writes 
+  its results to disk for the members to read.  The summary returned by 
+  each member is appended to a single store as soon as the member 
+  finishes, and members already in the store are skipped, so an 
+  interrupted ensemble is resumed by running it again.  The ensemble runs
+  in serial only; its members are the parallelism.
+  
+  :param member : Function member(i, path) that runs member <i>, writes 
+                  its results into the directory <path> and returns a 
+                  dictionary of summary values
+  :param config : Dictionary object containing information on physical 
+	                attributes such as velocties, age, and surface climate.
+                  The entries of config['ensemble'] are 'n_members', 
+                  'n_workers' and 'store', the latter relative to 
+                  config['output_path']
+  :param setup  : (Optional) function setup(path), run in the calling 
+                  process only, before the members that are not yet in the 
+                  store are started, which writes the data shared by the 
+                  members into the directory <path>, config['output_path']
+  """
+  def __init__(self, member, config, setup=None):
+    self.member    = member
+    self.config    = config
+    self.setup     = setup
+
+    params         = config['ensemble']
+    self.path      = config['output_path']
+    self.n_members = params['n_members']
+    self.n_workers = params.get('n_workers', cpu_count())
+    self.store     = self.path + params.get('store', 'ensemble.json')
+    self.processes = {}
+
+  def get_summaries(self):
+    """
+    Returns a dictionary of the records of all finished members in the 
+    store, keyed by member index.
+    """
+    records = {}
+    if os.path.isfile(self.store):
+      for line in open(self.store):
+        try:
+          r = json.loads(line)
+        except ValueError:
+          continue           # a record cut short by an interruption
+        if 'summary' in r:
+          records[r['member']] = r
+    return records
+
+  def get_member_path(self, i):
+    """
+    Returns the directory of the results of member <i>.
+    """
+    return self.path + 'run_%i/' % i
+
+  def solve_member(self, i):
+    """
+    Run member <i> in this worker process, and write its index, run time 
+    and summary, or the traceback if it failed, as the record of the member
+    into its directory.
+    """
+    path = self.get_member_path(i)
+    if not os.path.exists(path):
+      os.makedirs(path)
+    tic  = time.time()
+    try:
+      summary = self.member(i, path)
+      r = {'member'  : i,
+           'time'    : time.time() - tic,
+           'summary' : summary}
+    except Exception:
+      r = {'member'  : i,
+           'time'    : time.time() - tic,
+           'error'   : traceback.format_exc()}
+    f = open(path + 'record.json', 'w')
+    f.write(json.dumps(r))
+    f.close()
+
+  def spawn_member(self, i):
+    """
+    Run the calling script as the worker of member <i>, wait for it, and 
+    return the record of the member.
+    """
+    record = self.get_member_path(i) + 'record.json'
+    if os.path.isfile(record):
+      os.remove(record)
+    env    = dict(os.environ, ENSEMBLE_MEMBER=str(i))
+    tic    = time.time()
+    proc   = subprocess.Popen([sys.executable] + sys.argv, env=env)
+    self.processes[i] = proc
+    code   = proc.wait()
+    del self.processes[i]
+    if os.path.isfile(record):
+      return json.load(open(record))
+    return {'member' : i,
+            'time'   : time.time() - tic,
+            'error'  : 'worker exited with code %i' % code}
+
+  def solve(self):
+    """
+    Run all members that are not yet in the store, and return the records 
+    of the store.  In the worker process of a member, run that member and 
+    exit instead.
+    """
+    if 'ENSEMBLE_MEMBER' in os.environ:
+      self.solve_member(int(os.environ['ENSEMBLE_MEMBER']))
+      sys.exit(0)
+
+    if MPI.num_processes() > 1:
+      raise RuntimeError("EnsembleSolver runs its members as processes " +
+                         "of their own, and may not run under MPI with " +
+                         "more than one process.")
+    if not os.path.isfile(sys.argv[0]):
+      raise RuntimeError("EnsembleSolver runs the calling script for each " +
+                         "member, and must be called from a script.")
+    
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+
+    done    = self.get_summaries()
+    members = [i for i in range(self.n_members) if i not in done]
+    print 'ensemble : %i of %i members done, running %i on %i workers' \
+          % (len(done), self.n_members, len(members), self.n_workers)
+    
+    if self.setup is not None and len(members) > 0:
+      self.setup(self.path)
+    
+    # the threads only start and wait for the worker processes :
+    pool  = ThreadPool(self.n_workers)
+    store = open(self.store, 'a+')
+    
+    # terminate a record cut short by an interruption :
+    store.seek(0, os.SEEK_END)
+    if store.tell() > 0:
+      store.seek(-1, os.SEEK_END)
+      if store.read(1) != '\n':
+        store.seek(0, os.SEEK_END)
+        store.write('\n')
+    try:
+      for r in pool.imap_unordered(self.spawn_member, members):
+        store.write(json.dumps(r) + '\n')
+        store.flush()
+        os.fsync(store.fileno())
+        if 'error' in r:
+          print 'member %i failed :\n%s' % (r['member'], r['error'])
+        else:
+          print 'member %i done in %.1f s' % (r['member'], r['time'])
+      pool.close()
+    
+    except KeyboardInterrupt:
+      for proc in self.processes.values():
+        proc.terminate()
+      pool.terminate()
+      raise
+    
+    finally:
+      pool.join()
+      store.close()
+
+    return self.get_summaries()
 
-    n = len(mopt)/len(config['adjoint']['control_variable'])
-    for ii,c in enumerate(config['adjoint']['control_variable']):
-      set_local_from_global(c, mopt[ii*n:(ii+1)*n])
 
 class BalanceVelocitySolver(object):
+  """
+  Solves for the balance velocity of the upper surface of <model> on the
+  planar surface mesh of VelocityBalance, storing the results in model.U,
+  model.dSdx, model.dSdy, model.u_balance and model.v_balance.
+  """
   def __init__(self, model, config):
     self.bv_instance = VelocityBalance(model, config)
 
   def solve(self):
     self.bv_instance.solve()
 
+class BalanceVelocityAssimilationSolver(object):
+  """
+  This class assimilates observed surface speeds into the balance velocity 
+  of a :class:`~src.physics.VelocityBalance_2` instance by optimizing its 
+  four controls, Uobs, adot, H and the flow direction component dS[1], 
+  jointly with L-BFGS-B.  Each control is scaled by its error, so that a 
+  unit step in the optimization variable is a step of one error in every 
+  control, and the blocks are equally well conditioned.  Unless given, the
+  errors are the half widths of the bounds.
+
+  The last control reached is kept, and written to the restart file if one
+  is given, so that a further call to :meth:`solve` (or a new run) starts 
+  where the last one stopped.  The objective and, for each block, the norm
+  of the projected scaled gradient and the largest scaled step are printed 
+  at each evaluation and recorded in :attr:`history`.
+  
+  :param bv     : An instantiated :class:`~src.physics.VelocityBalance_2`
+  :param config : Dictionary whose entry 'balance_assimilation' holds
+                  'bounds', the list of the (lower, upper) bounds of the 
+                  four controls, and optionally 'scale', the list of their 
+                  errors, 'max_fun', 'gtol' and 'restart_file'
+  """
+  names = ['Uobs', 'adot', 'H', 'Ny']
+
+  def __init__(self, bv, config):
+    self.bv     = bv
+    self.config = config
+    
+    params      = config['balance_assimilation']
+    n           = bv.Q.dim()
+    self.n      = n
+    self.lower  = numpy.hstack([numpy.zeros(n) + b[0] 
+                                for b in params['bounds']])
+    self.upper  = numpy.hstack([numpy.zeros(n) + b[1] 
+                                for b in params['bounds']])
+    if params.get('scale') is None:
+      scale = 0.5 * (self.upper - self.lower)
+    else:
+      scale = numpy.hstack([numpy.zeros(n) + s for s in params['scale']])
+    scale[scale <= 0] = 1.0
+    self.scale        = scale
+    self.restart_file = params.get('restart_file')
+    
+    self.x        = None
+    self.history  = []
+    self.counters = {'forward' : 0, 'adjoint' : 0}
 
+  def get_controls(self):
+    """
+    Returns the list of the control Functions, in the order of the blocks.
+    """
+    bv = self.bv
+    return [bv.Uobs, bv.adot, bv.H, bv.dS[1]]
+
+  def get_control(self):
+    """
+    Returns the array of the stacked controls.
+    """
+    return numpy.hstack([c.vector().array() for c in self.get_controls()])
 
+  def set_control(self, x):
+    """
+    Set the controls from the stacked array <x>.
+    """
+    n = self.n
+    for i, c in enumerate(self.get_controls()):
+      c.vector().set_local(x[i*n:(i+1)*n].copy())
+      c.vector().apply('insert')
 
+  def get_initial_control(self):
+    """
+    Returns the control to start from : the last control reached, else that
+    of the restart file, else the current controls, within the bounds.
+    """
+    if self.x is not None:
+      x = self.x
+    elif self.restart_file is not None and os.path.isfile(self.restart_file):
+      print 'restarting from %s' % self.restart_file
+      x = numpy.load(self.restart_file)
+    else:
+      x = self.get_control()
+    return numpy.clip(x, self.lower, self.upper)
+
+  def objective_gradient(self, x):
+    """
+    Solve the forward and adjoint models for the control <x>, and return the
+    objective and its gradient with respect to <x>.
+    """
+    bv = self.bv
+    self.set_control(x)
+    bv.solve_forward()
+    I  = bv.objective()
+    self.counters['forward'] += 1
+    bv.solve_adjoint()
+    g  = numpy.hstack(bv.get_gradient())
+    self.counters['adjoint'] += 1
+    return I, g
+
+  def report(self, I, z, gz, dz, lb, ub):
+    """
+    Print and record the objective <I>, and for each block, the norm of the 
+    projected scaled gradient and the largest scaled step <dz>.
+    """
+    n    = self.n
+    pg   = numpy.abs(z - numpy.clip(z - gz, lb, ub))
+    pg_b = [pg[i*n:(i+1)*n].max() for i in range(len(self.names))]
+    dz_b = [numpy.abs(dz[i*n:(i+1)*n]).max() for i in range(len(self.names))]
+    self.history.append({'I' : I, 'pg' : pg_b, 'dz' : dz_b})
+    
+    if MPI.process_number() == 0:
+      print 'evaluation %i, I = %.6e' % (len(self.history), I)
+      for name, p, d in zip(self.names, pg_b, dz_b):
+        print '  %-4s : |proj. grad| = %.3e, |step| = %.3e' % (name, p, d)
+
+  def solve(self, callback=None):
+    """
+    Perform the optimization, and leave the VelocityBalance_2 instance at
+    the optimal controls.  <callback>, if given, is called with the 
+    VelocityBalance_2 instance after each evaluation.
+    """
+    params = self.config['balance_assimilation']
+    maxfun = params.get('max_fun', 100)
+    gtol   = params.get('gtol',    1e-5)
+
+    # optimize the scaled step z from x0, x = x0 + scale*z :
+    x0     = self.get_initial_control()
+    scale  = self.scale
+    lb     = (self.lower - x0) / scale
+    ub     = (self.upper - x0) / scale
+    state  = {'z' : numpy.zeros(len(x0)), 'I' : inf}
+    
+    def _IJ_fun(z, *args):
+      """
+      Return the objective function and its gradient with respect to the 
+      scaled step <z>.
+      """
+      x     = x0 + scale*z
+      I, g  = self.objective_gradient(x)
+      gz    = scale*g
+      self.report(I, z, gz, z - state['z'], lb, ub)
+      state['z'] = z.copy()
+      
+      # keep the best control for a warm restart :
+      if I < state['I']:
+        state['I'] = I
+        self.x     = x.copy()
+        if self.restart_file is not None and MPI.process_number() == 0:
+          numpy.save(self.restart_file, self.x)
+      if callback is not None:
+        callback(self.bv)
+      return I, gz
+    
+    if MPI.process_number() != 0:
+      iprint = -1
+    else:
+      iprint = 1
+    
+    zopt, f, d = fmin_l_bfgs_b(_IJ_fun, numpy.zeros(len(x0)), 
+                               bounds=zip(lb, ub), maxfun=maxfun, 
+                               pgtol=gtol, iprint=iprint)
+    
+    self.x = x0 + scale*zopt
+    self.set_control(self.x)
+    self.bv.solve_forward()
 
+    if MPI.process_number() == 0:
+      print 'forward solves : %i, adjoint solves : %i, %s' \
+            % (self.counters['forward'], self.counters['adjoint'], d['task'])
+    return self.x
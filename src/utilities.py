@@ -14,6 +14,7 @@ sys.path.append(src_directory)
 
 from scipy.io          import loadmat, savemat
 from scipy.interpolate import RectBivariateSpline, NearestNDInterpolator
+from matplotlib.tri    import Triangulation
 from numpy             import *
 from dolfin            import *
 from pylab             import plot, show, shape, meshgrid, contour
@@ -394,6 +395,177 @@ class DataInput:
     return unew
 
 
+class CellBins(object):
+  """
+  Bins the raw pixels of the gridded data of a DataInput object into the 
+  cells of a 2D mesh, or into the upper surface facets (marked <marker> in
+  the FacetFunction <ff>) of a 3D mesh.  The pixels are located once with 
+  a vectorized triangle finder, after which each field is reduced to 
+  per-cell counts, error-weighted means and variances by :meth:`bin`, 
+  without evaluating the data at every cell or vertex.
+
+  For a 3D mesh the results of a surface facet belong to the cell below 
+  it, so that cellwise Functions may be used in integrals over the 
+  surface.
+
+  :param di     : DataInput object holding the data
+  :param mesh   : Dolfin mesh to bin into
+  :param ff     : (Optional) FacetFunction marking the surface of a 3D mesh
+  :param marker : (Optional) marker of the surface facets in <ff>
+  """
+  def __init__(self, di, mesh, ff=None, marker=2):
+    """
+    Locate the pixels in the mesh.
+    """
+    self.di   = di
+    self.mesh = mesh
+    coord     = mesh.coordinates()
+
+    # triangles of the mesh, or of its upper surface, and the cells they 
+    # belong to :
+    if mesh.topology().dim() == 2:
+      tris  = mesh.cells()
+      owner = arange(mesh.num_cells())
+    else:
+      mesh.init(2, 3)
+      tris  = []
+      owner = []
+      for f in facets(mesh):
+        if ff[f] == marker:
+          tris.append(f.entities(0))
+          owner.append(f.entities(3)[0])
+      tris  = array(tris)
+      owner = array(owner)
+    
+    # pixel centres in the coordinates of the mesh :
+    X, Y = meshgrid(di.x, di.y)
+    if di.chg_proj:
+      X, Y = transform(di.p, di.new_p, X, Y)
+    
+    tri       = Triangulation(coord[:,0], coord[:,1], tris)
+    self.tri  = tri.get_trifinder()(X.ravel(), Y.ravel())
+
+    # horizontal areas of the triangles :
+    v         = coord[tris]
+    self.area = 0.5 * abs( (v[:,1,0] - v[:,0,0]) * (v[:,2,1] - v[:,0,1])
+                         - (v[:,2,0] - v[:,0,0]) * (v[:,1,1] - v[:,0,1]))
+    self.tris  = tris
+    self.owner = owner
+
+    # degrees of freedom of the cellwise constant space :
+    self.Q_dg = FunctionSpace(mesh, 'DG', 0)
+    dofmap    = self.Q_dg.dofmap()
+    self.dofs = array([dofmap.cell_dofs(c)[0] for c in owner])
+
+  def bin(self, fn, err=None, valid=None, min_count=1):
+    """
+    Bins the data <fn> of the DataInput object, which is the name of a 
+    field or an array shaped like one.  Returns a dictionary of arrays over 
+    the triangles holding
+
+      'count'  : the number of valid pixels
+      'mean'   : their mean, weighted by the inverse error variance
+      'var'    : the variance of the mean, from the pixel errors if <err> 
+                 is given, and from the scatter of the pixels otherwise
+      'std'    : its square root
+      'err'    : the error of a single pixel, sqrt(count * var), which does 
+                 not shrink with the number of pixels as 'std' does
+      'mask'   : True where at least <min_count> pixels are valid
+      'weight' : the inverse variance per unit area, normalized to a mean 
+                 of one over the masked triangles, so that the misfit of the
+                 cellwise means is weighted as the pixels in them would be
+    
+    :param fn        : name or array of the data
+    :param err       : (Optional) name or array of the pixel errors
+    :param valid     : (Optional) boolean array of the pixels to use
+    :param min_count : minimal number of pixels of a masked triangle
+    """
+    di = self.di
+    d  = di.data[fn] if type(fn) == str else fn
+    d  = array(d, dtype=float).ravel()
+    
+    good = (self.tri >= 0) & isfinite(d)
+    if valid is not None:
+      good &= array(valid).ravel()
+    if err is not None:
+      e     = di.data[err] if type(err) == str else err
+      e     = array(e, dtype=float).ravel()
+      good &= isfinite(e) & (e > 0)
+      w     = 1.0 / e[good]**2
+    else:
+      w     = ones(good.sum())
+    
+    n     = len(self.area)
+    idx   = self.tri[good]
+    d     = d[good]
+    count = bincount(idx, minlength=n)
+    w_sum = bincount(idx, weights=w, minlength=n)
+    mask  = count >= min_count
+    
+    mean        = zeros(n)
+    mean[mask]  = bincount(idx, weights=w*d, minlength=n)[mask] / w_sum[mask]
+    scatter     = bincount(idx, weights=w*(d - mean[idx])**2, minlength=n)
+    var         = zeros(n)
+    if err is not None:
+      var[mask] = 1.0 / w_sum[mask]
+    else:
+      var[mask] = scatter[mask] / w_sum[mask] / count[mask]
+    
+    # the variance of the mean of a single pixel without errors is unknown:
+    var[mask & (var <= 0)] = var[mask & (var > 0)].mean() \
+                             if any(mask & (var > 0)) else 1.0
+    
+    weight       = zeros(n)
+    weight[mask] = 1.0 / (var[mask] * self.area[mask])
+    weight[mask] = weight[mask] / weight[mask].mean()
+    
+    return {'count'  : count,
+            'mean'   : mean,
+            'var'    : var,
+            'std'    : var**0.5,
+            'err'    : (count * var)**0.5,
+            'mask'   : mask,
+            'weight' : weight}
+
+  def get_function(self, values):
+    """
+    Returns a cellwise constant Function holding the array <values> over 
+    the triangles, and zero elsewhere.
+    """
+    f = Function(self.Q_dg)
+    a = zeros(self.Q_dg.dim())
+    a[self.dofs] = values
+    f.vector().set_local(a)
+    f.vector().apply('insert')
+    return f
+
+  def get_mask(self, mask):
+    """
+    Returns a CellFunction which is one in the cells of the triangles 
+    where the boolean array <mask> is True, and zero elsewhere.
+    """
+    cf = CellFunctionSizet(self.mesh)
+    cf.set_all(0)
+    a  = cf.array()
+    a[self.owner[mask]] = 1
+    return cf
+
+  def get_vertex_values(self, values, mask, default=0.0):
+    """
+    Returns the array over the vertices of the mesh of the average of 
+    <values> over the adjacent triangles where <mask> is True, and 
+    <default> at the vertices without such triangles.
+    """
+    n_v   = self.mesh.num_vertices()
+    tris  = self.tris[mask]
+    v     = array(values)[mask]
+    n     = bincount(tris.ravel(), minlength=n_v)
+    s     = bincount(tris.ravel(), weights=repeat(v, 3), minlength=n_v)
+    a     = default * ones(n_v)
+    a[n > 0] = s[n > 0] / n[n > 0]
+    return a
+
+
 class DataOutput:
   
   def __init__(self, directory):
@@ -0,0 +1,327 @@
+"""
+Warm-up of the FFC/Instant cache.
+
+  This builds a tiny model for each supported configuration of the physics
+  classes and compiles all the forms they hold, so that later simulations
+  find every kernel in the cache.  Run it once per cache directory, e.g.
+  on a node that shares it with the batch jobs, with ::
+
+    python src/warmup.py /path/to/shared/cache
+
+  and set INSTANT_CACHE_DIR=/path/to/shared/cache in the jobs.  A report of
+  the compiled forms and their compile times is printed, and written to
+  warmup_report.json in the cache directory.
+
+  The signatures of the forms do not depend on the mesh or on the values
+  of the parameters (see :meth:`~src.model.Model.get_constant`), but they
+  do depend on options such as config['velocity']['quadrature_degree'] 
+  and config['velocity']['rate_factor'].  The built-in cases only cover 
+  the default values of these options, so production configurations are
+  passed with ::
+
+    python src/warmup.py /path/to/shared/cache --config run_config.py
+
+  where run_config.py defines the configuration dictionary 'config' of the
+  production runs, without running them.  Its forms are then compiled on
+  the tiny mesh instead of the built-in cases.  Forms built in the course 
+  of a solve, such as projections, are not covered.
+"""
+import os
+import json
+import time
+import argparse
+
+
+def get_config():
+  """
+  Returns the base configuration of the warm-up models.
+  """
+  return { 'mode'                         : 'steady',
+           't_start'                      : 0.0,
+           't_end'                        : 1.0,
+           'time_step'                    : 1.0,
+           'output_path'                  : './results/',
+           'wall_markers'                 : [],
+           'periodic_boundary_conditions' : False,
+           'log'                          : False,
+           'coupled' :
+           {
+             'on'        : False,
+             'inner_tol' : 0.0,
+             'max_iter'  : 1
+           },
+           'velocity' :
+           {
+             'on'             : True,
+             'newton_params'  : None,
+             'viscosity_mode' : 'isothermal',
+             'b_linear'       : None,
+             'use_T0'         : True,
+             'T0'             : 268.0,
+             'A0'             : 1e-16,
+             'beta2'          : 1e3,
+             'r'              : 0.0,
+             'E'              : 1.0,
+             'approximation'  : 'fo',
+             'boundaries'     : None
+           },
+           'enthalpy' :
+           {
+             'on'                  : False,
+             'use_surface_climate' : False,
+             'T_surface'           : 250.0,
+             'q_geo'               : 0.042*60**2*24*365,
+             'lateral_boundaries'  : None
+           },
+           'free_surface' :
+           {
+             'on'                         : False,
+             'lump_mass_matrix'           : True,
+             'use_shock_capturing'        : False,
+             'static_boundary_conditions' : False,
+             'thklim'                     : 10.0,
+             'use_pdd'                    : False,
+             'observed_smb'               : None
+           },
+           'age' :
+           {
+             'on'              : False,
+             'use_smb_for_ela' : False,
+             'ela'             : 0.0
+           },
+           'adjoint' :
+           {
+             'alpha'               : [1e-2],
+             'beta'                : 0.0,
+             'max_fun'             : 1,
+             'objective_function'  : 'logarithmic',
+             'bounds'              : None,
+             'control_variable'    : None,
+             'regularization_type' : 'Tikhonov'
+           }}
+
+def get_cases():
+  """
+  Returns the list of (name, configuration changes) of the warm-up cases.
+  Each change is a tuple of the config keys and the value to set.
+  """
+  cases = []
+  for approximation in ['fo', 'stokes']:
+    for mode in ['isothermal', 'linear', 'full']:
+      cases.append(('%s, %s' % (approximation, mode),
+                    [(('velocity', 'approximation'),  approximation),
+                     (('velocity', 'viscosity_mode'), mode)]))
+    cases.append(('%s, full, DG0' % approximation,
+                  [(('velocity', 'approximation'),  approximation),
+                   (('velocity', 'viscosity_mode'), 'full'),
+                   (('velocity', 'rate_factor'),    'DG0')]))
+  for approximation in ['sia', 'ssa', 'hybrid']:
+    cases.append((approximation,
+                  [(('velocity', 'approximation'), approximation)]))
+  for objective in ['logarithmic', 'linear', 'kinematic']:
+    for regularization in ['TV', 'Tikhonov']:
+      cases.append(('adjoint, %s, %s' % (objective, regularization),
+                    [(('adjoint', 'objective_function'),  objective),
+                     (('adjoint', 'regularization_type'), regularization)]))
+  for mode in ['steady', 'transient']:
+    cases.append(('enthalpy, %s' % mode, [(('mode',), mode)]))
+    cases.append(('age, %s' % mode,      [(('mode',), mode)]))
+  cases.append(('free surface', [(('mode',), 'transient')]))
+  return cases
+
+
+def get_config_case(path):
+  """
+  Returns the (name, configuration, physics) of the warm-up case of the 
+  production configuration 'config' defined by the Python file <path>.  
+  The physics are those switched on by the configuration, with the adjoint 
+  if it has an 'adjoint' section.  The fields given as arrays over the 
+  production mesh are replaced by the values of the warm-up model, as 
+  they set values and do not enter the forms, and the coarse levels of 
+  grid sequences are dropped.
+  """
+  from numpy import ndarray
+  
+  namespace = {}
+  execfile(path, namespace)
+  config = namespace['config']
+  base   = get_config()
+  
+  names  = ['velocity']
+  if 'adjoint' in config:
+    names.append('adjoint')
+  for name, section in [('enthalpy', 'enthalpy'), ('age', 'age'),
+                        ('free surface', 'free_surface')]:
+    if config.get(section, {}).get('on', False):
+      names.append(name)
+  
+  for section, keys in [('velocity', ['beta2', 'E', 'T0', 'b_linear']),
+                        ('enthalpy', ['T_surface', 'q_geo'])]:
+    d = config.get(section, {})
+    for k in keys:
+      if isinstance(d.get(k), ndarray):
+        d[k] = base[section][k]
+  for section in ['velocity', 'adjoint']:
+    config.get(section, {}).pop('levels', None)
+  for section, value in base.items():
+    config.setdefault(section, value)
+    if isinstance(value, dict):
+      for k, v in value.items():
+        config[section].setdefault(k, v)
+  return os.path.basename(path), config, names
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Compile the forms of the ' +
+                                   'physics classes into the Instant cache.')
+  parser.add_argument('cache_dir', nargs='?', default=None,
+                      help='cache directory, INSTANT_CACHE_DIR by default')
+  parser.add_argument('--nx', type=int, default=2,
+                      help='number of cells along each side of the mesh')
+  parser.add_argument('--config', action='append', default=[],
+                      help='Python file defining the production config ' +
+                           'to compile, instead of the built-in cases')
+  args = parser.parse_args(argv)
+
+  # instant reads the cache directory when it is first imported :
+  if args.cache_dir is not None:
+    os.environ['INSTANT_CACHE_DIR'] = os.path.abspath(args.cache_dir)
+
+  import ufl
+  from dolfin             import Expression, Function, Form, lhs, rhs, \
+                                 set_log_active, cpp
+  from model              import Model
+  from helper             import default_nonlin_solver_params
+  from physical_constants import IceParameters
+  from physics            import VelocityBP, VelocityStokes, VelocitySIA, \
+                                 VelocitySSA, Enthalpy, Age, FreeSurface, \
+                                 AdjointVelocityBP, NewtonProblem
+  set_log_active(False)
+
+  def get_model():
+    model = Model()
+    model.set_geometry(Expression('1000.0 - 1e-3*x[0]'),
+                       Expression('-1e-3*x[0]'))
+    model.generate_uniform_mesh(args.nx, args.nx, args.nx,
+                                xmin=0, xmax=1e4, ymin=0, ymax=1e4)
+    model.set_parameters(IceParameters())
+    model.initialize_variables()
+    return model
+
+  def get_velocity(model, config):
+    approximation = config['velocity']['approximation']
+    if config['velocity']['viscosity_mode'] == 'linear':
+      config['velocity']['b_linear'] = Function(model.Q)
+    if   approximation == 'fo':
+      return VelocityBP(model, config)
+    elif approximation == 'stokes':
+      return VelocityStokes(model, config)
+    elif approximation == 'sia':
+      return VelocitySIA(model, config)
+    else:
+      return VelocitySSA(model, config)
+
+  def get_forms(obj):
+    forms = []
+    for name, value in sorted(vars(obj).items()):
+      if isinstance(value, NewtonProblem):
+        forms.append((name + '.F', value.F_form))
+        forms.append((name + '.J', value.J_form))
+      elif isinstance(value, (list, tuple)):
+        for i, f in enumerate(value):
+          if isinstance(f, (ufl.Form, cpp.Form)):
+            forms.append(('%s[%i]' % (name, i), f))
+      elif isinstance(value, (ufl.Form, cpp.Form)):
+        forms.append((name, value))
+    return forms
+
+  def compile_form(f):
+    # dolfin Forms are compiled when the physics class is set up :
+    if isinstance(f, cpp.Form):
+      return 0.0, 'setup'
+    t0 = time.time()
+    try:
+      Form(f)
+
+    # residuals in terms of a trial function are solved as lhs == rhs :
+    except Exception:
+      try:
+        Form(lhs(f))
+        Form(rhs(f))
+      except Exception as e:
+        return time.time() - t0, 'failed (%s)' % e.__class__.__name__
+    return time.time() - t0, 'compiled'
+
+  # the built-in cases, each with the physics classes it sets up :
+  cases = []
+  for case, changes in get_cases():
+    config = get_config()
+    config['velocity']['newton_params'] = default_nonlin_solver_params()
+    for keys, value in changes:
+      d = config
+      for k in keys[:-1]:
+        d = d[k]
+      d[keys[-1]] = value
+    names = ['velocity']
+    for name in ['adjoint', 'enthalpy', 'age', 'free surface']:
+      if case.startswith(name):
+        names.append(name)
+    cases.append((case, config, names))
+
+  # or the production configurations, with the classes they switch on :
+  if len(args.config) > 0:
+    cases = []
+    for path in args.config:
+      cases.append(get_config_case(path))
+
+  report = []
+  t_all  = time.time()
+  for case, config, names in cases:
+    print '::: %s :::' % case
+    t0 = time.time()
+    try:
+      model    = get_model()
+      config['adjoint']['control_variable'] = [model.beta2]
+      velocity = get_velocity(model, config)
+      objs     = [('velocity', velocity)]
+      if 'adjoint' in names:
+        objs.append(('adjoint', AdjointVelocityBP(model, config, velocity)))
+      if 'enthalpy' in names:
+        objs.append(('enthalpy', Enthalpy(model, config)))
+      if 'age' in names:
+        objs.append(('age', Age(model, config)))
+      if 'free surface' in names:
+        objs.append(('free_surface', FreeSurface(model, config)))
+    except Exception as e:
+      print '    setup failed : %s' % e
+      report.append({'case' : case, 'form' : None, 'time' : 0.0,
+                     'status' : 'setup failed (%s)' % e.__class__.__name__})
+      continue
+    t_setup = time.time() - t0
+    print '    %-40s %8.2f s' % ('setup', t_setup)
+    report.append({'case' : case, 'form' : 'setup', 'time' : t_setup,
+                   'status' : 'compiled'})
+
+    for o_name, obj in objs:
+      for f_name, f in get_forms(obj):
+        t, status = compile_form(f)
+        name      = '%s.%s' % (o_name, f_name)
+        print '    %-40s %8.2f s  %s' % (name, t, status)
+        report.append({'case' : case, 'form' : name, 'time' : t,
+                       'status' : status})
+
+  t_all = time.time() - t_all
+  n     = len([r for r in report if r['form'] not in [None, 'setup']])
+  print 'warm-up of %i forms in %.1f s' % (n, t_all)
+
+  if args.cache_dir is not None:
+    out = open(os.path.join(args.cache_dir, 'warmup_report.json'), 'w')
+    json.dump({'date'  : time.strftime('%Y-%m-%d %H:%M:%S'),
+               'total' : t_all,
+               'forms' : report}, out, indent=2)
+    out.close()
+  return report
+
+
+if __name__ == '__main__':
+  main()
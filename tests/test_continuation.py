@@ -0,0 +1,63 @@
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..'))
+
+import unittest
+import dolfin
+from src.physics import ViscosityContinuation
+
+class TestViscosityContinuation(unittest.TestCase):
+  """
+  The continuation of :class:`~src.physics.ViscosityContinuation` with a
+  mock Newton solve, on a zero initial velocity.
+  """
+  def get_continuation(self, steps=4, iterations=4):
+    config = {'velocity' : {'continuation' : {'eps_reg'    : 1e-2,
+                                              'n'          : 1.0,
+                                              'steps'      : steps,
+                                              'iterations' : iterations}}}
+    U      = dolfin.Function(dolfin.FunctionSpace(dolfin.UnitIntervalMesh(2),
+                                                  'CG', 1))
+    params = {'relative_tolerance'      : 1e-9,
+              'error_on_nonconvergence' : True}
+    return ViscosityContinuation(config, 1e-5, 3.0), U, params
+
+  def test_slow_converged_steps_terminate(self):
+    """
+    Steps which converge in more than twice the iterations aimed at halve
+    the step until it is below 'min_step', and the target is then solved.
+    """
+    target       = 4
+    cont, U, np  = self.get_continuation(steps=4, iterations=target)
+    calls        = []
+    def newton_solve():
+      calls.append(float(cont.n))
+      if len(calls) > 1000:
+        raise RuntimeError('the continuation does not terminate')
+      return 3*target, True
+
+    its, converged = cont.solve(newton_solve, np, U)
+    self.assertTrue(converged)
+    self.assertEqual(calls[-1], 3.0)
+    self.assertEqual(its, 3*target*len(calls))
+    self.assertEqual(np['relative_tolerance'], 1e-9)
+    self.assertTrue(np['error_on_nonconvergence'])
+
+  def test_failed_first_step_solves_target(self):
+    """
+    A failed first step gives up on the continuation.
+    """
+    cont, U, np = self.get_continuation()
+    calls       = []
+    def newton_solve():
+      calls.append(float(cont.n))
+      return 10, len(calls) > 1
+
+    its, converged = cont.solve(newton_solve, np, U)
+    self.assertTrue(converged)
+    self.assertEqual(calls, [1.0, 3.0])
+
+
+if __name__ == '__main__':
+  unittest.main()